@@ -0,0 +1,427 @@
+# ----------------------------------
+# Client Trust Management Benchmarks
+# ----------------------------------
+
+# Runs the Client Trust operations headless against a generated SQLite database and workbooks, then reports
+# wall time, query counts and peak memory for each one. Save a run with --output and check a later run
+# against it with --compare to catch regressions.
+#
+#   python benchmark.py --clients 500 --years 3 --rows 200 --output baseline.json
+#   python benchmark.py --clients 500 --years 3 --rows 200 --compare baseline.json
+
+# -------
+# Imports
+# -------
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import openpyxl
+import pandas as pd
+
+# --------------------
+# Load the application
+# --------------------
+
+# The application is a script with a hyphenated file name, so it is loaded from its path.
+# config_work.json is read relative to the working directory, the same as when the app is started
+app_dir = os.path.dirname(os.path.abspath(__file__))
+os.chdir(app_dir)
+
+spec = importlib.util.spec_from_file_location('client_trust_management',
+                                              os.path.join(app_dir, 'client-trust-management.py'))
+ctm = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(ctm)
+
+# Operations in the order they are run, with the files each one creates (removed before every run) and the
+# files it edits (restored from a pristine copy before every run, so every run does the same work)
+operations = [
+    ('add_deposits', [], []),
+    ('add_withdrawals', [], []),
+    ('add_ins_outs', [], []),
+    ('discharge_patients', [], []),
+    ('generate_store_list', ['store_list'], []),
+    ('replenish_store_balances_thurs', [], ['store_list']),
+    ('generate_new_store_list', ['new_store_list'], []),
+    ('replenish_new_store_balances', [], ['new_store_list']),
+]
+
+first_names = ['James', 'Mary', 'John', 'Patricia', 'Robert', 'Jennifer', 'Michael', 'Linda', 'William',
+               'Elizabeth', 'David', 'Barbara', 'Richard', 'Susan', 'Joseph', 'Jessica', 'Thomas', 'Sarah']
+last_names = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Rodriguez',
+              'Martinez', 'Hernandez', 'Lopez', 'Gonzalez', 'Wilson', 'Anderson', 'Thomas', 'Taylor', 'Moore']
+
+# --------------
+# Data Generator
+# --------------
+
+# Unique synthetic (FirstName, LastName) pairs, numbered once the plain combinations run out
+def client_names(count):
+    names = []
+    for index in range(count):
+        first_name = first_names[index % len(first_names)]
+        last_name = last_names[(index // len(first_names)) % len(last_names)]
+        suffix = index // (len(first_names) * len(last_names))
+        names.append((first_name, f"{last_name}{suffix}" if suffix else last_name))
+    return names
+
+# Build the SQLite database: clients spread over the phases and years of weekly deposits and withdrawals
+def generate_database(database_path, names, years, rng):
+    backend = ctm.SQLiteBackend(database_path)
+    connection = backend.connect()
+    cursor = connection.cursor()
+
+    clients = []
+    spent_clients = set()
+    for client_id, (first_name, last_name) in enumerate(names, start=1):
+        phase = rng.choices(['1', '2', '3', '4'], weights=[60, 15, 10, 15])[0]
+        discharged = phase == '4' and rng.random() < 0.5
+        clients.append((client_id, first_name, last_name, phase, discharged, None, None))
+
+        # Phase 4 clients that are due for discharge have nothing left in their account
+        if phase == '4' and not discharged and rng.random() < 0.5:
+            spent_clients.add(client_id)
+    cursor.executemany("""
+        INSERT INTO Clients (ClientID, FirstName, LastName, Phase, Discharged, Comments, Contract)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, clients)
+
+    # Every client gets a Beginning Balance plus a deposit and a withdrawal most weeks
+    start_date = datetime.today() - timedelta(days=365 * years)
+    transactions = []
+    for client_id in range(1, len(names) + 1):
+        transactions.append((start_date.strftime('%m/%d/%Y'), 'Beginning Balance', 0.0, 0.0, client_id))
+        if client_id in spent_clients:
+            continue
+        for week in range(52 * years):
+            if rng.random() < 0.7:
+                transaction_date = (start_date + timedelta(weeks=week)).strftime('%m/%d/%Y')
+                amount = round(rng.uniform(5, 60), 2)
+                transactions.append((transaction_date, 'Cash', amount, 0.0, client_id))
+                transactions.append((transaction_date, 'Store', 0.0, round(amount * rng.uniform(0.5, 1), 2),
+                                     client_id))
+
+    cursor.executemany(ctm.insert_transaction_query,
+                       [(transaction_id,) + row for transaction_id, row in enumerate(transactions, start=1)])
+    connection.commit()
+    connection.close()
+
+    return clients, len(transactions)
+
+# Deposits or withdrawals sheet of `rows` entries, mostly known clients with a few unknown and repeated ones
+def generate_transaction_sheet(path, names, rows, rng):
+    entries = []
+    for _ in range(rows):
+        first_name, last_name = rng.choice(names) if rng.random() < 0.9 else ('Unknown', f'Patient{rng.randint(1, 999)}')
+        entries.append({'FirstName': first_name, 'LastName': last_name, 'Type': rng.choice(['Cash', 'Check']),
+                        'Amount': round(rng.uniform(5, 100), 2)})
+    pd.DataFrame(entries, columns=['FirstName', 'LastName', 'Type', 'Amount']).to_excel(path, index=False)
+
+# Ins N Outs sheet of `rows` admissions of new patients and discharges of existing ones
+def generate_ins_outs_sheet(path, names, rows, rng):
+    entries = []
+    for index in range(rows):
+        if rng.random() < 0.5:
+            entries.append({'FirstName': 'New', 'LastName': f'Admission{index}', 'Type': 'A',
+                            'Contract': rng.choice(['Yes', 'No']), 'ReasonForDischarge': None})
+        else:
+            first_name, last_name = rng.choice(names)
+            entries.append({'FirstName': first_name, 'LastName': last_name, 'Type': 'D', 'Contract': None,
+                            'ReasonForDischarge': 'Completed Program'})
+    pd.DataFrame(entries, columns=['FirstName', 'LastName', 'Type', 'Contract',
+                                   'ReasonForDischarge']).to_excel(path, index=False)
+
+# Store List Linked To Access: every phase 1 client plus a few who have left, balance in column G
+def generate_linked_workbook(path, clients, rng):
+    workbook = openpyxl.Workbook()
+    worksheet = workbook.active
+    worksheet.append(['LastName', 'FirstName', 'Phase', '', '', '', 'Balance'])
+    for client_id, first_name, last_name, phase, discharged, comments, contract in clients:
+        if phase == '1' or rng.random() < 0.05:
+            worksheet.append([last_name, first_name, phase, None, None, None, round(rng.uniform(0, 100), 2)])
+    workbook.save(path)
+
+# Yesterday's New Store List (names from row 4, Final Balance in H) and today's Quarters sheet
+def generate_store_list_inputs(previous_path, quarters_path, clients, rows, rng):
+    phase_1 = [(last_name, first_name) for client_id, first_name, last_name, phase, *rest in clients
+               if phase == '1']
+
+    workbook = openpyxl.Workbook()
+    worksheet = workbook.active
+    worksheet['A3'], worksheet['B3'], worksheet['H3'] = 'Last Name', 'First Name', 'Final Balance'
+    for row_num, (last_name, first_name) in enumerate(sorted(phase_1), start=4):
+        worksheet[f'A{row_num}'] = last_name
+        worksheet[f'B{row_num}'] = first_name
+        worksheet[f'H{row_num}'] = round(rng.uniform(0, 100), 2)
+    workbook.save(previous_path)
+
+    workbook = openpyxl.Workbook()
+    worksheet = workbook.active
+    worksheet.append(['LastName', 'FirstName', 'Amount'])
+    for _ in range(rows):
+        last_name, first_name = rng.choice(phase_1) if phase_1 else ('Unknown', 'Patient')
+        worksheet.append([last_name, first_name, round(rng.uniform(0.25, 10), 2)])
+    workbook.save(quarters_path)
+
+# Stand-in for the Comcash API with a customer for most phase 1 clients and a few sales each
+class SyntheticComcash:
+    customers = []
+    sales = {}
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    @classmethod
+    def populate(cls, clients, rng):
+        cls.customers = []
+        cls.sales = {}
+        for client_id, first_name, last_name, phase, *rest in clients:
+            if phase == '1' and rng.random() < 0.9:
+                cls.customers.append({'id': client_id, 'firstName': first_name, 'lastName': last_name})
+                cls.sales[client_id] = [
+                    {'products': [{'title': 'Snack', 'price': 1.5}, {'title': 'Soda', 'price': 2.0}],
+                     'payment': {'totalPayedAmount': 3.5}}
+                    for _ in range(rng.randint(0, 3))]
+
+    def get_customer_snapshot(self, status=1, customer_type=4):
+        return ctm.CustomerSnapshot(self.customers)
+
+    def get_sales_for_customers(self, customer_ids, time_from, time_to, max_workers=None, timeout=None):
+        return {customer_id: self.sales.get(customer_id, []) for customer_id in customer_ids}, {}
+
+# Write every fixture into `workdir` and point the application's paths at it
+def generate_fixtures(workdir, clients_count, years, rows, seed):
+    rng = random.Random(seed)
+
+    folders = {name: os.path.join(workdir, name) for name in
+               ['Deposits', 'Withdrawals', 'Ins N Outs', 'Store List', 'New Store List', 'Quarters']}
+    for folder in folders.values():
+        os.makedirs(folder, exist_ok=True)
+
+    today = datetime.today().strftime('%m-%d-%y')
+    yesterday = (datetime.today() - timedelta(days=1)).strftime('%m-%d-%y')
+
+    ctm.auto_deposits_path = os.path.join(folders['Deposits'], 'Automated-Deposits-Sheet.xlsx')
+    ctm.auto_withdrawals_path = os.path.join(folders['Withdrawals'], 'Automated-Withdrawals-Sheet.xlsx')
+    ctm.auto_ins_outs_path = os.path.join(folders['Ins N Outs'], 'Automated-InsOuts.xlsx')
+    ctm.store_list_folder_path = folders['Store List']
+    ctm.linked_to_access_path = os.path.join(folders['Store List'], 'Store List Linked To Access.xlsx')
+    ctm.deposits_folder_path = folders['Deposits']
+    ctm.withdrawals_folder_path = folders['Withdrawals']
+    ctm.new_store_folder_path = folders['New Store List']
+    ctm.quarters_folder_path = folders['Quarters']
+
+    # Run headless: no Excel, no files opened, no Comcash
+    ctm.excel_backend = 'openpyxl'
+    ctm.open_generated_files = False
+    ctm.APIClient = SyntheticComcash
+    ctm.sales_store = ctm.SalesStore(os.path.join(workdir, 'sales.sqlite3'))
+
+    names = client_names(clients_count)
+    template_path = os.path.join(workdir, 'template.sqlite3')
+    if os.path.exists(template_path):
+        os.remove(template_path)  # Regenerate rather than add to a database left by an earlier run
+    clients, transaction_count = generate_database(template_path, names, years, rng)
+
+    generate_transaction_sheet(ctm.auto_deposits_path, names, rows, rng)
+    generate_transaction_sheet(ctm.auto_withdrawals_path, names, rows, rng)
+    generate_ins_outs_sheet(ctm.auto_ins_outs_path, names, rows, rng)
+    generate_linked_workbook(ctm.linked_to_access_path, clients, rng)
+    generate_store_list_inputs(os.path.join(folders['New Store List'], f'Store List_{yesterday}.xlsx'),
+                               os.path.join(folders['Quarters'], f'Quarters_{today}.xlsx'), clients, rows, rng)
+    SyntheticComcash.populate(clients, rng)
+
+    # Files created by the operations, removed before each run so every run does the full work
+    outputs = {
+        'store_list': os.path.join(folders['Store List'], f'Store List_{today}.xlsx'),
+        'new_store_list': os.path.join(folders['New Store List'], f'Store List_{today}.xlsx'),
+    }
+
+    # Pristine copies of the store lists the top-ups edit, made once by the operations that create them
+    pristine = {}
+    for name, key in (('generate_store_list', 'store_list'), ('generate_new_store_list', 'new_store_list')):
+        run = run_operation(name, template_path, os.path.join(workdir, 'benchmark.sqlite3'), [outputs[key]], {},
+                            False)
+        if run['failed'] or not os.path.exists(outputs[key]):
+            sys.exit(f"Could not generate the {key} fixture: {run['outcome']}")
+        pristine[key] = os.path.join(workdir, f'pristine_{key}.xlsx')
+        shutil.move(outputs[key], pristine[key])
+
+    return template_path, outputs, pristine, transaction_count
+
+# ------
+# Runner
+# ------
+
+# Run one operation against a fresh copy of the database and of the workbooks it edits (pristine copy ->
+# path), returning its measurements
+def run_operation(name, template_path, database_path, outputs, inputs, trace_memory):
+    shutil.copyfile(template_path, database_path)
+    for output in outputs:
+        if os.path.exists(output):
+            os.remove(output)
+    for pristine_path, input_path in inputs.items():
+        shutil.copyfile(pristine_path, input_path)
+
+    # Start with an empty sales store so every run fetches its sales
+    ctm.sales_store.close()
+    if os.path.exists(ctm.sales_store.database_path):
+        os.remove(ctm.sales_store.database_path)
+
+    host = ctm.ClientTrustOperations(ctm.CommandLineReporter(echo=False),
+                                     ctm.ConnectionManager(ctm.SQLiteBackend(database_path)))
+
+    # Keep the operation's console prints out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        host.db.acquire()  # Connect before timing, the app keeps its connections open between operations
+        host.db.reset_stats()
+
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        getattr(host, name)()
+        elapsed = time.perf_counter() - start
+        peak_memory = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        if trace_memory:
+            tracemalloc.stop()
+
+    with host.db.stats_lock:
+        queries = sum(count for count, seconds in host.db.statement_stats.values())
+        database_time = sum(seconds for count, seconds in host.db.statement_stats.values())
+    host.db.close_all()
+
+    # The first thing the operation reported, or the error it stopped with
+    messages = [line for line in host.result_box.messages if line]
+    outcome = (messages[-1] if host.result_box.failed else messages[0]) if messages else ''
+    return {'seconds': elapsed, 'queries': queries, 'database_seconds': database_time,
+            'peak_memory': peak_memory, 'failed': host.result_box.failed, 'outcome': outcome}
+
+# Run every selected operation `repeat` times, keeping the fastest time and measuring memory in one extra run
+def run_benchmarks(names, template_path, workdir, outputs, pristine, repeat, trace_memory):
+    database_path = os.path.join(workdir, 'benchmark.sqlite3')
+    results = {}
+
+    for name, output_keys, input_keys in operations:
+        if name not in names:
+            continue
+        output_paths = [outputs[key] for key in output_keys]
+        input_paths = {pristine[key]: outputs[key] for key in input_keys}
+
+        runs = [run_operation(name, template_path, database_path, output_paths, input_paths, False)
+                for _ in range(repeat)]
+        result = min(runs, key=lambda run: run['seconds'])
+        result['median_seconds'] = statistics.median(run['seconds'] for run in runs)
+        if trace_memory:
+            result['peak_memory'] = run_operation(name, template_path, database_path, output_paths, input_paths,
+                                                  True)['peak_memory']
+        results[name] = result
+
+        print(f"{name:32} {result['seconds']:8.3f}s {result['queries']:7d} queries "
+              f"{result['database_seconds']:8.3f}s in db {format_memory(result['peak_memory']):>10}  "
+              f"{result['outcome'][:60]}")
+
+    return results
+
+def format_memory(peak_memory):
+    if peak_memory is None:
+        return '-'
+    return f"{peak_memory / (1024 * 1024):.1f} MiB"
+
+# -------------------
+# Regression Checking
+# -------------------
+
+# Compare against a saved run, returns the regressions found
+def compare_results(results, baseline, threshold):
+    regressions = []
+
+    print()
+    print(f"{'operation':32} {'seconds':>18} {'queries':>16} {'peak memory':>24}")
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+
+        time_ratio = result['seconds'] / previous['seconds'] if previous['seconds'] else 1.0
+        print(f"{name:32} {previous['seconds']:7.3f} -> {result['seconds']:7.3f} "
+              f"{previous['queries']:6d} -> {result['queries']:6d} "
+              f"{format_memory(previous.get('peak_memory')):>10} -> {format_memory(result.get('peak_memory')):>10}")
+
+        if time_ratio > 1 + threshold:
+            regressions.append(f"{name} took {time_ratio:.2f}x as long ({previous['seconds']:.3f}s -> "
+                               f"{result['seconds']:.3f}s)")
+        if result['queries'] > previous['queries']:
+            regressions.append(f"{name} ran {result['queries']} queries, up from {previous['queries']}")
+        if result.get('peak_memory') and previous.get('peak_memory') and \
+                result['peak_memory'] > previous['peak_memory'] * (1 + threshold):
+            regressions.append(f"{name} peak memory grew to {format_memory(result['peak_memory'])} "
+                               f"from {format_memory(previous['peak_memory'])}")
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Client Trust Management operations "
+                                                 "against synthetic data.")
+    parser.add_argument('--clients', type=int, default=300, help="Number of clients in the database")
+    parser.add_argument('--years', type=int, default=2, help="Years of transaction history per client")
+    parser.add_argument('--rows', type=int, default=100,
+                        help="Rows in the deposits, withdrawals, Ins N Outs and Quarters sheets")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed for the generated data")
+    parser.add_argument('--repeat', type=int, default=3, help="Timed runs per operation, the fastest is kept")
+    parser.add_argument('--operations', nargs='+', choices=[operation[0] for operation in operations],
+                        default=[operation[0] for operation in operations], help="Operations to run")
+    parser.add_argument('--no-memory', action='store_true', help="Skip the tracemalloc peak memory run")
+    parser.add_argument('--workdir', help="Directory for the generated fixtures (default: a temporary one)")
+    parser.add_argument('--output', help="Save the results as JSON")
+    parser.add_argument('--compare', help="Compare against results saved with --output")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="Allowed slowdown before a run counts as a regression (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='ctm-benchmark-')
+    os.makedirs(workdir, exist_ok=True)
+
+    parameters = {'clients': args.clients, 'years': args.years, 'rows': args.rows, 'seed': args.seed}
+    print(f"Generating {args.clients} clients, {args.years} years of history and {args.rows}-row sheets "
+          f"in {workdir}")
+    template_path, outputs, pristine, transaction_count = generate_fixtures(workdir, args.clients, args.years,
+                                                                            args.rows, args.seed)
+    print(f"{transaction_count} transactions generated.")
+    print()
+
+    results = run_benchmarks(args.operations, template_path, workdir, outputs, pristine, args.repeat,
+                             not args.no_memory)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'parameters': parameters, 'results': results}, file, indent=2)
+        print(f"\nResults saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            baseline = json.load(file)
+        if baseline.get('parameters') != parameters:
+            print(f"\nWarning: baseline was generated with {baseline.get('parameters')}, this run used {parameters}")
+
+        regressions = compare_results(results, baseline.get('results', {}), args.threshold)
+        if regressions:
+            print("\nRegressions:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("\nNo regressions.")
+
+if __name__ == '__main__':
+    main()
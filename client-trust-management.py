@@ -13,26 +13,81 @@
 # Imports
 # -------
 
+import time
+startup_started = time.perf_counter()  # For the startup profile
+
 import os
 import sys
-import openpyxl
-import pyodbc
-from PyQt5.QtWidgets import (QApplication, QMainWindow,
-                             QPushButton, QVBoxLayout,
-                             QHBoxLayout, QTextEdit,
-                             QLabel, QWidget, QGroupBox)
-from PyQt5.QtCore import Qt
-import pandas as pd
-import xlwings as xw
-from datetime import datetime, timedelta
-from openpyxl import load_workbook
-from openpyxl.styles import PatternFill, Font, Alignment, Border, Side
-from openpyxl.worksheet.table import Table, TableStyleInfo
+import importlib
+from datetime import datetime, date, timedelta
 import shutil
 import json
-import requests
-import time
-from API import API_KEY, API_PIN, API_PASSWORD, API_URL
+import base64
+import argparse
+import logging
+from logging.handlers import RotatingFileHandler
+from contextlib import contextmanager, redirect_stdout
+import sqlite3
+import re
+import zipfile
+from xml.etree import ElementTree
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Seconds each deferred module took to import, in the order they were first used
+deferred_import_times = {}
+
+# Import a module the first time an operation needs it and time how long that took
+def import_deferred(name):
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    elapsed = time.perf_counter() - start
+
+    if name not in deferred_import_times:
+        deferred_import_times[name] = elapsed
+        record_span('import', name, elapsed)
+    return module
+
+# Stands in for a module until one of its attributes is used, so the window can open without loading
+# pandas, openpyxl, xlwings, pyodbc and requests
+class LazyModule:
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attribute):
+        if self.module is None:
+            self.module = import_deferred(self.name)
+        return getattr(self.module, attribute)
+
+# Stands in for a class imported from a deferred module, e.g. openpyxl.styles.PatternFill
+class LazyName:
+    def __init__(self, module, name):
+        self.module = module
+        self.name = name
+
+    def __call__(self, *args, **kwargs):
+        return getattr(self.module, self.name)(*args, **kwargs)
+
+openpyxl = LazyModule('openpyxl')
+pyodbc = LazyModule('pyodbc')
+pd = LazyModule('pandas')
+xw = LazyModule('xlwings')
+requests = LazyModule('requests')
+openpyxl_styles = LazyModule('openpyxl.styles')
+openpyxl_table = LazyModule('openpyxl.worksheet.table')
+requests_adapters = LazyModule('requests.adapters')
+PatternFill = LazyName(openpyxl_styles, 'PatternFill')
+Font = LazyName(openpyxl_styles, 'Font')
+Alignment = LazyName(openpyxl_styles, 'Alignment')
+Border = LazyName(openpyxl_styles, 'Border')
+Side = LazyName(openpyxl_styles, 'Side')
+Table = LazyName(openpyxl_table, 'Table')
+TableStyleInfo = LazyName(openpyxl_table, 'TableStyleInfo')
+openpyxl_utils = LazyModule('openpyxl.utils')
+column_index_from_string = LazyName(openpyxl_utils, 'column_index_from_string')
+get_column_letter = LazyName(openpyxl_utils, 'get_column_letter')
+HTTPAdapter = LazyName(requests_adapters, 'HTTPAdapter')
 
 # --------------
 # ALL FILE PATHS
@@ -62,133 +117,1715 @@ withdrawals_folder_path = os.path.join(excel_base_dir, '2024 Withdrawals')
 new_store_folder_path = os.path.join(excel_base_dir,'New Store List')
 quarters_folder_path = os.path.join(excel_base_dir, 'Quarters')
 
+# Top up the store lists through Excel on Windows. Set to 'openpyxl' to edit the files directly on a headless
+# machine or server, their formulas are saved with computed values so no Excel recalculation is needed
+excel_backend = config.get('excel_backend', 'xlwings' if sys.platform == 'win32' else 'openpyxl')
+
+# Open generated workbooks in Excel once they are saved (Windows only)
+open_generated_files = config.get('open_generated_files', sys.platform == 'win32')
+
+# Open a generated file with its default program when that is turned on
+def open_file(file_path):
+    if open_generated_files:
+        os.startfile(file_path)
+
 # Database Connection String
 connection_string = (
         r'DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};'
         r'DBQ=' + database_path + ';'
 )
 
+# ---------------
+# Instrumentation
+# ---------------
+
+# Counts and durations of the Access queries, Comcash calls and workbook I/O made by each operation,
+# written to a rotating JSON log (one record per line) for looking at trends over time
+operation_log_path = config.get('operation_log_path', 'operation_log.jsonl')
+operation_log_max_bytes = config.get('operation_log_max_bytes', 1024 * 1024)
+operation_log_backups = config.get('operation_log_backups', 5)
+
+# The spans being recorded on this thread, set while an operation runs
+instrumentation = threading.local()
+
+# Irregular plurals for the summary line, everything else gets an "s"
+span_plurals = {'query': 'queries'}
+
+class OperationSpans:
+    def __init__(self, name):
+        self.name = name
+        self.started = datetime.now()
+        self.start = time.perf_counter()
+        self.seconds = None
+        self.lock = threading.Lock()  # Comcash requests record from several threads at once
+        self.spans = {}  # (subject, action) -> [count, seconds]
+
+    def add(self, subject, action, seconds, count=1):
+        with self.lock:
+            stats = self.spans.setdefault((subject, action), [0, 0.0])
+            stats[0] += count
+            stats[1] += seconds
+
+    def finish(self):
+        self.seconds = time.perf_counter() - self.start
+
+    def summary(self):
+        # e.g. "Generate New Store List 9.8s: 1 Access query 0.02s, 62 HTTP calls 8.1s, 1 workbook open 3.4s"
+        parts = []
+        with self.lock:
+            for (subject, action), (count, seconds) in self.spans.items():
+                noun = action if count == 1 else span_plurals.get(action, f"{action}s")
+                parts.append(f"{count} {subject} {noun} {seconds:.2f}s")
+        return f"{self.name} {self.seconds:.2f}s: " + (', '.join(parts) if parts else "no I/O recorded")
+
+    def record(self, status):
+        with self.lock:
+            spans = {f"{subject} {action}": {'count': count, 'seconds': round(seconds, 4)}
+                     for (subject, action), (count, seconds) in self.spans.items()}
+        return {'operation': self.name, 'started': self.started.isoformat(timespec='seconds'),
+                'seconds': round(self.seconds, 4), 'status': status, 'spans': spans}
+
+# Add a timed call to the operation running on this thread, if there is one
+def record_span(subject, action, seconds, count=1):
+    spans = getattr(instrumentation, 'spans', None)
+    if spans is not None:
+        spans.add(subject, action, seconds, count)
+
+@contextmanager
+def span(subject, action):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(subject, action, time.perf_counter() - start)
+
+# Run a function on another thread (e.g. a Comcash worker) recording into the calling operation's spans
+def call_in_spans(spans, function, *args):
+    instrumentation.spans = spans
+    try:
+        return function(*args)
+    finally:
+        instrumentation.spans = None
+
+# Start recording an operation on this thread
+def begin_spans(name):
+    instrumentation.spans = OperationSpans(name)
+    return instrumentation.spans
+
+# Stop recording and append the operation's record to the log
+def end_spans(spans, status):
+    instrumentation.spans = None
+    spans.finish()
+    try:
+        operation_logger().info(json.dumps(spans.record(status)))
+    except OSError as e:
+        print(f"Could not write the operation log: {e}")
+
+def operation_logger():
+    logger = logging.getLogger('client_trust.operations')
+
+    # Open the log file on first use
+    if not logger.handlers:
+        handler = RotatingFileHandler(operation_log_path, maxBytes=operation_log_max_bytes,
+                                      backupCount=operation_log_backups, encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+# Workbook I/O, timed as workbook spans
+def open_workbook(file_path, **kwargs):
+    with span('workbook', 'open'):
+        return openpyxl.load_workbook(file_path, **kwargs)
+
+def save_workbook(workbook, file_path):
+    with span('workbook', 'save'):
+        workbook.save(file_path)
+        cache_formula_values(file_path, workbook)
+
+def read_excel(file_path, **kwargs):
+    with span('workbook', 'read'):
+        return pd.read_excel(file_path, **kwargs)
+
+# ------------------
+# Formula Evaluation
+# ------------------
+
+# openpyxl saves formulas without values, so a file this module wrote used to need Excel to recalculate it
+# before anything could read its balances. The formula shapes written here (cell arithmetic like
+# =C4-E4-F4+G4 and SUM over a range) are computed in Python and saved as the cells' cached values.
+formula_term = re.compile(r'\s*([+-]?)\s*(?:SUM\(\$?([A-Z]+)\$?(\d+):\$?([A-Z]+)\$?(\d+)\)|\$?([A-Z]+)\$?(\d+)'
+                          r'|(\d+(?:\.\d+)?))\s*')
+
+class FormulaEvaluator:
+    def __init__(self, worksheet):
+        self.cells = {}
+        for row in worksheet.iter_rows():
+            for cell in row:
+                if cell.value is not None:
+                    self.cells[(cell.column, cell.row)] = cell.value
+        self.results = {}
+        self.evaluating = set()
+
+    def value(self, column, row):
+        # A cell's number: formulas are evaluated, blanks and text count as 0 like cell_number
+        value = self.cells.get((column, row))
+        if isinstance(value, str) and value.startswith('='):
+            return self.formula_value(column, row)
+        return cell_number(value)
+
+    def formula_value(self, column, row):
+        key = (column, row)
+        if key not in self.results:
+            # A formula that refers back to itself can't be worked out
+            if key in self.evaluating:
+                raise ValueError("circular reference")
+            self.evaluating.add(key)
+            try:
+                self.results[key] = self.evaluate(self.cells[key][1:])
+            finally:
+                self.evaluating.discard(key)
+        return self.results[key]
+
+    def evaluate(self, formula):
+        total = 0.0
+        position = 0
+        while position < len(formula):
+            match = formula_term.match(formula, position)
+            if not match or match.end() == position or (position and not match.group(1)):
+                raise ValueError(f"unsupported formula ={formula}")
+            sign, sum_start_col, sum_start_row, sum_end_col, sum_end_row, col, row, number = match.groups()
+
+            if sum_start_col:
+                term = 0.0
+                for sum_col in range(column_index_from_string(sum_start_col),
+                                     column_index_from_string(sum_end_col) + 1):
+                    for sum_row in range(int(sum_start_row), int(sum_end_row) + 1):
+                        term += self.value(sum_col, sum_row)
+            elif col:
+                term = self.value(column_index_from_string(col), int(row))
+            else:
+                term = float(number)
+
+            total += -term if sign == '-' else term
+            position = match.end()
+        return total
+
+    def formula_values(self):
+        # Cell reference -> value of every formula that could be worked out
+        values = {}
+        for (column, row), value in self.cells.items():
+            if isinstance(value, str) and value.startswith('='):
+                try:
+                    values[f"{get_column_letter(column)}{row}"] = self.formula_value(column, row)
+                except ValueError:
+                    continue
+        return values
+
+# Write the worked out formula values into a saved xlsx as the cells' cached values
+def cache_formula_values(file_path, workbook):
+    values_by_title = {worksheet.title: FormulaEvaluator(worksheet).formula_values()
+                       for worksheet in workbook.worksheets}
+    if not any(values_by_title.values()):
+        return
+
+    with zipfile.ZipFile(file_path) as source:
+        entries = {info.filename: source.read(info.filename) for info in source.infolist()}
+
+    # Find each sheet's XML part through the workbook's relationships
+    namespaces = {'main': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main',
+                  'rel': 'http://schemas.openxmlformats.org/officeDocument/2006/relationships',
+                  'pkg': 'http://schemas.openxmlformats.org/package/2006/relationships'}
+    targets = {relationship.get('Id'): relationship.get('Target') for relationship in
+               ElementTree.fromstring(entries['xl/_rels/workbook.xml.rels']).findall('pkg:Relationship', namespaces)}
+
+    for sheet in ElementTree.fromstring(entries['xl/workbook.xml']).find('main:sheets', namespaces):
+        values = values_by_title.get(sheet.get('name'))
+        target = targets.get(sheet.get(f"{{{namespaces['rel']}}}id"), '')
+        part = target.lstrip('/') if target.startswith('/') else f"xl/{target}"
+        if not values or part not in entries:
+            continue
+
+        # openpyxl writes a formula cell as <c r="H4" ...><f>C4-E4-F4+G4</f><v /></c>, or with an empty
+        # <v></v> when lxml is installed
+        cached = set()
+
+        def add_value(match):
+            value = values.get(match.group(2))
+            if value is None:
+                return match.group(0)
+            cached.add(match.group(2))
+            return f"{match.group(1)}<f>{match.group(3)}</f><v>{float(value)!r}</v></c>"
+
+        xml = entries[part].decode('utf-8')
+        entries[part] = re.sub(r'(<c r="([A-Z]+\d+)"[^>]*>)<f>([^<]*)</f>(?:<v\s*/>|<v>\s*</v>)?\s*</c>',
+                               add_value, xml).encode('utf-8')
+
+        # Say so when a cell was written in a form this doesn't recognise, rather than leave it blank quietly
+        if len(cached) < len(values):
+            print(f"{len(values) - len(cached)} formula values on '{sheet.get('name')}' could not be saved in "
+                  f"{os.path.basename(file_path)}, they are blank until Excel recalculates the file.")
+
+    # Excel still recalculates everything when the file is opened
+    workbook_xml = entries['xl/workbook.xml'].decode('utf-8')
+    if 'fullCalcOnLoad' not in workbook_xml:
+        workbook_xml = re.sub(r'<calcPr\b', '<calcPr fullCalcOnLoad="1"', workbook_xml, count=1)
+        entries['xl/workbook.xml'] = workbook_xml.encode('utf-8')
+
+    temporary_path = f"{file_path}.tmp"
+    with zipfile.ZipFile(temporary_path, 'w', zipfile.ZIP_DEFLATED) as target_zip:
+        for name, data in entries.items():
+            target_zip.writestr(name, data)
+    os.replace(temporary_path, file_path)
+
+# ----------------
+# Storage Backends
+# ----------------
+
+# Errors raised by either database driver, caught by the operations below. pyodbc can only have raised
+# something once it has been imported, so it isn't imported just to build the except clause
+def database_errors():
+    if 'pyodbc' in sys.modules:
+        return sys.modules['pyodbc'].Error, sqlite3.Error
+    return sqlite3.Error,
+
+def integrity_errors():
+    if 'pyodbc' in sys.modules:
+        return sys.modules['pyodbc'].IntegrityError, sqlite3.IntegrityError
+    return sqlite3.IntegrityError,
+
+# The Client Trust database in Microsoft Access, through the Access ODBC driver (Windows only)
+class AccessBackend:
+    name = 'Access'
+
+    def __init__(self, connection_string):
+        self.connection_string = connection_string
+
+    def connect(self):
+        return pyodbc.connect(self.connection_string)
+
+# The same Clients/Transactions tables and Balance query in a SQLite file, so the pipeline can run headless
+class SQLiteBackend:
+    name = 'SQLite'
+
+    # Name columns compare without case, the same as Access text comparisons. Transaction dates are
+    # bound as MM/DD/YYYY text, Access converts them to dates and SQLite keeps the text
+    schema = """
+        CREATE TABLE IF NOT EXISTS Clients (
+            ClientID INTEGER PRIMARY KEY,
+            FirstName TEXT COLLATE NOCASE,
+            LastName TEXT COLLATE NOCASE,
+            Phase TEXT,
+            Discharged BOOLEAN DEFAULT 0,
+            Comments TEXT,
+            Contract TEXT
+        );
+        CREATE TABLE IF NOT EXISTS Transactions (
+            TransactionID INTEGER PRIMARY KEY,
+            TransactionDate TEXT,
+            TransactionDescription TEXT,
+            DepositAmount REAL,
+            WithdrawalAmount REAL,
+            ClientID INTEGER REFERENCES Clients (ClientID)
+        );
+        CREATE INDEX IF NOT EXISTS TransactionsByDate ON Transactions (TransactionDate);
+        CREATE INDEX IF NOT EXISTS TransactionsByClient ON Transactions (ClientID);
+        CREATE INDEX IF NOT EXISTS ClientsByName ON Clients (LastName, FirstName);
+        CREATE VIEW IF NOT EXISTS Balance AS
+            SELECT c.ClientID, c.FirstName, c.LastName, c.Phase,
+            SUM(t.DepositAmount) AS [Sum of DepositAmount], SUM(t.WithdrawalAmount) AS [Sum of WithdrawalAmount]
+            FROM Clients AS c LEFT JOIN Transactions AS t ON t.ClientID = c.ClientID
+            GROUP BY c.ClientID, c.FirstName, c.LastName, c.Phase;
+    """
+
+    def __init__(self, database_path):
+        self.database_path = database_path
+
+    def connect(self):
+        # Connections are handed between the GUI and worker threads by the ConnectionManager
+        connection = sqlite3.connect(self.database_path, check_same_thread=False)
+        connection.row_factory = SQLiteRow.from_cursor
+        connection.executescript(self.schema)
+        connection.commit()
+        return SQLiteConnection(connection)
+
+# Gives a sqlite3 connection the pyodbc calling convention the operations use
+class SQLiteConnection:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def cursor(self):
+        return SQLiteCursor(self.connection.cursor())
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def close(self):
+        self.connection.close()
+
+# A result row that, like a pyodbc Row, is a tuple whose columns can also be read by name (row.FirstName)
+class SQLiteRow(tuple):
+    def __new__(cls, values, columns):
+        row = super().__new__(cls, values)
+        row.columns = columns
+        return row
+
+    @classmethod
+    def from_cursor(cls, cursor, values):
+        return cls(values, [column[0] for column in cursor.description])
+
+    def __getattr__(self, name):
+        try:
+            return self[self.columns.index(name)]
+        except ValueError:
+            raise AttributeError(name) from None
+
+class SQLiteCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, *params):
+        # pyodbc takes parameters either spread out or as a single sequence
+        if len(params) == 1 and isinstance(params[0], (tuple, list)):
+            params = params[0]
+        self.cursor.execute(sql, tuple(params))
+        return self
+
+    def executemany(self, sql, rows):
+        self.cursor.executemany(sql, rows)
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def close(self):
+        self.cursor.close()
+
+# Pick the backend from the config, Access unless told otherwise
+def make_storage_backend(config):
+    if config.get('storage_backend', 'access') == 'sqlite':
+        return SQLiteBackend(config.get('sqlite_database_path', 'client_trust.sqlite3'))
+    return AccessBackend(connection_string)
+
+storage_backend = make_storage_backend(config)
+
+# ------------------
+# Connection Manager
+# ------------------
+
+# Keeps one open, health-checked database connection per worker thread so the ODBC driver's
+# connect cost (opening the file, creating the lock file) is paid once instead of on every button press
+class ConnectionManager:
+    def __init__(self, backend, health_check_query="SELECT COUNT(*) FROM Clients WHERE 1 = 0",
+                 health_check_interval=30, statement_cache_size=32):
+        self.backend = backend
+        self.health_check_query = health_check_query
+        self.health_check_interval = health_check_interval  # Seconds a connection can sit idle before it is checked
+        self.statement_cache_size = statement_cache_size  # Prepared statements kept per connection
+        self.local = threading.local()
+        self.connections = []
+
+        # Driver timing, shared by every thread
+        self.stats_lock = threading.Lock()
+        self.connect_count = 0
+        self.connect_time = 0.0
+        self.statement_stats = {}  # SQL -> [executions, seconds]
+
+    def acquire(self):
+        # Hand out this thread's connection, reconnecting if it has gone bad
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None and not connection.is_healthy():
+            connection.close()
+            connection = None
+
+        if connection is None:
+            connection = self.connect()
+        return connection
+
+    def release(self, connection):
+        # Drop anything the operation left uncommitted and keep the connection open for the next one
+        try:
+            connection.rollback()
+        except database_errors():
+            connection.close()
+
+    def connect(self):
+        start = time.perf_counter()
+        raw_connection = self.backend.connect()
+        elapsed = time.perf_counter() - start
+        record_span(self.backend.name, 'connect', elapsed)
+
+        with self.stats_lock:
+            self.connect_count += 1
+            self.connect_time += elapsed
+        print(f"Connected to {self.backend.name} in {elapsed:.3f}s.")
+
+        connection = ManagedConnection(self, raw_connection)
+        self.local.connection = connection
+        with self.stats_lock:
+            self.connections.append(connection)
+        return connection
+
+    def record(self, sql, seconds, executed=True):
+        # Fetches add to the time of the statement they read from without counting as another execution
+        with self.stats_lock:
+            stats = self.statement_stats.setdefault(' '.join(sql.split()), [0, 0.0])
+            stats[0] += 1 if executed else 0
+            stats[1] += seconds
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.connect_count = 0
+            self.connect_time = 0.0
+            self.statement_stats = {}
+
+    def close_all(self):
+        with self.stats_lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            connection.close()
+
+    def timing_summary(self):
+        # Connect and per-statement time spent in the driver, slowest statements first
+        with self.stats_lock:
+            lines = [f"{self.backend.name} connects: {self.connect_count} in {self.connect_time:.3f}s"]
+            for sql, (count, seconds) in sorted(self.statement_stats.items(), key=lambda item: -item[1][1]):
+                lines.append(f"{seconds:8.3f}s {count:6d}x  {sql[:100]}")
+        return lines
+
+# A database connection owned by ConnectionManager, with a cache of one prepared cursor per statement
+class ManagedConnection:
+    def __init__(self, manager, connection):
+        self.manager = manager
+        self.connection = connection
+        self.statements = {}  # SQL -> cursor, in least recently used order
+        self.last_used = time.monotonic()
+        self.closed = False
+
+    def cursor(self):
+        return StatementCursor(self)
+
+    def statement_cursor(self, sql):
+        # pyodbc keeps a statement prepared while the same SQL is run again on the same cursor
+        self.last_used = time.monotonic()
+        cursor = self.statements.pop(sql, None)
+        if cursor is None:
+            cursor = self.connection.cursor()
+            if len(self.statements) >= self.manager.statement_cache_size:
+                oldest_sql = next(iter(self.statements))
+                self.statements.pop(oldest_sql).close()
+        self.statements[sql] = cursor
+        return cursor
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def is_healthy(self):
+        if self.closed:
+            return False
+
+        # Only check a connection that has been idle for a while
+        if time.monotonic() - self.last_used < self.manager.health_check_interval:
+            return True
+
+        try:
+            cursor = self.statement_cursor(self.manager.health_check_query)
+            cursor.execute(self.manager.health_check_query)
+            cursor.fetchall()
+            return True
+        except database_errors():
+            return False
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.statements.clear()
+        try:
+            self.connection.close()
+        except database_errors():
+            pass
+
+# Cursor handed to operations: routes each statement to its prepared cursor and times the driver calls
+class StatementCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = None
+        self.sql = None
+
+    def execute(self, sql, *params):
+        self.sql = sql
+        self.cursor = self.connection.statement_cursor(sql)
+        start = time.perf_counter()
+        self.cursor.execute(sql, *params)
+        self.connection.manager.record(sql, time.perf_counter() - start)
+        record_span(self.connection.manager.backend.name, 'query', time.perf_counter() - start)
+        return self
+
+    def executemany(self, sql, rows):
+        self.sql = sql
+        self.cursor = self.connection.statement_cursor(sql)
+        start = time.perf_counter()
+        self.cursor.executemany(sql, rows)
+        self.connection.manager.record(sql, time.perf_counter() - start)
+        record_span(self.connection.manager.backend.name, 'query', time.perf_counter() - start)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self.cursor.fetchone()
+        self.connection.manager.record(self.sql, time.perf_counter() - start, executed=False)
+        record_span(self.connection.manager.backend.name, 'query', time.perf_counter() - start, count=0)
+        return row
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = self.cursor.fetchall()
+        self.connection.manager.record(self.sql, time.perf_counter() - start, executed=False)
+        record_span(self.connection.manager.backend.name, 'query', time.perf_counter() - start, count=0)
+        return rows
+
+# -------------
+# ID Allocation
+# -------------
+
+# Hands out TransactionID/ClientID values from a block reserved with a single MAX query
+class IDAllocator:
+    def __init__(self, cursor, table, column):
+        self.cursor = cursor
+        self.max_query = f"SELECT MAX({column}) FROM {table}"
+        self.next_id = None
+        self.last_id = None
+
+    def reserve(self, count):
+        # Read the current maximum once and keep the next `count` IDs for this run
+        self.cursor.execute(self.max_query)
+        max_id = self.cursor.fetchone()[0] or 0
+
+        self.next_id = int(max_id) + 1
+        self.last_id = int(max_id) + count
+
+    def allocate(self):
+        # Reserve another block if this one has run out
+        if self.next_id is None or self.next_id > self.last_id:
+            self.reserve(1)
+
+        allocated_id = self.next_id
+        self.next_id += 1
+        return allocated_id
+
+    def reset(self):
+        # Forget the reserved block so the next allocation re-reads the table
+        self.next_id = None
+        self.last_id = None
+
+# Run a block of inserts that use allocated IDs, retrying with fresh IDs when someone else took them first
+def run_with_id_retry(connection, allocators, write, retries=3):
+    for attempt in range(1, retries + 1):
+        try:
+            result = write()
+            connection.commit()
+            return result
+        except integrity_errors():
+            # Another user inserted the same IDs since they were reserved, roll back and reserve again
+            connection.rollback()
+            for allocator in allocators:
+                allocator.reset()
+            if attempt == retries:
+                raise
+
+# ---------------
+# Client Balances
+# ---------------
+
+# ClientBalances keeps each client's deposit and withdrawal totals so balance lookups don't have to
+# aggregate the whole Transactions history. It is created by the Verify/Rebuild Client Balances command
+# and, once it exists, every insert path below updates it in the same transaction as the Transactions rows
+create_client_balances_query = """
+    CREATE TABLE ClientBalances (
+        ClientID INTEGER PRIMARY KEY,
+        DepositSum DOUBLE,
+        WithdrawalSum DOUBLE,
+        NetBalance DOUBLE
+    )
+"""
+
+# Rows shaped like the Balance query, one per client, read from ClientBalances. Clients without a
+# ClientBalances row (e.g. entered by hand in Access) get live totals from Transactions instead of
+# disappearing, and only their transactions are added up
+materialized_balance_query = """
+    SELECT c.ClientID, c.FirstName, c.LastName, c.Phase,
+    IIf(cb.ClientID IS NULL, t.DepositSum, cb.DepositSum) AS [Sum of DepositAmount],
+    IIf(cb.ClientID IS NULL, t.WithdrawalSum, cb.WithdrawalSum) AS [Sum of WithdrawalAmount]
+    FROM (Clients AS c LEFT JOIN ClientBalances AS cb ON c.ClientID = cb.ClientID)
+    LEFT JOIN (
+        SELECT ClientID, SUM(DepositAmount) AS DepositSum, SUM(WithdrawalAmount) AS WithdrawalSum
+        FROM Transactions
+        WHERE ClientID NOT IN (SELECT ClientID FROM ClientBalances)
+        GROUP BY ClientID
+    ) AS t ON c.ClientID = t.ClientID
+"""
+
+# Number of ClientIDs sent in each ClientBalances lookup
+client_balance_chunk_size = 50
+
+# Check whether ClientBalances has been built in this database
+def has_client_balances(cursor):
+    try:
+        cursor.execute("SELECT COUNT(*) FROM ClientBalances WHERE 1 = 0")
+        cursor.fetchall()
+        return True
+    except database_errors():
+        return False
+
+# The FROM source for queries written against Balance, the materialized table when it exists
+def balance_source(cursor):
+    if has_client_balances(cursor):
+        return f"({materialized_balance_query})"
+    return "Balance"
+
+# Insert Transactions rows and add their amounts to ClientBalances, the caller commits
+def insert_transactions(cursor, transaction_rows):
+    cursor.executemany(insert_transaction_query, transaction_rows)
+
+    if has_client_balances(cursor):
+        # Total the new rows per client, the same columns as insert_transaction_query
+        deltas = {}
+        for _, _, _, deposit, withdrawal, client_id in transaction_rows:
+            totals = deltas.setdefault(client_id, [0.0, 0.0])
+            totals[0] += float(deposit or 0)
+            totals[1] += float(withdrawal or 0)
+        add_client_balance_deltas(cursor, deltas)
+
+# Add per-client (deposit, withdrawal) amounts to ClientBalances, creating rows for clients not in it yet
+def add_client_balance_deltas(cursor, deltas):
+    client_ids = list(deltas)
+    existing_ids = set()
+    for start in range(0, len(client_ids), client_balance_chunk_size):
+        chunk = client_ids[start:start + client_balance_chunk_size]
+        placeholders = ', '.join('?' for _ in chunk)
+        cursor.execute(f"SELECT ClientID FROM ClientBalances WHERE ClientID IN ({placeholders})", chunk)
+        existing_ids.update(row[0] for row in cursor.fetchall())
+
+    updates = [(deposit, withdrawal, deposit - withdrawal, client_id)
+               for client_id, (deposit, withdrawal) in deltas.items() if client_id in existing_ids]
+    inserts = [(client_id, deposit, withdrawal, deposit - withdrawal)
+               for client_id, (deposit, withdrawal) in deltas.items() if client_id not in existing_ids]
+
+    if updates:
+        cursor.executemany("""
+            UPDATE ClientBalances SET DepositSum = DepositSum + ?, WithdrawalSum = WithdrawalSum + ?,
+            NetBalance = NetBalance + ?
+            WHERE ClientID = ?
+            """, updates)
+    if inserts:
+        cursor.executemany("""
+            INSERT INTO ClientBalances (ClientID, DepositSum, WithdrawalSum, NetBalance)
+            VALUES (?, ?, ?, ?)
+            """, inserts)
+
+# Recompute every client's totals from Transactions, ClientID -> (deposit sum, withdrawal sum)
+def compute_client_balances(cursor):
+    cursor.execute("""
+        SELECT ClientID, SUM(DepositAmount), SUM(WithdrawalAmount)
+        FROM Transactions
+        GROUP BY ClientID
+        """)
+    return {client_id: (float(deposit or 0), float(withdrawal or 0))
+            for client_id, deposit, withdrawal in cursor.fetchall() if client_id is not None}
+
+# Compare ClientBalances against Transactions, returns (ClientID, stored net, computed net) for every mismatch
+def verify_client_balances(cursor, computed):
+    cursor.execute("SELECT ClientID, DepositSum, WithdrawalSum FROM ClientBalances")
+    stored = {client_id: (float(deposit or 0), float(withdrawal or 0))
+              for client_id, deposit, withdrawal in cursor.fetchall()}
+
+    mismatches = []
+    for client_id in sorted(set(stored) | set(computed)):
+        stored_deposit, stored_withdrawal = stored.get(client_id, (0.0, 0.0))
+        deposit, withdrawal = computed.get(client_id, (0.0, 0.0))
+        if round(stored_deposit, 2) != round(deposit, 2) or round(stored_withdrawal, 2) != round(withdrawal, 2):
+            mismatches.append((client_id, stored_deposit - stored_withdrawal, deposit - withdrawal))
+
+    return mismatches
+
+# Replace the contents of ClientBalances (creating it if needed) with totals recomputed from Transactions
+def rebuild_client_balances(cursor, computed):
+    if has_client_balances(cursor):
+        cursor.execute("DELETE FROM ClientBalances")
+    else:
+        cursor.execute(create_client_balances_query)
+
+    cursor.executemany("""
+        INSERT INTO ClientBalances (ClientID, DepositSum, WithdrawalSum, NetBalance)
+        VALUES (?, ?, ?, ?)
+        """, [(client_id, deposit, withdrawal, deposit - withdrawal)
+              for client_id, (deposit, withdrawal) in computed.items()])
+
+# ---------------------------
+# Batch Transaction Ingestion
+# ---------------------------
+
+# Insert statement shared by every path that writes to the Transactions table
+insert_transaction_query = """
+    INSERT INTO Transactions (TransactionID, TransactionDate, TransactionDescription,
+    DepositAmount, WithdrawalAmount, ClientID)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+# Build the key used to match spreadsheet names against Access (Access text comparisons ignore case)
+def client_name_key(first_name, last_name):
+    return str(first_name).lower(), str(last_name).lower()
+
+# Add the lower-cased name columns every planning merge joins on
+def add_name_keys(df):
+    df['first_key'] = df['FirstName'].astype(str).str.lower()
+    df['last_key'] = df['LastName'].astype(str).str.lower()
+    return df
+
+# Round an amount column so amounts read from Excel and from Access compare equal
+def amount_keys(amounts):
+    return pd.to_numeric(amounts, errors='coerce').fillna(0).astype(float).round(2)
+
+# Convert a pandas value into something pyodbc can bind (plain Python types, None for blanks)
+def db_value(value):
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    return value.item() if hasattr(value, 'item') else value
+
+# Load every client once into a DataFrame with one row per (FirstName, LastName)
+def load_clients_frame(cursor):
+    cursor.execute("SELECT ClientID, FirstName, LastName, Phase FROM Clients ORDER BY ClientID")
+    clients = pd.DataFrame.from_records([tuple(row) for row in cursor.fetchall()],
+                                        columns=['ClientID', 'FirstName', 'LastName', 'Phase'])
+    clients = add_name_keys(clients.dropna(subset=['FirstName', 'LastName']))
+
+    # Keep the first match, the same client a single-row lookup would have returned
+    return clients.drop_duplicates(subset=['first_key', 'last_key'], keep='first')
+
+# Read the day's transactions once into a frame of duplicate-check keys
+def load_existing_transactions(cursor, transaction_date):
+    cursor.execute("""
+        SELECT TransactionDescription, DepositAmount, WithdrawalAmount, ClientID
+        FROM Transactions
+        WHERE TransactionDate = ?
+    """, (transaction_date,))
+    existing = pd.DataFrame.from_records([tuple(row) for row in cursor.fetchall()],
+                                         columns=['TransactionDescription', 'DepositAmount',
+                                                  'WithdrawalAmount', 'ClientID'])
+
+    # A transaction without a client can't duplicate a spreadsheet row, and would stop the ClientID cast
+    existing = existing[existing['ClientID'].notna()]
+
+    # A row counts as a duplicate in either direction, the same as the old per-column checks
+    keys = []
+    for direction, amount_column in (('deposit', 'DepositAmount'), ('withdrawal', 'WithdrawalAmount')):
+        keys.append(pd.DataFrame({
+            'desc_key': existing['TransactionDescription'].astype(str).str.lower(),
+            'amount_key': amount_keys(existing[amount_column]),
+            'ClientID': existing['ClientID'].astype(int),
+            'direction': direction
+        }))
+
+    return pd.concat(keys, ignore_index=True).drop_duplicates()
+
+# Plan a deposits or withdrawals spreadsheet: every row gets a status of not_found, phase_4, duplicate or insert
+def plan_transactions(df, clients, existing, direction):
+    plan = add_name_keys(df[['FirstName', 'LastName', 'Type', 'Amount']].reset_index(drop=True))
+
+    # Match every row to its client in one merge
+    plan = plan.merge(clients[['first_key', 'last_key', 'ClientID', 'Phase']], how='left',
+                      on=['first_key', 'last_key'])
+    found = plan['ClientID'].notna()
+    plan['ClientID'] = plan['ClientID'].fillna(-1).astype(int)
+
+    # Clients in phase 4 don't get new transactions
+    phase_4 = found & (pd.to_numeric(plan['Phase'], errors='coerce') == 4)
+    candidate = found & ~phase_4
+
+    # A row is a duplicate if the same transaction is already in Access or earlier in this file
+    plan['desc_key'] = plan['Type'].astype(str).str.lower()
+    plan['amount_key'] = amount_keys(plan['Amount'])
+    key_columns = ['desc_key', 'amount_key', 'ClientID']
+
+    existing_keys = existing.loc[existing['direction'] == direction, key_columns].drop_duplicates()
+    in_access = plan[key_columns].merge(existing_keys, how='left', indicator=True)['_merge'].eq('both').to_numpy()
+
+    repeated = pd.Series(False, index=plan.index)
+    repeated[candidate] = plan.loc[candidate, key_columns].duplicated(keep='first')
+    duplicate = candidate & (in_access | repeated)
+
+    plan['status'] = 'insert'
+    plan.loc[duplicate, 'status'] = 'duplicate'
+    plan.loc[phase_4, 'status'] = 'phase_4'
+    plan.loc[~found, 'status'] = 'not_found'
+    return plan
+
+# Transactions rows (without TransactionID) for the planned inserts
+def planned_transaction_rows(plan, direction, transaction_date):
+    rows = []
+    for row in plan[plan['status'] == 'insert'].itertuples(index=False):
+        amount = db_value(row.Amount)
+        if direction == 'deposit':
+            deposit_amount, withdrawal_amount = amount, 0.00
+        else:
+            deposit_amount, withdrawal_amount = 0.00, amount
+
+        # TransactionID is allocated when the plan is written
+        rows.append((transaction_date, db_value(row.Type), deposit_amount, withdrawal_amount, int(row.ClientID)))
+
+    return rows
+
+# Plan an Ins N Outs sheet: admit, already_in_access, discharge, already_discharged, not_found or invalid
+def plan_ins_outs(df, clients):
+    plan = add_name_keys(df.reset_index(drop=True))
+    plan = plan.merge(clients[['first_key', 'last_key', 'ClientID', 'Phase']], how='left',
+                      on=['first_key', 'last_key'])
+    found = plan['ClientID'].notna()
+    admission = plan['Type'] == 'A'
+    discharge = plan['Type'] == 'D'
+    name_columns = ['first_key', 'last_key']
+
+    # New admissions, a name admitted twice in the file is only added the first time
+    new_admission = admission & ~found
+    new_admission[new_admission] = ~plan.loc[new_admission, name_columns].duplicated(keep='first')
+
+    # A discharge can also match a patient admitted earlier in the same file
+    admitted = plan.loc[new_admission, name_columns].assign(admission_row=plan.index[new_admission])
+    plan = plan.merge(admitted, how='left', on=name_columns)
+    admitted_earlier = ~found & plan['admission_row'].notna() & (plan['admission_row'] < plan.index)
+    plan.loc[~admitted_earlier, 'admission_row'] = None
+
+    # Patients already in phase 4, or discharged by an earlier row of the file, are not discharged again
+    discharge_found = discharge & (found | admitted_earlier)
+    phase = pd.to_numeric(plan['Phase'], errors='coerce').where(found, 1)
+    already_discharged = discharge_found & (phase == 4)
+    to_discharge = discharge_found & ~already_discharged
+    repeated = pd.Series(False, index=plan.index)
+    repeated[to_discharge] = plan.loc[to_discharge, name_columns].duplicated(keep='first')
+
+    plan['status'] = 'invalid'
+    plan.loc[admission, 'status'] = 'already_in_access'
+    plan.loc[new_admission, 'status'] = 'admit'
+    plan.loc[discharge, 'status'] = 'not_found'
+    plan.loc[discharge_found, 'status'] = 'discharge'
+    plan.loc[already_discharged | repeated, 'status'] = 'already_discharged'
+    return plan
+
+# Write a planned Ins N Outs sheet to Access, allocating the new ClientIDs and TransactionIDs
+def write_ins_outs(cursor, plan, client_ids, transaction_ids, transaction_date):
+    admissions = plan[plan['status'] == 'admit']
+    changes = plan[plan['status'].isin(['admit', 'discharge'])]
+    client_ids.reserve(len(admissions))
+    transaction_ids.reserve(len(changes))
+
+    # New patients start in phase 1, not discharged and without comments
+    new_client_ids = {row_index: client_ids.allocate() for row_index in admissions.index}
+    client_rows = [(new_client_ids[row_index], db_value(row.FirstName), db_value(row.LastName), 1, False, None,
+                    db_value(row.Contract))
+                   for row_index, row in zip(admissions.index, admissions.itertuples(index=False))]
+
+    # One transaction per admission (Beginning Balance) and per discharge (the reason), in sheet order
+    transaction_rows = []
+    discharge_ids = []
+    for row_index, row in zip(changes.index, changes.itertuples(index=False)):
+        if row.status == 'admit':
+            transaction_rows.append((transaction_ids.allocate(), transaction_date, 'Beginning Balance',
+                                     0.00, 0.00, new_client_ids[row_index]))
+        else:
+            client_id = new_client_ids[int(row.admission_row)] if pd.notna(row.admission_row) \
+                else int(row.ClientID)
+            transaction_rows.append((transaction_ids.allocate(), transaction_date,
+                                     db_value(row.ReasonForDischarge), 0.00, 0.00, client_id))
+            discharge_ids.append((client_id,))
+
+    if client_rows:
+        cursor.executemany("""
+            INSERT INTO Clients (ClientID, FirstName, LastName, Phase, Discharged, Comments, Contract)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, client_rows)
+    if transaction_rows:
+        insert_transactions(cursor, transaction_rows)
+    if discharge_ids:
+        cursor.executemany("UPDATE Clients SET Phase = 4 WHERE ClientID = ?", discharge_ids)
+
+# Messages for the user describing what happened to every row of an Ins N Outs sheet
+def ins_outs_messages(plan):
+    messages = []
+    for row in plan.itertuples(index=False):
+        first_name, last_name = row.FirstName, row.LastName
+
+        if row.status == 'admit':
+            messages += [f"{first_name} {last_name} added to Access Database.", ""]
+        elif row.status == 'already_in_access':
+            messages += [f"{first_name} {last_name} is already in Access Database.",
+                         "Check with records and manually enter the patient into Access Database.", ""]
+        elif row.status == 'discharge':
+            messages += [f"{first_name} {last_name} discharged from Access Database.", ""]
+        elif row.status == 'already_discharged':
+            messages += [f"{first_name} {last_name} has already been discharged.", ""]
+        elif row.status == 'not_found':
+            messages += [f"Client {first_name} {last_name} not found in Access Database. No discharge entry added.",
+                         ""]
+        else:
+            messages.append(f"Invalid entry type for {first_name} {last_name}")
+
+    return messages
+
+# ---------
+# Discharge
+# ---------
+
+# Number of ClientIDs sent in each UPDATE ... WHERE ClientID IN (...) statement
+discharge_chunk_size = 50
+
+# Mark clients Discharged by ClientID in chunked bulk updates, the caller commits
+def discharge_clients(cursor, client_ids, chunk_size=discharge_chunk_size):
+    for start in range(0, len(client_ids), chunk_size):
+        chunk = client_ids[start:start + chunk_size]
+        placeholders = ', '.join('?' for _ in chunk)
+        cursor.execute(f"UPDATE Clients SET Discharged = True WHERE ClientID IN ({placeholders})", chunk)
+
+    return len(client_ids)
+
+# ----------------
+# Store List Files
+# ----------------
+
+# Read the linked Store List once, in streaming mode, into an ordered (last, first) -> balance map
+def load_linked_balances(linked_file_path):
+    linked_wb = open_workbook(linked_file_path, read_only=True, data_only=True)
+
+    try:
+        linked_balances = {}
+        for row in linked_wb.active.iter_rows(min_row=2, max_col=7, values_only=True):  # Skip the header
+            linked_last_name = row[0]
+            linked_first_name = row[1] if len(row) > 1 else None
+            linked_balance = row[6] if len(row) > 6 else None  # Column G (balance) is the 7th column, index 6
+
+            # Only keep rows where both last name and first name are filled in
+            if linked_last_name is None or linked_first_name is None:
+                continue
+
+            # Names are compared without case, the first row for a name wins
+            key = (str(linked_last_name).lower(), str(linked_first_name).lower())
+            linked_balances.setdefault(key, (linked_last_name, linked_first_name, linked_balance))
+    finally:
+        linked_wb.close()
+
+    return linked_balances
+
+# Read every client's Access balance at once into a (first, last) -> balance map
+def load_balances(cursor):
+    cursor.execute(f'''
+        SELECT b.FirstName, b.LastName, b.[Sum of DepositAmount], b.[Sum of WithdrawalAmount]
+        FROM {balance_source(cursor)} AS b
+        ''')
+
+    balances = {}
+    for first_name, last_name, deposit_sum, withdrawal_sum in cursor.fetchall():
+        if first_name is None or last_name is None:
+            continue
+
+        deposit_sum = deposit_sum if deposit_sum is not None else 0
+        withdrawal_sum = withdrawal_sum if withdrawal_sum is not None else 0
+        balances.setdefault(client_name_key(first_name, last_name), float(deposit_sum - withdrawal_sum))
+
+    return balances
+
+# Work out the "Add to List" (column F) values that bring each Store List balance up to $100
+def compute_store_top_ups(rows, balances):
+    # rows holds columns A to G of each client row, starting at row 2
+    f_values = []
+    messages = []
+
+    for row in rows:
+        last_name, first_name = row[0], row[1]
+        current_add_col = row[5] if row[5] is not None else 0
+        store_balance = row[6]
+
+        # Stop at the first row without a last name
+        if last_name is None:
+            break
+
+        # Leave the row as it is unless Access has a balance for the client
+        f_values.append(row[5])
+        balance = balances.get(client_name_key(first_name, last_name))
+        if balance is None:
+            continue
+
+        store_balance = float(store_balance or 0)
+
+        # Only proceed if balance > 0 to avoid negative values being added
+        if balance > 0:
+            # Check if adding balance exceeds 100
+            if (balance + store_balance) > 100:
+                add_amount = 100 - store_balance - current_add_col
+                f_values[-1] = current_add_col + add_amount
+                messages.append(f"Added {add_amount} to {first_name} {last_name}'s store balance.")
+            else:
+                f_values[-1] = current_add_col + balance
+                messages.append(f"Added {balance} to {first_name} {last_name}'s store balance.")
+
+    return f_values, messages
+
+# The workbook open in any running Excel, or None. Matched on the full path, or on the file name when Excel
+# reports a OneDrive URL instead
+def find_open_workbook(file_path):
+    full_path = os.path.normcase(os.path.abspath(file_path))
+    file_name = os.path.basename(file_path).lower()
+    for app in xw.apps:
+        for book in app.books:
+            if book.fullname.lower().startswith('http'):
+                if book.name.lower() == file_name:
+                    return book
+            elif os.path.normcase(book.fullname) == full_path:
+                return book
+    return None
+
+# Use the workbook where staff already have it open, so what they typed but haven't saved is read and kept,
+# and only start a hidden Excel when it isn't open. An attached workbook is left open
+@contextmanager
+def excel_workbook(file_path):
+    workbook = find_open_workbook(file_path)
+    if workbook is not None:
+        yield workbook
+        return
+
+    app = xw.App(visible=False, add_book=False)  # Run Excel in the background
+    try:
+        with span('workbook', 'open'):
+            workbook = app.books.open(file_path)
+        yield workbook
+        workbook.close()
+    finally:
+        app.quit()
+
+# Top up a Store List through Excel, reading and writing whole ranges instead of single cells
+def replenish_store_list_xlwings(excel_file_path, balances):
+    with excel_workbook(excel_file_path) as workbook:
+        worksheet = workbook.sheets[0]
+
+        # Recalculate the workbook to ensure all formulas are updated
+        workbook.api.RefreshAll()  # Refresh all data connections and formulas
+        worksheet.api.Calculate()  # Recalculate worksheet formulas
+
+        # Read columns A to G of every client row as one 2D array, starting at row 2
+        last_row = worksheet.range('A1').current_region.last_cell.row
+        rows = worksheet.range(f'A2:G{last_row}').options(ndim=2).value if last_row >= 2 else []
+
+        f_values, messages = compute_store_top_ups(rows, balances)
+
+        # Write column F back in one assignment
+        if f_values:
+            worksheet.range(f'F2:F{len(f_values) + 1}').options(transpose=True).value = f_values
+
+        with span('workbook', 'save'):
+            workbook.save()
+
+    return messages
+
+# A cell value as a number for recomputing a formula, blanks and text count as 0
+def cell_number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return 0.0
+    return float(value)
+
+# Top up a Store List without Excel, so it can run headless
+def replenish_store_list_openpyxl(excel_file_path, balances):
+    # Read the values Excel last calculated
+    values_wb = open_workbook(excel_file_path, read_only=True, data_only=True)
+    try:
+        # Client rows end at the first row without a last name, the totals and "Left" list follow
+        rows = []
+        for row in values_wb.active.iter_rows(min_row=2, max_col=7, values_only=True):
+            if row[0] is None:
+                break
+            rows.append(list(row) + [None] * (7 - len(row)))
+    finally:
+        values_wb.close()
+
+    # Work out the Balance column (=C-D-E+F) where Excel never calculated it
+    for row in rows:
+        if row[6] is None:
+            row[6] = cell_number(row[2]) - cell_number(row[3]) - cell_number(row[4]) + cell_number(row[5])
+
+    f_values, messages = compute_store_top_ups(rows, balances)
+
+    # Write column F into the workbook with its formulas intact
+    workbook = open_workbook(excel_file_path)
+    worksheet = workbook.active
+    for row_number, value in enumerate(f_values, start=2):
+        worksheet[f'F{row_number}'] = value
+    save_workbook(workbook, excel_file_path)
+
+    return messages
+
+# Work out the "Added to Store Balance" (column G) values that bring each New Store List balance up to $100
+def compute_new_store_top_ups(rows, balances):
+    # rows holds columns A to H of each patient row, starting at row 4
+    g_values = []
+    messages = []
+
+    for row in rows:
+        last_name, first_name = row[0], row[1]
+
+        # Stop at the first row without a name
+        if not first_name and not last_name:
+            break
+
+        current_add_column = float(row[6] or 0)  # Default to 0 if the "Added" column is empty
+        current_final_balance = float(row[7] or 0)
+
+        # Leave the row as it is unless Access has a balance for the client
+        g_values.append(row[6])
+        access_balance = balances.get(client_name_key(first_name, last_name))
+        if access_balance is None:
+            print(f"No data found for {first_name} {last_name} in the database.")
+            continue
+
+        if access_balance > 0.00:
+            if (current_add_column + current_final_balance + access_balance) <= 100:
+                amount_to_add = current_add_column + access_balance
+            else:
+                amount_to_add = current_add_column + (100 - current_final_balance)
+                if amount_to_add < 0:
+                    continue
+
+            g_values[-1] = amount_to_add
+            messages.append(f"Added ${amount_to_add} to {first_name} {last_name}'s account.")
+
+    return g_values, messages
+
+# Top up a New Store List through Excel with one range read and one range write
+def replenish_new_store_list_xlwings(store_file_path, balances):
+    with excel_workbook(store_file_path) as workbook:
+        worksheet = workbook.sheets[0]
+
+        # Recalculate the workbook to ensure all formulas are updated
+        workbook.api.RefreshAll()  # Refresh all data connections and formulas
+        worksheet.api.Calculate()  # Recalculate worksheet formulas
+
+        # Read columns A to H of every patient row as one 2D array, starting at row 4
+        last_row = worksheet.used_range.last_cell.row
+        rows = worksheet.range(f'A4:H{last_row}').options(ndim=2).value if last_row >= 4 else []
+
+        g_values, messages = compute_new_store_top_ups(rows, balances)
+
+        # Write column G back in one assignment
+        if g_values:
+            worksheet.range(f'G4:G{len(g_values) + 3}').options(transpose=True).value = g_values
+
+        with span('workbook', 'save'):
+            workbook.save()
+
+    return messages
+
+# Top up a New Store List without Excel, so it can run headless
+def replenish_new_store_list_openpyxl(store_file_path, balances):
+    # Read the values Excel last calculated
+    values_wb = open_workbook(store_file_path, read_only=True, data_only=True)
+    try:
+        # Patient rows end at the first row without a name
+        rows = []
+        for row in values_wb.worksheets[0].iter_rows(min_row=4, max_col=8, values_only=True):
+            if not row[0] and not row[1]:
+                break
+            rows.append(list(row) + [None] * (8 - len(row)))
+    finally:
+        values_wb.close()
+
+    # Work out the Final Balance column (=C-E-F+G) where Excel never calculated it
+    for row in rows:
+        if row[7] is None:
+            row[7] = cell_number(row[2]) - cell_number(row[4]) - cell_number(row[5]) + cell_number(row[6])
+
+    g_values, messages = compute_new_store_top_ups(rows, balances)
+
+    # Write column G into the workbook with its formulas intact
+    workbook = open_workbook(store_file_path)
+    worksheet = workbook.worksheets[0]
+    for row_number, value in enumerate(g_values, start=4):
+        worksheet[f'G{row_number}'] = value
+    save_workbook(workbook, store_file_path)
+
+    return messages
+
+# Read a Quarters sheet once, in streaming mode, into a (last, first) -> amount map (a repeated name keeps its last amount)
+def load_quarters(quarters_file_path):
+    quarters_wb = open_workbook(quarters_file_path, read_only=True, data_only=True)
+
+    try:
+        quarters = {}
+        for quarter_row in quarters_wb.active.iter_rows(min_row=2, max_col=3, values_only=True):
+            q_last_name, q_first_name, q_amount = (tuple(quarter_row) + (None, None, None))[:3]
+
+            # Skip empty rows
+            if q_last_name is None and q_first_name is None:
+                continue
+            quarters[(q_last_name, q_first_name)] = q_amount
+    finally:
+        quarters_wb.close()
+
+    return quarters
+
+# Read a New Store List's final balances (column H) in streaming mode into a (last, first) -> balance map.
+# H is a formula, so a file Excel never recalculated has no cached value and it is recomputed as C-E-F+G
+def load_previous_final_balances(previous_file_path):
+    previous_wb = open_workbook(previous_file_path, read_only=True, data_only=True)
+
+    try:
+        previous_data = {}
+        for row in previous_wb.worksheets[0].iter_rows(min_row=4, max_col=8, values_only=True):
+            row = tuple(row) + (None,) * (8 - len(row))
+            prev_last_name, prev_first_name = row[0], row[1]
+
+            # Only rows with both names are patients
+            if not (prev_last_name and prev_first_name):
+                continue
+
+            final_balance = row[7]
+            if final_balance is None:
+                final_balance = cell_number(row[2]) - cell_number(row[4]) - cell_number(row[5]) + cell_number(row[6])
+            previous_data[(prev_last_name, prev_first_name)] = final_balance
+    finally:
+        previous_wb.close()
+
+    return previous_data
+
+# Read the (LastName, FirstName) of every patient on a New Store List, starting at row 4
+def read_store_list_names(store_list_file):
+    store_wb = open_workbook(store_list_file, read_only=True, data_only=True)
+
+    try:
+        store_names = []
+        for store_last_name, store_first_name in store_wb.worksheets[0].iter_rows(min_row=4, max_col=2,
+                                                                                  values_only=True):
+            # Stop if both first and last names are None
+            if store_last_name is None and store_first_name is None:
+                break
+            store_names.append((store_last_name, store_first_name))
+    finally:
+        store_wb.close()
+
+    return store_names
+
+# Total the "Added to Store Balance" column (G) per patient across the given days' New Store Lists
+def build_weekly_added_ledger(dates):
+    weekly_added = {}
+
+    for day in dates:
+        date_str = day.strftime('%m-%d-%y')
+        store_file_path = os.path.join(new_store_folder_path, f'Store List_{date_str}.xlsx')
+
+        # Skip days without a store list
+        if not os.path.exists(store_file_path):
+            continue
+
+        try:
+            past_wb = open_workbook(store_file_path, read_only=True, data_only=True)
+        except Exception as e:
+            # Continue to the next file if there are issues opening this one
+            print(f"Error accessing file {store_file_path}: {e}")
+            continue
+
+        try:
+            # Only the first row for each patient counts in a day's list
+            seen_names = set()
+            for row in past_wb.worksheets[0].iter_rows(min_row=4, max_col=7, values_only=True):
+                past_last_name = row[0]
+                past_first_name = row[1] if len(row) > 1 else None
+                added_value = row[6] if len(row) > 6 else None
+
+                name = (past_last_name, past_first_name)
+                if past_last_name is None or name in seen_names:
+                    continue
+                seen_names.add(name)
+
+                if added_value is not None:
+                    weekly_added[name] = weekly_added.get(name, 0) + added_value
+        finally:
+            past_wb.close()
+
+    return weekly_added
+
+# ---------
+# Reporters
+# ---------
+
+# Where operations send their messages: the results box in the window, or the console when run from the
+# command line. Subclasses provide append(), setText() and clear(). Handlers call error() instead of setText()
+# for messages that mean the operation failed.
+class Reporter:
+    failed = False
+
+    def error(self, text):
+        self.failed = True
+        self.setText(text)
+
+# Collects an operation's messages for the command line, printing them as they arrive unless told not to
+class CommandLineReporter(Reporter):
+    def __init__(self, echo=True):
+        self.echo = echo
+        self.messages = []
+
+    def append(self, text):
+        self.messages.append(text)
+        if self.echo:
+            print(text)
+
+    def setText(self, text):
+        # The console can't be cleared, the new text is printed after the old and kept with it, so a command
+        # that runs several operations reports all of them
+        self.append(text)
+
+    def clear(self):
+        # Nothing is dropped, like the console
+        pass
+
+# ---------------
+# Background Jobs
+# ---------------
+
+# Cancel flag of the job running on the current worker thread
+current_job = threading.local()
+
+# Raised at a checkpoint when the user cancels the running job. It is a BaseException so the
+# operations' own `except Exception` handlers let it through and their `finally` blocks still clean up.
+class JobCancelled(BaseException):
+    pass
+
+# Called by operations between stages, stops the job if the user pressed Cancel
+def check_cancelled():
+    cancel_event = getattr(current_job, 'cancel_event', None)
+    if cancel_event is not None and cancel_event.is_set():
+        raise JobCancelled()
+
 # -----------------
 # Main Window Class
 # -----------------
 
-class MainWindow(QMainWindow):
-    def __init__(self):
-        super().__init__()
+# The window and its background jobs are built on PyQt5, which is only imported when the window is opened so the
+# command line also runs on servers without it. Returns the MainWindow class
+def load_main_window():
+    import_deferred('PyQt5.QtWidgets')  # Timed for the startup profile
+    from PyQt5.QtWidgets import (QMainWindow,
+                                 QPushButton, QVBoxLayout,
+                                 QHBoxLayout, QTextEdit,
+                                 QLabel, QWidget, QGroupBox)
+    from PyQt5.QtCore import Qt, QObject, QRunnable, QThreadPool, pyqtSignal
+
+    # Thread-safe stand-in for the results text box, operations on worker threads write to it through signals
+    class ResultBox(QObject, Reporter):
+        appended = pyqtSignal(str)
+        text_set = pyqtSignal(str)
+        cleared = pyqtSignal()
+
+        def __init__(self, text_edit):
+            super().__init__()
+            self.appended.connect(text_edit.append)
+            self.text_set.connect(text_edit.setText)
+            self.cleared.connect(text_edit.clear)
+
+        def append(self, text):
+            self.appended.emit(text)
+
+        def setText(self, text):
+            self.text_set.emit(text)
+
+        def clear(self):
+            self.cleared.emit()
+
+    # Signals a job sends back to the GUI thread
+    class JobSignals(QObject):
+        finished = pyqtSignal(str, bool, str)  # Job name, whether it was cancelled, timing summary
+
+    # Runs one MainWindow operation on a pool thread
+    class Job(QRunnable):
+        def __init__(self, name, operation, resources):
+            super().__init__()
+            self.name = name
+            self.operation = operation
+            self.resources = resources
+            self.cancel_event = threading.Event()
+            self.signals = JobSignals()
+
+        def run(self):
+            # Excel automation through xlwings needs COM initialised on every thread that uses it
+            try:
+                import pythoncom
+                pythoncom.CoInitialize()
+            except ImportError:
+                pythoncom = None
+
+            current_job.cancel_event = self.cancel_event
+            cancelled = False
+
+            # Time the operation's Access, Comcash and workbook calls
+            spans = begin_spans(self.name)
+            status = 'ok'
+
+            try:
+                self.operation()
+            except JobCancelled:
+                cancelled = True
+                status = 'cancelled'
+            except Exception as e:
+                status = 'failed'
+                print(f"Job {self.name} failed: {e}")
+            finally:
+                end_spans(spans, status)
+                current_job.cancel_event = None
+                if pythoncom:
+                    pythoncom.CoUninitialize()
+                self.signals.finished.emit(self.name, cancelled, spans.summary())
+
+    # Starts operations off the GUI thread and keeps jobs that use the same files or database from overlapping
+    class JobRunner(QObject):
+        jobs_changed = pyqtSignal()
+
+        def __init__(self, result_box):
+            super().__init__()
+            self.result_box = result_box
+            self.pool = QThreadPool()
+
+            # Keep idle pool threads, and the database connections they hold, alive between jobs
+            self.pool.setExpiryTimeout(-1)
+            self.running = {}
+
+        def start(self, name, operation, resources):
+            # Refuse to start a job that would write to something another job is using
+            for running_job in self.running.values():
+                if running_job.name == name or running_job.resources & resources:
+                    self.result_box.append(f"\"{name}\" can't start while \"{running_job.name}\" is running.")
+                    return False
+
+            job = Job(name, operation, resources)
+            job.signals.finished.connect(self.job_finished)
+            self.running[name] = job
+            self.pool.start(job)
+            self.jobs_changed.emit()
+            return True
+
+        def job_finished(self, name, cancelled, summary):
+            self.running.pop(name, None)
+            if cancelled:
+                self.result_box.append(f"\"{name}\" was cancelled.")
+
+            # Where the time went
+            self.result_box.append("")
+            self.result_box.append(summary)
+            self.jobs_changed.emit()
 
-        # Set up the main window
-        self.setWindowTitle("Client Trust Management")
-        self.setGeometry(200, 200, 600, 400)
+        def cancel_all(self):
+            for job in self.running.values():
+                job.cancel_event.set()
 
-        # Main layout
-        main_layout = QVBoxLayout()
+        def running_names(self):
+            return list(self.running)
 
-        # Horizontal layout to hold the groups
-        button_layout = QHBoxLayout()
+    class MainWindow(QMainWindow):
+        def __init__(self):
+            super().__init__()
 
-        # 1. Organization and Deposits Group
-        org_deposits_group = QGroupBox("Organization and Deposits")
-        org_deposits_group.setAlignment(Qt.AlignCenter)
-        org_deposits_layout = QVBoxLayout()
+            # Text box for displaying results, operations write to it through a thread-safe ResultBox
+            self.result_text = QTextEdit()
+            self.result_text.setReadOnly(True)
+            self.result_box = ResultBox(self.result_text)
 
-        self.ins_and_outs_button = QPushButton("Add Ins && Outs to Access")
-        self.ins_and_outs_button.clicked.connect(self.add_ins_outs)
-        org_deposits_layout.addWidget(self.ins_and_outs_button)
+            # Runs the button operations in the background
+            self.job_runner = JobRunner(self.result_box)
 
-        self.generate_deposit_sheet_button = QPushButton("Generate New Deposits Sheet")
-        self.generate_deposit_sheet_button.clicked.connect(self.generate_deposits_sheet)
-        org_deposits_layout.addWidget(self.generate_deposit_sheet_button)
+            # Database connections stay open between operations
+            self.db = ConnectionManager(storage_backend)
 
-        org_deposits_group.setLayout(org_deposits_layout)
-        button_layout.addWidget(org_deposits_group)
+            # The operations the buttons run
+            self.operations = ClientTrustOperations(self.result_box, self.db)
 
-        # 2. Store List Group
-        store_list_group = QGroupBox("Store List")
-        store_list_group.setAlignment(Qt.AlignCenter)
-        store_list_layout = QVBoxLayout()
+            # Set up the main window
+            self.setWindowTitle("Client Trust Management")
+            self.setGeometry(200, 200, 600, 400)
 
-        self.add_new_patients_button = QPushButton("Add New/Dephased Patients to Comcash")
-        self.add_new_patients_button.clicked.connect(self.new_patients_to_comcash)
-        store_list_layout.addWidget(self.add_new_patients_button)
+            # Main layout
+            main_layout = QVBoxLayout()
 
-        self.remove_patients_comcash_button = QPushButton("Delete Discharged/2nd Phase Patients from Comcash")
-        self.remove_patients_comcash_button.clicked.connect(self.delete_patients_from_comcash)
-        store_list_layout.addWidget(self.remove_patients_comcash_button)
+            # Horizontal layout to hold the groups
+            button_layout = QHBoxLayout()
 
-        self.store_list_button = QPushButton("Generate Today's Store List")
-        self.store_list_button.clicked.connect(self.generate_store_list)
-        store_list_layout.addWidget(self.store_list_button)
+            # 1. Organization and Deposits Group
+            org_deposits_group = QGroupBox("Organization and Deposits")
+            org_deposits_group.setAlignment(Qt.AlignCenter)
+            org_deposits_layout = QVBoxLayout()
 
-        self.replenish_books_thurs_button = QPushButton("Store Balances to $100")
-        self.replenish_books_thurs_button.clicked.connect(self.replenish_store_balances_thurs)
-        store_list_layout.addWidget(self.replenish_books_thurs_button)
+            self.ins_and_outs_button = QPushButton("Add Ins && Outs to Access")
+            self.connect_job(self.ins_and_outs_button, "Add Ins & Outs to Access", self.operations.add_ins_outs, {'access'})
+            org_deposits_layout.addWidget(self.ins_and_outs_button)
 
-        self.new_store_list_button = QPushButton("Generate New Store List")
-        self.new_store_list_button.clicked.connect(self.generate_new_store_list)
-        store_list_layout.addWidget(self.new_store_list_button)
+            self.generate_deposit_sheet_button = QPushButton("Generate New Deposits Sheet")
+            self.connect_job(self.generate_deposit_sheet_button, "Generate New Deposits Sheet", self.operations.generate_deposits_sheet, {'deposits_sheet'})
+            org_deposits_layout.addWidget(self.generate_deposit_sheet_button)
 
-        self.add_deposits_to_store_button = QPushButton("Add Daily Deposits to New Store List")
-        self.add_deposits_to_store_button.clicked.connect(self.add_daily_deposits_to_store_list)
-        store_list_layout.addWidget(self.add_deposits_to_store_button)
+            org_deposits_group.setLayout(org_deposits_layout)
+            button_layout.addWidget(org_deposits_group)
 
-        self.replenish_balances_store_button = QPushButton("Replenish Store Balances to $100")
-        self.replenish_balances_store_button.clicked.connect(self.replenish_new_store_balances)
-        store_list_layout.addWidget(self.replenish_balances_store_button)
+            # 2. Store List Group
+            store_list_group = QGroupBox("Store List")
+            store_list_group.setAlignment(Qt.AlignCenter)
+            store_list_layout = QVBoxLayout()
 
-        store_list_group.setLayout(store_list_layout)
-        button_layout.addWidget(store_list_group)
+            self.add_new_patients_button = QPushButton("Add New/Dephased Patients to Comcash")
+            self.connect_job(self.add_new_patients_button, "Add New/Dephased Patients to Comcash", self.operations.new_patients_to_comcash, {'comcash'})
+            store_list_layout.addWidget(self.add_new_patients_button)
 
-        # 3. Balancing the Client Trust Database Group
-        balance_group = QGroupBox("Balancing Client Trust")
-        balance_group.setAlignment(Qt.AlignCenter)
-        balance_layout = QVBoxLayout()
+            self.remove_patients_comcash_button = QPushButton("Delete Discharged/2nd Phase Patients from Comcash")
+            self.connect_job(self.remove_patients_comcash_button, "Delete Discharged/2nd Phase Patients from Comcash", self.operations.delete_patients_from_comcash, {'comcash'})
+            store_list_layout.addWidget(self.remove_patients_comcash_button)
 
-        self.generate_withdrawal_sheet_button = QPushButton("Generate New Withdrawals Sheet")
-        self.generate_withdrawal_sheet_button.clicked.connect(self.generate_withdrawals_sheet)
-        balance_layout.addWidget(self.generate_withdrawal_sheet_button)
+            self.store_list_button = QPushButton("Generate Today's Store List")
+            self.connect_job(self.store_list_button, "Generate Today's Store List", self.operations.generate_store_list, {'store_list'})
+            store_list_layout.addWidget(self.store_list_button)
 
-        self.deposit_button = QPushButton("Add Deposits to Access")
-        self.deposit_button.clicked.connect(self.add_deposits)
-        balance_layout.addWidget(self.deposit_button)
+            self.replenish_books_thurs_button = QPushButton("Store Balances to $100")
+            self.connect_job(self.replenish_books_thurs_button, "Store Balances to $100", self.operations.replenish_store_balances_thurs, {'store_list'})
+            store_list_layout.addWidget(self.replenish_books_thurs_button)
 
-        self.withdrawal_button = QPushButton("Add Withdrawals to Access")
-        self.withdrawal_button.clicked.connect(self.add_withdrawals)
-        balance_layout.addWidget(self.withdrawal_button)
+            self.new_store_list_button = QPushButton("Generate New Store List")
+            self.connect_job(self.new_store_list_button, "Generate New Store List", self.operations.generate_new_store_list, {'new_store_list'})
+            store_list_layout.addWidget(self.new_store_list_button)
 
-        self.discharge_button = QPushButton("Discharge $0.00 Balances")
-        self.discharge_button.clicked.connect(self.discharge_patients)
-        balance_layout.addWidget(self.discharge_button)
+            self.add_deposits_to_store_button = QPushButton("Add Daily Deposits to New Store List")
+            self.connect_job(self.add_deposits_to_store_button, "Add Daily Deposits to New Store List", self.operations.add_daily_deposits_to_store_list, {'new_store_list'})
+            store_list_layout.addWidget(self.add_deposits_to_store_button)
 
-        balance_group.setLayout(balance_layout)
-        button_layout.addWidget(balance_group)
+            self.replenish_balances_store_button = QPushButton("Replenish Store Balances to $100")
+            self.connect_job(self.replenish_balances_store_button, "Replenish Store Balances to $100", self.operations.replenish_new_store_balances, {'new_store_list'})
+            store_list_layout.addWidget(self.replenish_balances_store_button)
 
-        # Add the horizontal layout to the main layout
-        main_layout.addLayout(button_layout)
+            self.sync_sales_button = QPushButton("Sync Comcash Sales")
+            self.connect_job(self.sync_sales_button, "Sync Comcash Sales", self.operations.sync_comcash_sales, {'comcash'})
+            store_list_layout.addWidget(self.sync_sales_button)
 
-        # Text box for displaying results
-        self.result_box = QTextEdit()
-        self.result_box.setReadOnly(True)
-        main_layout.addWidget(self.result_box)
+            store_list_group.setLayout(store_list_layout)
+            button_layout.addWidget(store_list_group)
 
-        # Container widget
-        container = QWidget()
-        container.setLayout(main_layout)
+            # 3. Balancing the Client Trust Database Group
+            balance_group = QGroupBox("Balancing Client Trust")
+            balance_group.setAlignment(Qt.AlignCenter)
+            balance_layout = QVBoxLayout()
 
-        # Set the central widget to the container
-        self.setCentralWidget(container)
+            self.generate_withdrawal_sheet_button = QPushButton("Generate New Withdrawals Sheet")
+            self.connect_job(self.generate_withdrawal_sheet_button, "Generate New Withdrawals Sheet", self.operations.generate_withdrawals_sheet, {'withdrawals_sheet'})
+            balance_layout.addWidget(self.generate_withdrawal_sheet_button)
+
+            self.deposit_button = QPushButton("Add Deposits to Access")
+            self.connect_job(self.deposit_button, "Add Deposits to Access", self.operations.add_deposits, {'access'})
+            balance_layout.addWidget(self.deposit_button)
+
+            self.withdrawal_button = QPushButton("Add Withdrawals to Access")
+            self.connect_job(self.withdrawal_button, "Add Withdrawals to Access", self.operations.add_withdrawals, {'access'})
+            balance_layout.addWidget(self.withdrawal_button)
+
+            self.discharge_button = QPushButton("Discharge $0.00 Balances")
+            self.connect_job(self.discharge_button, "Discharge $0.00 Balances", self.operations.discharge_patients, {'access'})
+            balance_layout.addWidget(self.discharge_button)
+
+            self.verify_balances_button = QPushButton("Verify/Rebuild Client Balances")
+            self.connect_job(self.verify_balances_button, "Verify/Rebuild Client Balances", self.operations.verify_client_balances, {'access'})
+            balance_layout.addWidget(self.verify_balances_button)
+
+            balance_group.setLayout(balance_layout)
+            button_layout.addWidget(balance_group)
+
+            # Add the horizontal layout to the main layout
+            main_layout.addLayout(button_layout)
+
+            # Running job status and cancel button
+            status_layout = QHBoxLayout()
+            self.job_status_label = QLabel("Ready.")
+            status_layout.addWidget(self.job_status_label)
+
+            self.cancel_button = QPushButton("Cancel")
+            self.cancel_button.setEnabled(False)
+            self.cancel_button.clicked.connect(self.job_runner.cancel_all)
+            status_layout.addWidget(self.cancel_button)
+
+            main_layout.addLayout(status_layout)
+            self.job_runner.jobs_changed.connect(self.update_job_status)
+
+            # Add the results text box
+            main_layout.addWidget(self.result_text)
+
+            # Container widget
+            container = QWidget()
+            container.setLayout(main_layout)
+
+            # Set the central widget to the container
+            self.setCentralWidget(container)
+
+        def connect_job(self, button, name, operation, resources):
+            # Run the operation as a background job when the button is clicked
+            button.clicked.connect(lambda checked=False: self.job_runner.start(name, operation, resources))
+
+        def update_job_status(self):
+            # Show which jobs are running and only allow Cancel while something is
+            running = self.job_runner.running_names()
+            if running:
+                self.job_status_label.setText(f"Running: {', '.join(running)}")
+            else:
+                self.job_status_label.setText("Ready.")
+            self.cancel_button.setEnabled(bool(running))
+
+        def closeEvent(self, event):
+            # Stop any running jobs before the window closes
+            self.job_runner.cancel_all()
+            self.job_runner.pool.waitForDone()
+
+            # Report where the Access time went this session
+            for line in self.db.timing_summary():
+                print(line)
+            self.db.close_all()
+            sales_store.close()
+            super().closeEvent(event)
+
+    return MainWindow
+
+# ----------
+# Operations
+# ----------
+
+# The workflows behind the buttons, kept apart from the window so they can also run from the command line.
+# Every message goes to the reporter and every database call through the connection manager.
+class ClientTrustOperations:
+    def __init__(self, result_box, db):
+        self.result_box = result_box
+        self.db = db
 
     def discharge_patients(self):
         # Default connection
         connection = None
         try:
             # Establish the connection
-            connection = pyodbc.connect(connection_string)
+            connection = self.db.acquire()
 
             # Create a cursor object using the connection
             cursor = connection.cursor()
+
+            # Let Access total the transactions of the phase 4 clients that are not discharged yet, straight
+            # from Transactions by ClientID so two clients with the same name keep their own balances
             query = '''
-                SELECT FirstName, LastName, Phase, [Sum Of DepositAmount], [Sum Of WithdrawalAmount]
-                FROM Balance
+                SELECT c.ClientID, c.FirstName, c.LastName, c.Phase,
+                SUM(t.DepositAmount), SUM(t.WithdrawalAmount)
+                FROM Clients AS c LEFT JOIN Transactions AS t ON t.ClientID = c.ClientID
+                WHERE c.Phase = '4' AND c.Discharged = False
+                GROUP BY c.ClientID, c.FirstName, c.LastName, c.Phase
                 '''
             cursor.execute(query)
             rows = cursor.fetchall()
@@ -196,192 +1833,107 @@ class MainWindow(QMainWindow):
             # Clear previous results
             self.result_box.clear()
 
-            # Keep count of discharged patients
-            patient_discharge_count = 0
-
-            # Iterate over the rows and print them
-            for row in rows:
-                # Get name
-                first_name = row[0]
-                last_name = row[1]
-
-                # Get phase
-                phase = int(row[2])
+            # Keep the phase 4 clients whose balance is 0.00
+            discharge_ids = []
+            for client_id, first_name, last_name, phase, deposit, withdrawal in rows:
+                balance = float(deposit or 0) - float(withdrawal or 0)
 
-                # Get deposits and withdrawals
-                deposit = float(row[3])
-                withdrawal = float(row[4])
-
-                # Calculate balance
-                balance = deposit - withdrawal
-
-                # Mark Discharged if patient is phase 4 and balance = 0.00
-                if phase == 4 and balance == 0.0000:
+                if round(balance, 2) == 0:
                     self.result_box.append(f"Discharging: {last_name}, {first_name}, "
                                            f"Phase: {phase}, Balance: {balance}")
-                    update_query = '''
-                        UPDATE Clients
-                        SET Discharged = True
-                        WHERE FirstName = ? AND LastName = ?
-                    '''
-                    cursor.execute(update_query, (first_name, last_name))
-                    connection.commit()
-                    patient_discharge_count = patient_discharge_count + 1
+                    discharge_ids.append(client_id)
+
+            check_cancelled()
+
+            # Mark them all Discharged in chunked updates under a single commit
+            patient_discharge_count = discharge_clients(cursor, discharge_ids)
+            connection.commit()
 
             # If no patients were discharge, print message for the user
             if patient_discharge_count == 0:
                 self.result_box.append(f"No patients met the discharge criteria.")
+            else:
+                self.result_box.append("")
+                self.result_box.append(f"Discharged {patient_discharge_count} of {len(rows)} phase 4 patients. "
+                                       f"{len(rows) - patient_discharge_count} still have a balance.")
 
         # Print error if found
-        except pyodbc.Error as e:
-            self.result_box.setText(f"Error: {e}")
+        except database_errors() as e:
+            if connection:
+                connection.rollback()
+            self.result_box.error(f"Error: {e}")
         except Exception as e:
-            self.result_box.setText(f"Unexpected error: {e}")
+            self.result_box.error(f"Unexpected error: {e}")
         finally:
             if connection:
-                connection.close()
+                self.db.release(connection)
 
-    def add_deposits(self):
-        # Path to Excel file
-        excel_path = auto_deposits_path
-
-        # Load the Excel file into a pandas DataFrame
-        df = pd.read_excel(excel_path)
+    def verify_client_balances(self):
+        # Default connection
         connection = None
 
         try:
-            # Establish the connection to Access Database
-            connection = pyodbc.connect(connection_string)
-
-            # Create a cursor object using the Access connection
+            connection = self.db.acquire()
             cursor = connection.cursor()
 
             # Clear previous results
             self.result_box.clear()
 
-            # Iterate over each row in the Excel Dataframe
-            for index, row in df.iterrows():
-                excel_first_name = row['FirstName']
-                excel_last_name = row['LastName']
-                excel_type = row['Type']
-                excel_amount = row['Amount']
-
-                # Query the Access database for the client
-                query = """
-                                SELECT ClientID, FirstName, LastName, Phase
-                                FROM Clients
-                                WHERE FirstName = ? AND LastName = ?
-                            """
-
-                cursor.execute(query, (excel_first_name, excel_last_name))
-                client = cursor.fetchone()
-
-                # Check if the client exists
-                if not client:
-                    # If no client is found, print a message
-                    self.result_box.append(
-                        f"{excel_first_name} {excel_last_name} not found in Access. Deposit was not added.")
-                    self.result_box.append("")
-                    continue
-
-                client_id, first_name, last_name, phase = client
-
-                # Check if the client's phase is 4
-                if phase == 4:
-                    # If phase is 4, print a message and skip the deposit
-                    self.result_box.append(
-                        f"{excel_first_name} {excel_last_name} found in Access, but Phase: 4. Deposit was not added.")
-                    self.result_box.append("")
-                    continue
-
-                # Query the Access database
-                query = """
-                    SELECT ClientID, FirstName, LastName
-                    FROM Clients
-                    WHERE FirstName = ? AND LastName = ?
-                """
-
-                cursor.execute(query, (excel_first_name, excel_last_name))
-                client = cursor.fetchone()
-
-                if client:
-                    client_id = client[0]
-
-                    # Get today's date for the transaction
-                    today_date = datetime.today().strftime('%m/%d/%Y')
-
-                    # Check if a matching transaction already exists
-                    check_query = """
-                    SELECT TransactionID
-                    FROM Transactions
-                    WHERE TransactionDate = ? AND TransactionDescription = ? 
-                    AND DepositAmount = ? AND ClientID = ?
-                    """
-                    cursor.execute(check_query, (today_date, excel_type, excel_amount, client_id))
-                    existing_transaction = cursor.fetchone()
-
-                    if existing_transaction:
-                        # If transaction already exists, print message
-                        self.result_box.append(
-                            f"Transaction already exists for {excel_first_name} {excel_last_name} "
-                            f"with the amount {excel_amount} on {today_date}.")
-                        self.result_box.append("")
-                    else:
-                        # Get the highest current transaction number from the Transactions table
-                        max_transaction_query = "SELECT MAX(TransactionID) FROM Transactions"
-                        cursor.execute(max_transaction_query)
-                        max_transaction = cursor.fetchone()[0]  # Fetch the current maximum
-
-                        # Create the new transaction number by adding 1
-                        new_transaction_number = max_transaction + 1
-
-                        # Get today's date for the transaction
-                        today_date = datetime.today().strftime('%m/%d/%Y')
-
-                        # Insert the new transaction entry
-                        insert_query = """
-                                        INSERT INTO Transactions (TransactionID, TransactionDate, 
-                                        TransactionDescription, DepositAmount, WithdrawalAmount, ClientID)
-                                        VALUES (?, ?, ?, ?, ?, ?)
-                                    """
+            # Recompute every client's totals from the full Transactions history
+            computed = compute_client_balances(cursor)
 
-                        deposit_amount = excel_amount
-                        withdrawal_amount = 0.00
+            check_cancelled()
 
-                        cursor.execute(insert_query, (new_transaction_number, today_date,
-                                                      excel_type, deposit_amount, withdrawal_amount, client_id))
-
-                        self.result_box.append(
-                            f"Deposited: {deposit_amount} to {excel_first_name} "
-                            f"{excel_last_name}'s account on {today_date}.")
-                        self.result_box.append("")
-
-                        # Commit the transaction
-                        connection.commit()
+            if not has_client_balances(cursor):
+                self.result_box.append("ClientBalances does not exist yet. Building it from Transactions.")
+            else:
+                mismatches = verify_client_balances(cursor, computed)
+                if not mismatches:
+                    self.result_box.append(f"ClientBalances matches Transactions for all {len(computed)} clients.")
+                    return
 
-        except FileNotFoundError:
-            self.result_box.setText("Deposits Excel file not found.")
+                # Show what was out of step before rebuilding
+                for client_id, stored_balance, balance in mismatches:
+                    self.result_box.append(f"ClientID {client_id}: stored {stored_balance:.2f}, "
+                                           f"Transactions {balance:.2f}")
+                self.result_box.append(f"{len(mismatches)} clients did not match. Rebuilding ClientBalances.")
 
-        except pyodbc.Error as e:
-            self.result_box.setText(f"Error: {e}")
+            rebuild_client_balances(cursor, computed)
+            connection.commit()
+            self.result_box.append(f"ClientBalances rebuilt for {len(computed)} clients.")
 
+        except database_errors() as e:
+            if connection:
+                connection.rollback()
+            self.result_box.error(f"Error: {e}")
         except Exception as e:
-            self.result_box.setText(f"Unexpected error: {e}")
-
+            self.result_box.error(f"Unexpected error: {e}")
         finally:
             if connection:
-                connection.close()
+                self.db.release(connection)
+
+    def add_deposits(self):
+        self.ingest_transactions(auto_deposits_path, 'deposit')
 
     def add_withdrawals(self):
-        # Path to Excel file
-        excel_path = auto_withdrawals_path
+        self.ingest_transactions(auto_withdrawals_path, 'withdrawal')
+
+    def ingest_transactions(self, excel_path, direction):
+        # Wording used in the messages for each direction
+        if direction == 'deposit':
+            label, file_label = "Deposit", "Deposits"
+        else:
+            label, file_label = "Withdrawal", "Withdrawal"
+
+        # Default connection
         connection = None
+
         try:
             # Load the Excel file into a pandas DataFrame
-            df = pd.read_excel(excel_path)
+            df = read_excel(excel_path)
 
             # Establish the connection to Access Database
-            connection = pyodbc.connect(connection_string)
+            connection = self.db.acquire()
 
             # Create a cursor object using the Access connection
             cursor = connection.cursor()
@@ -389,101 +1941,73 @@ class MainWindow(QMainWindow):
             # Clear previous results
             self.result_box.clear()
 
-            # Iterate over each row in the Excel Dataframe
-            for index, row in df.iterrows():
-                excel_first_name = row['FirstName']
-                excel_last_name = row['LastName']
-                excel_type = row['Type']
-                excel_amount = row['Amount']
-
-                # Query the Access database for the client
-                query = """
-                                SELECT ClientID, FirstName, LastName, Phase
-                                FROM Clients
-                                WHERE FirstName = ? AND LastName = ?
-                            """
-
-                cursor.execute(query, (excel_first_name, excel_last_name))
-                client = cursor.fetchone()
-
-                # Check if the client exists
-                if not client:
-                    # If no client is found, print a message
-                    self.result_box.append(
-                        f"{excel_first_name} {excel_last_name} not found in Access. Withdrawal was not added.")
-                    self.result_box.append("")
-                    continue
+            # Get today's date for the transactions
+            today_date = datetime.today().strftime('%m/%d/%Y')
 
-                client_id, first_name, last_name, phase = client
+            # Load all clients once instead of querying Access for every spreadsheet row
+            clients = load_clients_frame(cursor)
 
-                # Check if the client's phase is 4
-                if phase == 4:
-                    # If phase is 4, print a message and skip the deposit
-                    self.result_box.append(
-                        f"{excel_first_name} {excel_last_name} found in Access, but Phase: 4. Withdrawal was not added.")
-                    self.result_box.append("")
-                    continue
+            # Load today's transactions once for the duplicate check
+            existing = load_existing_transactions(cursor, today_date)
 
-                # Get today's date for the transaction
-                today_date = datetime.today().strftime('%m/%d/%Y')
-
-                # Check if a matching transaction already exists
-                check_query = """
-                            SELECT TransactionID
-                            FROM Transactions
-                            WHERE TransactionDate = ? AND TransactionDescription = ? 
-                            AND WithdrawalAmount = ? AND ClientID = ?
-                            """
-                cursor.execute(check_query, (today_date, excel_type, excel_amount, client_id))
-                existing_transaction = cursor.fetchone()
-
-                if existing_transaction:
-                    # If transaction already exists, print message
-                    self.result_box.append(
-                        f"Transaction already exists for {excel_first_name} {excel_last_name} "
-                        f"with the amount {excel_amount} on {today_date}.")
-                    self.result_box.append("")
-                else:
-                    # Get the highest current transaction number from the Transactions table
-                    max_transaction_query = "SELECT MAX(TransactionID) FROM Transactions"
-                    cursor.execute(max_transaction_query)
-                    max_transaction = cursor.fetchone()[0]  # Fetch the current maximum
+            # Work out what should happen to every row before anything is written
+            plan = plan_transactions(df, clients, existing, direction)
+            inserts = planned_transaction_rows(plan, direction, today_date)
 
-                    # Create the new transaction number by adding 1
-                    new_transaction_number = max_transaction + 1
+            check_cancelled()
 
-                    # Insert the new transaction entry
-                    insert_query = """
-                                                INSERT INTO Transactions (TransactionID, TransactionDate, 
-                                                TransactionDescription, DepositAmount, WithdrawalAmount, ClientID)
-                                                VALUES (?, ?, ?, ?, ?, ?)
-                                            """
+            # Reserve one block of transaction numbers for the whole file
+            transaction_ids = IDAllocator(cursor, 'Transactions', 'TransactionID')
 
-                    deposit_amount = 0.00
-                    withdrawal_amount = excel_amount
+            def write_inserts():
+                transaction_ids.reserve(len(inserts))
+                insert_transactions(cursor, [(transaction_ids.allocate(),) + params for params in inserts])
 
-                    cursor.execute(insert_query, (new_transaction_number, today_date,
-                                                  excel_type, deposit_amount, withdrawal_amount, client_id))
+            # Write the whole file in one transaction, rolling everything back if any insert fails
+            if inserts:
+                try:
+                    run_with_id_retry(connection, [transaction_ids], write_inserts)
+                except database_errors() as e:
+                    connection.rollback()
+                    self.result_box.error(f"Error: {e}")
+                    self.result_box.append(f"The file was rolled back. No {label.lower()}s were added.")
+                    return
 
-                    self.result_box.append(
-                        f"Withdrew: {withdrawal_amount} from {excel_first_name} "
-                        f"{excel_last_name}'s account on {today_date}.")
-                    self.result_box.append("")
+            # Report what happened to every row
+            for entry in plan.itertuples(index=False):
+                first_name = entry.FirstName
+                last_name = entry.LastName
+                amount = entry.Amount
 
-                    # Commit the transaction
-                    connection.commit()
+                if entry.status == 'not_found':
+                    self.result_box.append(f"{first_name} {last_name} not found in Access. {label} was not added.")
+                elif entry.status == 'phase_4':
+                    self.result_box.append(
+                        f"{first_name} {last_name} found in Access, but Phase: 4. {label} was not added.")
+                elif entry.status == 'duplicate':
+                    self.result_box.append(
+                        f"Transaction already exists for {first_name} {last_name} "
+                        f"with the amount {amount} on {today_date}.")
+                elif direction == 'deposit':
+                    self.result_box.append(
+                        f"Deposited: {amount} to {first_name} {last_name}'s account on {today_date}.")
+                else:
+                    self.result_box.append(
+                        f"Withdrew: {amount} from {first_name} {last_name}'s account on {today_date}.")
+                self.result_box.append("")
 
         except FileNotFoundError:
-            self.result_box.setText("Withdrawal Excel file not found.")
+            self.result_box.error(f"{file_label} Excel file not found.")
 
-        except pyodbc.Error as e:
-            self.result_box.setText(f"Error: {e}")
+        except database_errors() as e:
+            self.result_box.error(f"Error: {e}")
 
         except Exception as e:
-            self.result_box.setText(f"Unexpected error: {e}")
+            self.result_box.error(f"Unexpected error: {e}")
+
         finally:
             if connection:
-                connection.close()
+                self.db.release(connection)
 
     def add_ins_outs(self):
         # Default connection
@@ -494,172 +2018,45 @@ class MainWindow(QMainWindow):
             file_path = auto_ins_outs_path
 
             # Read into a dataframe
-            df = pd.read_excel(file_path)
+            df = read_excel(file_path)
 
             # Establish connection to Access Database
-            connection = pyodbc.connect(connection_string)
+            connection = self.db.acquire()
             cursor = connection.cursor()
 
-            # Step 1: Get the max ClientID from the Clients table
-            max_id_query = "SELECT MAX(ClientID) FROM Clients"
-            cursor.execute(max_id_query)
-            max_client_id = cursor.fetchone()[0]
-
             self.result_box.clear()
 
-            # Step 2: Insert new clients from admissions_df into the Clients table
-            for index, row in df.iterrows():
-                entry_type = row['Type']
-                first_name = row['FirstName']
-                last_name = row['LastName']
-
-                if entry_type == 'A':
-                    # Check if the client already exists in the database
-                    client_check_query = """
-                            SELECT ClientID FROM Clients
-                            WHERE FirstName = ? AND LastName = ?
-                        """
-
-                    cursor.execute(client_check_query, first_name, last_name)
-                    existing_client = cursor.fetchone()
-
-                    if existing_client is not None:
-                        self.result_box.append(f"{first_name} {last_name} is already in Access Database.")
-                        self.result_box.append(
-                            "Check with records and manually enter the patient into Access Database.")
-                        self.result_box.append("")
-                    else:
-                        client_id = max_client_id + 1  # Incrementing for each new client
-                        max_client_id = client_id
-                        first_name = row['FirstName']
-                        last_name = row['LastName']
-                        phase = 1
-                        discharged = False
-                        comments = None  # No comments as per your request
-                        contract = row['Contract']
-
-                        # SQL query to insert the new client
-                        insert_query = """
-                            INSERT INTO Clients (ClientID, FirstName, LastName, Phase, Discharged, Comments, Contract)
-                            VALUES (?, ?, ?, ?, ?, ?, ?)
-                            """
-
-                        # Execute the query for each client
-                        cursor.execute(insert_query, client_id, first_name, last_name, phase, discharged, comments,
-                                       contract)
-
-                        # Get the max Transaction ID from the Transactions table
-                        max_transaction_id_query = "SELECT MAX(TransactionID) FROM Transactions"
-                        cursor.execute(max_transaction_id_query)
-                        max_transaction_id = cursor.fetchone()[0]
-
-                        if max_transaction_id is None:
-                            max_transaction_id = 1
-                        else:
-                            max_transaction_id += 1
-
-                        # Transaction details
-                        transaction_id = max_transaction_id
-                        transaction_date = datetime.now().strftime('%m/%d/%Y')  # Today's date
-                        transaction_description = 'Beginning Balance'
-                        deposit_amount = 0.00
-                        withdrawal_amount = 0.00
-
-                        # SQL query to insert a new transaction
-                        transaction_query = """
-                                INSERT INTO Transactions (TransactionID, TransactionDate, TransactionDescription, DepositAmount, WithdrawalAmount, ClientID)
-                                VALUES (?, ?, ?, ?, ?, ?)
-                                """
-
-                        # Execute the query to add the new transaction
-                        cursor.execute(transaction_query, transaction_id, transaction_date, transaction_description,
-                                       deposit_amount,
-                                       withdrawal_amount, client_id)
-
-                        self.result_box.append(f"{first_name} {last_name} added to Access Database.")
-                        self.result_box.append("")
-                elif entry_type == 'D':
-                    # Step 2: Insert Discharges from admissions_df into the Clients table on Access Database
-                    reason_for_discharge = row['ReasonForDischarge']
-
-                    # Find the Access ClientID by matching first and last names
-                    client_id_query = """
-                        SELECT ClientID, Phase FROM Clients
-                        WHERE FirstName = ? AND LastName = ?
-                    """
-
-                    cursor.execute(client_id_query, first_name, last_name)
-                    client_data = cursor.fetchone()
-
-                    if client_data is not None:
-                        client_id, current_phase = client_data
-
-                        # Check if the patient is already phase 4
-                        if int(current_phase) == 4:
-                            self.result_box.append(f"{first_name} {last_name} has already been discharged.")
-                            self.result_box.append("")
-                        else:
-                            # Get the max TransactionID from the Transactions table
-                            max_transaction_id_query = """
-                                    SELECT MAX(TransactionID) FROM Transactions
-                                    """
-                            cursor.execute(max_transaction_id_query)
-                            max_transaction_id = cursor.fetchone()[0]
-
-                            max_transaction_id = max_transaction_id + 1
-
-                            # Transaction details for discharge
-                            transaction_id = max_transaction_id
-                            transaction_date = datetime.now().strftime("%m/%d/%Y")
-                            transaction_description = reason_for_discharge
-                            deposit_amount = 0.00
-                            withdrawal_amount = 0.00
-
-                            # SQL query to insert a new discharge transaction
-                            transaction_query = """
-                                        INSERT INTO Transactions (TransactionID, TransactionDate, TransactionDescription, 
-                                        DepositAmount, WithdrawalAmount, ClientID)
-                                        VALUES (?, ?, ?, ?, ?, ?)
-                                    """
-
-                            cursor.execute(transaction_query, transaction_id, transaction_date,
-                                           transaction_description, deposit_amount, withdrawal_amount, client_id)
-
-                            update_phase_query = """
-                                        UPDATE Clients
-                                        SET Phase = 4
-                                        WHERE ClientID = ?
-                                    """
-                            cursor.execute(update_phase_query, client_id)
-
-                            self.result_box.append(f"{first_name} {last_name} discharged from Access Database.")
-                            self.result_box.append("")
-                    else:
-                        self.result_box.append(
-                            f"Client {first_name} {last_name} not found in Access Database. No discharge entry added.")
-                        self.result_box.append("")
-                else:
-                    self.result_box.append(f"Invalid entry type for {first_name} {last_name}")
+            # Step 1: Match every admission and discharge against the clients in Access at once
+            plan = plan_ins_outs(df, load_clients_frame(cursor))
+            transaction_date = datetime.now().strftime('%m/%d/%Y')  # Today's date
 
-            # Commit the transaction
-            connection.commit()
+            check_cancelled()
+
+            # Step 2: Write the admissions and discharges with newly allocated IDs and commit them together
+            client_ids = IDAllocator(cursor, 'Clients', 'ClientID')
+            transaction_ids = IDAllocator(cursor, 'Transactions', 'TransactionID')
+            run_with_id_retry(connection, [client_ids, transaction_ids],
+                              lambda: write_ins_outs(cursor, plan, client_ids, transaction_ids, transaction_date))
+
+            for message in ins_outs_messages(plan):
+                self.result_box.append(message)
 
         except FileNotFoundError:
-            self.result_box.setText("Ins n Outs Excel file not found.")
-        except pyodbc.Error as e:
-            self.result_box.setText(f"Error: {e}")
+            self.result_box.error("Ins n Outs Excel file not found.")
+        except database_errors() as e:
+            self.result_box.error(f"Error: {e}")
         except Exception as e:
-            self.result_box.setText(f"Unexpected error: {e}")
+            self.result_box.error(f"Unexpected error: {e}")
         finally:
             if connection:
-                connection.close()
+                self.db.release(connection)
 
     def replenish_store_balances_thurs(self):
         # Default connection
         connection = None
 
         try:
-            connection = pyodbc.connect(connection_string)
+            connection = self.db.acquire()
             cursor = connection.cursor()
 
             # Get today's date in the format MM-DD-YY
@@ -674,82 +2071,41 @@ class MainWindow(QMainWindow):
 
             self.result_box.clear()
 
-            try:
-                # Use xlwings to open the workbook and recalculate all formulas
-                app = xw.App(visible=False)  # Run Excel in the background
-                workbook = xw.Book(excel_file_path)
-                worksheet = workbook.sheets[0]
-
-                # Recalculate the workbook to ensure all formulas are updated
-                workbook.api.RefreshAll()  # Refresh all data connections and formulas
-                worksheet.api.Calculate()  # Recalculate worksheet formulas
-
-                # Iterate over the rows, starting at row 2
-                for row in range(2, worksheet.range('A1').current_region.last_cell.row + 1):
-                    last_name = worksheet.range(f'A{row}').value
-                    first_name = worksheet.range(f'B{row}').value
-                    store_balance = worksheet.range(f'G{row}').value  # Get the value from formula in Column G
-
-                    # Stop the loop if last_name is None
-                    if last_name is None:
-                        break
-                    # Query the Access database for the matching LastName and FirstName
-                    query = """
-                    SELECT [Sum of DepositAmount], [Sum of WithdrawalAmount]
-                    FROM Balance
-                    WHERE [LastName] = ? AND [FirstName] = ?
-                    """
-
-                    cursor.execute(query, (last_name, first_name))
-                    result = cursor.fetchone()
-
-                    if result:
-                        deposit_sum = result[0] if result[0] is not None else 0
-                        withdrawal_sum = result[1] if result[1] is not None else 0
-
-                        balance = float(deposit_sum - withdrawal_sum)
-                        current_add_col = worksheet.range(f'F{row}').value \
-                            if worksheet.range(f'F{row}').value is not None else 0
-
-                        store_balance = float(store_balance)
-
-                        # Only proceed if balance > 0 to avoid negative values being added
-                        if balance > 0:
-                            # Check if adding balance exceeds 100
-                            if (balance + store_balance) > 100:
-                                add_amount = 100 - store_balance - current_add_col
-                                worksheet.range(f'F{row}').value = current_add_col + add_amount
-                                self.result_box.append(
-                                    f"Added {add_amount} to {first_name} {last_name}'s store balance.")
-                            else:
-                                worksheet.range(f'F{row}').value = current_add_col + balance
-                                self.result_box.append(f"Added {balance} to {first_name} {last_name}'s store balance.")
+            # Fetch every client's Access balance in one query
+            balances = load_balances(cursor)
 
-                # Save the workbook to store recalculated values (optional)
-                workbook.save()
-                workbook.close()
-                app.quit()
+            check_cancelled()
+
+            try:
+                # Edit the file directly or through Excel, as set by excel_backend
+                if excel_backend == 'openpyxl':
+                    messages = replenish_store_list_openpyxl(excel_file_path, balances)
+                else:
+                    messages = replenish_store_list_xlwings(excel_file_path, balances)
 
             except Exception as e:
-                self.result_box.setText(f"Error loading Excel file: {e}")
+                self.result_box.error(f"Error loading Excel file: {e}")
                 return
 
+            for message in messages:
+                self.result_box.append(message)
+
         except FileNotFoundError:
-            self.result_box.setText("Store List Excel file not found.")
-        except pyodbc.Error as e:
-            self.result_box.setText(f"Error: {e}")
+            self.result_box.error("Store List Excel file not found.")
+        except database_errors() as e:
+            self.result_box.error(f"Error: {e}")
         except Exception as e:
-            self.result_box.setText(f"Unexpected error: {e}")
+            self.result_box.error(f"Unexpected error: {e}")
         finally:
             if connection:
-                connection.close()
+                self.db.release(connection)
 
     def generate_store_list(self):
         # Default connection
         connection = None
         try:
             # Create a connection to the Access database
-            connection = pyodbc.connect(connection_string)
+            connection = self.db.acquire()
             cursor = connection.cursor()
 
             # Query to fetch clients with Phase = 1
@@ -784,10 +2140,8 @@ class MainWindow(QMainWindow):
             ws['F1'] = 'Add to List'
             ws['G1'] = 'Balance'
 
-            # Load the linked Excel file (Store List_Linked_To_Access)
-            linked_file_path = linked_to_access_path
-            linked_wb = openpyxl.load_workbook(linked_file_path, data_only=True)
-            linked_ws = linked_wb.active
+            # Load the linked Excel file (Store List_Linked_To_Access) once into a name -> balance map
+            linked_balances = load_linked_balances(linked_to_access_path)
 
             # Iterate over clients and populate new file
             for idx, client in enumerate(clients, start=2):
@@ -798,16 +2152,10 @@ class MainWindow(QMainWindow):
                 ws[f'A{idx}'] = last_name  # LastName in column A
                 ws[f'B{idx}'] = first_name  # FirstName in column B
 
-                # Search for the matching name in the linked file
-                for row in linked_ws.iter_rows(min_row=2, values_only=True):  # Start from row 2, skip header
-                    linked_last_name = row[0]
-                    linked_first_name = row[1]
-                    linked_balance = row[6]  # Column G (balance) is the 7th column, index 6
-
-                    # Check if the names match
-                    if last_name.lower() == linked_last_name.lower() and first_name.lower() == linked_first_name.lower():
-                        ws[f'C{idx}'] = linked_balance  # Add the balance to the new file (column C)
-                        break  # Stop searching once the match is found
+                # Look up the matching name in the linked file, keyed the same way as load_linked_balances
+                linked_client = linked_balances.get((str(last_name).lower(), str(first_name).lower()))
+                if linked_client is not None:
+                    ws[f'C{idx}'] = linked_client[2]  # Add the balance to the new file (column C)
 
                 # Add formula to the G column (Balance) for the current row
                 ws[f'G{idx}'] = f'=C{idx}-D{idx}-E{idx}+F{idx}'
@@ -845,28 +2193,24 @@ class MainWindow(QMainWindow):
             ws[f'A{left_title_row}'].alignment = center_alignment
 
             # Create a set of full names (LastName, FirstName) for easy comparison
-            client_names = {(client[0].lower(), client[1].lower()) for client in clients}
+            client_names = {(str(client[0]).lower(), str(client[1]).lower()) for client in clients}
 
             # Start filling the "Left" list, one row below the "Left" title row
             left_list_row = left_title_row + 1
 
-            # Iterate through the linked Excel file and find names not in the clients list
-            for row in linked_ws.iter_rows(min_row=2, values_only=True):
-                linked_last_name = row[0]
-                linked_first_name = row[1]
-                linked_balance = row[6]
-
-                # Only proceed if both last name and first name are not None
-                if linked_last_name is not None and linked_first_name is not None:
-                    # Compare full name from linked list with client names
-                    if (linked_last_name.lower(), linked_first_name.lower()) not in client_names:
-                        # Add unmatched name to the "Left" list
-                        ws[f'A{left_list_row}'] = linked_last_name
-                        ws[f'B{left_list_row}'] = linked_first_name
-                        # Populate column C with the balance (Column G in linked file)
-                        ws[f'C{left_list_row}'] = linked_balance
-                        ws[f'F{left_list_row}'] = f'=C{left_list_row}-D{left_list_row}-E{left_list_row}'
-                        left_list_row += 1  # Move to the next row for the next unmatched name
+            # Names in the linked file that are not in the clients list make up the "Left" list
+            left_names = [name for name in linked_balances if name not in client_names]
+
+            for name in left_names:
+                linked_last_name, linked_first_name, linked_balance = linked_balances[name]
+
+                # Add unmatched name to the "Left" list
+                ws[f'A{left_list_row}'] = linked_last_name
+                ws[f'B{left_list_row}'] = linked_first_name
+                # Populate column C with the balance (Column G in linked file)
+                ws[f'C{left_list_row}'] = linked_balance
+                ws[f'F{left_list_row}'] = f'=C{left_list_row}-D{left_list_row}-E{left_list_row}'
+                left_list_row += 1  # Move to the next row for the next unmatched name
 
             # After all clients are added, find the row after the last client
             last_left_row = left_list_row
@@ -914,22 +2258,22 @@ class MainWindow(QMainWindow):
                                             f'-E{final_calc_row + 1}-F{final_calc_row + 1}+G{final_calc_row + 1}')
 
             # Save and open the new workbook
-            sl.save(file_path)
-            os.startfile(file_path)
+            save_workbook(sl, file_path)
+            open_file(file_path)
 
             # Clear previous results and print confirmation
             self.result_box.clear()
             self.result_box.append(f"{file_name} created.")
 
         except FileNotFoundError:
-            self.result_box.setText("Linked file not found.")
-        except pyodbc.Error as e:
-            self.result_box.setText(f"Error: {e}")
+            self.result_box.error("Linked file not found.")
+        except database_errors() as e:
+            self.result_box.error(f"Error: {e}")
         except Exception as e:
-            self.result_box.setText(f"Unexpected error: {e}")
+            self.result_box.error(f"Unexpected error: {e}")
         finally:
             if connection:
-                connection.close()
+                self.db.release(connection)
 
     def generate_deposits_sheet(self):
         try:
@@ -943,7 +2287,7 @@ class MainWindow(QMainWindow):
             deposit_files = [f for f in files if f.startswith("Deposits for Client Trust")]
 
             if not deposit_files:
-                self.result_box.setText("No deposit files found.")
+                self.result_box.error("No deposit files found.")
                 return
 
             # Sort files by the date in the format MM-DD-YY (removing .xlsx extension)
@@ -966,7 +2310,7 @@ class MainWindow(QMainWindow):
 
             # Now modify the new copy to clear specified cells
             # Load the workbook
-            workbook = openpyxl.load_workbook(destination_file)
+            workbook = open_workbook(destination_file)
 
             # Iterate over both Sheet1 and Sheet2
             for sheet_name in ['Sheet 1', 'Sheet 2']:
@@ -981,20 +2325,20 @@ class MainWindow(QMainWindow):
                         sheet[f'{col}{row}'].value = None  # Clear the content
 
             # Save the modified workbook
-            workbook.save(destination_file)
+            save_workbook(workbook, destination_file)
 
             # Update the result box to show success
             self.result_box.setText(f"Successfully created file: {destination_file}")
 
             # Open the newly created file
-            os.startfile(destination_file)
+            open_file(destination_file)
 
         except FileNotFoundError:
-            self.result_box.setText("Deposit file not found.")
-        except pyodbc.Error as e:
-            self.result_box.setText(f"Database error: {e}")
+            self.result_box.error("Deposit file not found.")
+        except database_errors() as e:
+            self.result_box.error(f"Database error: {e}")
         except Exception as e:
-            self.result_box.setText(f"Unexpected error: {e}")
+            self.result_box.error(f"Unexpected error: {e}")
 
     def generate_withdrawals_sheet(self):
         try:
@@ -1008,7 +2352,7 @@ class MainWindow(QMainWindow):
             withdrawal_files = [f for f in files if f.startswith("Withdrawals for Client Trust")]
 
             if not withdrawal_files:
-                self.result_box.setText("No withdrawal files found.")
+                self.result_box.error("No withdrawal files found.")
                 return
 
             # Sort files by the date in the format MM-DD-YY (removing .xlsx extension)
@@ -1031,7 +2375,7 @@ class MainWindow(QMainWindow):
 
             # Now modify the new copy to clear specified cells
             # Load the workbook
-            workbook = openpyxl.load_workbook(destination_file)
+            workbook = open_workbook(destination_file)
 
             # Iterate over both Sheet1 and Sheet2
             for sheet_name in ['Sheet 1', 'Sheet 2']:
@@ -1046,20 +2390,20 @@ class MainWindow(QMainWindow):
                         sheet[f'{col}{row}'].value = None  # Clear the content
 
             # Save the modified workbook
-            workbook.save(destination_file)
+            save_workbook(workbook, destination_file)
 
             # Update the result box to show success
             self.result_box.setText(f"Successfully created file: {destination_file}")
 
             # Open the newly created file
-            os.startfile(destination_file)
+            open_file(destination_file)
 
         except FileNotFoundError:
-            self.result_box.setText("Withdrawal file not found.")
-        except pyodbc.Error as e:
-            self.result_box.setText(f"Database error: {e}")
+            self.result_box.error("Withdrawal file not found.")
+        except database_errors() as e:
+            self.result_box.error(f"Database error: {e}")
         except Exception as e:
-            self.result_box.setText(f"Unexpected error: {e}")
+            self.result_box.error(f"Unexpected error: {e}")
 
     def new_patients_to_comcash(self):
         # Default connection
@@ -1067,15 +2411,15 @@ class MainWindow(QMainWindow):
 
         try:
             # Establish the connection to Access Database
-            connection = pyodbc.connect(connection_string)
+            connection = self.db.acquire()
 
             # Create a cursor object using the Access connection
             cursor = connection.cursor()
 
             # Query all phase 1 patients
-            query = '''
+            query = f'''
                     SELECT FirstName, LastName, Phase
-                    FROM Balance
+                    FROM {balance_source(cursor)} AS b
                     WHERE Phase = '1';
             '''
             cursor.execute(query)
@@ -1085,8 +2429,8 @@ class MainWindow(QMainWindow):
             # Establish connection to Comcash API
             api_client = APIClient()
 
-            deleted_customer_list = api_client.get_customer_list(2, 4)
-            active_customer_list = api_client.get_customer_list(1,4)
+            deleted_customers = api_client.get_customer_snapshot(2, 4)
+            active_customers = api_client.get_customer_snapshot(1, 4)
 
             # Clear previous results
             self.result_box.clear()
@@ -1094,24 +2438,16 @@ class MainWindow(QMainWindow):
             customers_added = 0
 
             for row in rows:
+                check_cancelled()
+
                 first_name = row.FirstName
                 last_name = row.LastName
 
-                # Check if the customer exists in the deleted_customer_list
-                customer_in_deleted_list = False
-
-
-                for deleted_customer in deleted_customer_list:
-                    if deleted_customer['firstName'] == first_name and deleted_customer['lastName'] == last_name:
-                        customer_in_deleted_list = True
-                        break
+                # Check if the customer exists in the deleted customer list
+                customer_in_deleted_list = deleted_customers.find(first_name, last_name) is not None
 
                 if not customer_in_deleted_list:
-                    customer_in_active_list = False
-                    for active_customer in active_customer_list:
-                        if active_customer['firstName'] == first_name and active_customer['lastName'] == last_name:
-                            customer_in_active_list = True
-                            break
+                    customer_in_active_list = active_customers.find(first_name, last_name) is not None
 
                     # Print appropriate messages based on customer presence
                     if not customer_in_active_list:
@@ -1126,13 +2462,13 @@ class MainWindow(QMainWindow):
             if customers_added == 0:
                 self.result_box.append("No patients were added to Comcash.")
 
-        except pyodbc.Error as e:
-            self.result_box.setText(f"Error: {e}")
+        except database_errors() as e:
+            self.result_box.error(f"Error: {e}")
         except Exception as e:
-            self.result_box.setText(f"Unexpected error: {e}")
+            self.result_box.error(f"Unexpected error: {e}")
         finally:
             if connection:
-                connection.close()
+                self.db.release(connection)
 
     def delete_patients_from_comcash(self):
         # Default connection
@@ -1140,15 +2476,15 @@ class MainWindow(QMainWindow):
 
         try:
             # Establish the connection to Access Database
-            connection = pyodbc.connect(connection_string)
+            connection = self.db.acquire()
 
             # Create a cursor object using the Access connection
             cursor = connection.cursor()
 
             # Query all phase 1 patients
-            query = '''
+            query = f'''
                     SELECT FirstName, LastName, Phase
-                    FROM Balance
+                    FROM {balance_source(cursor)} AS b
                     WHERE Phase IN ('2', '3', '4');
             '''
             cursor.execute(query)
@@ -1158,40 +2494,44 @@ class MainWindow(QMainWindow):
             # Establish connection to Comcash API
             api_client = APIClient()
 
-            active_customer_list = api_client.get_customer_list(1,4)
+            active_customers = api_client.get_customer_snapshot(1, 4)
 
             # Clear previous results
             self.result_box.clear()
 
             # For every row in the database query
             for row in rows:
+                check_cancelled()
+
                 first_name = row.FirstName
                 last_name = row.LastName
 
-                # For every active customer in the list, if there is name match, delete the customer
-                for active_customer in active_customer_list:
-                    if active_customer['firstName'] == first_name and active_customer['lastName'] == last_name:
-                        api_client.delete_customer(int(active_customer.get("id")))
-                        self.result_box.append(f"{first_name} {last_name}'s account removed from Comcash.")
+                # For every active customer with a name match, delete the customer
+                for active_customer in active_customers.find_all(first_name, last_name):
+                    api_client.delete_customer(int(active_customer.get("id")))
+                    self.result_box.append(f"{first_name} {last_name}'s account removed from Comcash.")
 
-        except pyodbc.Error as e:
-            self.result_box.setText(f"Error: {e}")
+        except database_errors() as e:
+            self.result_box.error(f"Error: {e}")
         except Exception as e:
-            self.result_box.setText(f"Unexpected error: {e}")
+            self.result_box.error(f"Unexpected error: {e}")
         finally:
             if connection:
-                connection.close()
+                self.db.release(connection)
 
     def generate_new_store_list(self):
+        # Default connection
+        connection = None
+
         try:
             # Create a connection to the Comcash API
             api_client = APIClient()
 
             # Get the customer list
-            customers = api_client.get_customer_list(1, 4)
+            customers = api_client.get_customer_snapshot(1, 4)
 
             # Create a connection to the Access database
-            connection = pyodbc.connect(connection_string)
+            connection = self.db.acquire()
             cursor = connection.cursor()
 
             # Query to fetch clients with Phase = 1
@@ -1222,24 +2562,12 @@ class MainWindow(QMainWindow):
             quarters_file_path = os.path.join(quarters_path, quarters_file_name)
 
             # Check if the previous store list exists
-            previous_data = {}
-
-            # Open the workbook using xlwings
-            with xw.App(visible=False) as app:
-                wb = app.books.open(previous_file_path)
-                ws = wb.sheets[0]  # Adjust if it's not the first sheet
-
-                # Read the data starting from row 4
-                for row_num in range(4, ws.api.UsedRange.Rows.Count + 1):
-                    prev_last_name = ws.range(f'A{row_num}').value
-                    prev_first_name = ws.range(f'B{row_num}').value
-                    final_balance = ws.range(f'H{row_num}').value  # Assuming final balance is in column H
-
-                    # Store in the dictionary
-                    if prev_last_name and prev_first_name:
-                        previous_data[(prev_last_name, prev_first_name)] = final_balance
+            if not os.path.exists(previous_file_path):
+                self.result_box.error(f"Previous store list '{previous_file_name}' not found.")
+                return
 
-                wb.close()
+            # Read yesterday's final balances straight from the file, without starting Excel
+            previous_data = load_previous_final_balances(previous_file_path)
 
             if os.path.exists(store_file_path):
                 print(f"File '{store_file_name}' already exists. No new file created.")
@@ -1274,6 +2602,21 @@ class MainWindow(QMainWindow):
                 ws['G3'] = "Added to Store Balance"
                 ws['H3'] = "Final Balance"
 
+                # Sales are read for last Wednesday, from 00:00 to 23:59
+                last_wednesday = datetime.now() - timedelta(days=6)
+                time_from = int(time.mktime(
+                    datetime(last_wednesday.year, last_wednesday.month, last_wednesday.day, 0, 0,
+                             0).timetuple()))
+                time_to = int(time.mktime(
+                    datetime(last_wednesday.year, last_wednesday.month, last_wednesday.day, 23, 59,
+                             59).timetuple()))
+
+                # Store list rows of clients that have a Comcash account, keyed by row number
+                customer_rows = {}
+
+                # Store list row of every name, for matching the Quarters sheet
+                store_rows = {}
+
                 row_num = 4  # Start at row 4
                 for client in clients:
                     last_name = client.LastName
@@ -1282,6 +2625,7 @@ class MainWindow(QMainWindow):
                     # Insert Last Name in column A and First Name in column B
                     ws[f'A{row_num}'] = last_name
                     ws[f'B{row_num}'] = first_name
+                    store_rows.setdefault((last_name, first_name), row_num)
 
                     # Check if the client existed in the previous day's store list
                     final_balance = previous_data.get((last_name, first_name), 0)  # Default to 0 if no match found
@@ -1290,95 +2634,90 @@ class MainWindow(QMainWindow):
                     ws[f'C{row_num}'] = final_balance
 
                     # Get customer ID (you will need to adapt this to match your data model)
-                    customer = next(
-                        (c for c in customers if c.get('lastName') == last_name and c.get('firstName') == first_name),
-                        None)
+                    customer = customers.find(first_name, last_name)
 
                     if customer:
-                        customer_id = customer['id']
+                        customer_rows[row_num] = (customer['id'], first_name, last_name)
 
-                        # Get sales for the customer
-                        last_wednesday = datetime.now() - timedelta(days=6)
-                        time_from = int(time.mktime(
-                            datetime(last_wednesday.year, last_wednesday.month, last_wednesday.day, 0, 0,
-                                     0).timetuple()))
-                        time_to = int(time.mktime(
-                            datetime(last_wednesday.year, last_wednesday.month, last_wednesday.day, 23, 59,
-                                     59).timetuple()))
+                    # Set the formula for Final Balance in column H
+                    ws[f'H{row_num}'] = f"=C{row_num}-E{row_num}-F{row_num}+G{row_num}"
 
-                        sales = api_client.get_customer_sales(customer_id, time_from, time_to)
+                    # Move to the next row
+                    row_num += 1
 
-                        # Initialize an empty list to store product details
-                        product_list = []
+                check_cancelled()
 
-                        # Initialize total payment
-                        total_payment = 0.00
+                # Read every client's sales from the local sales store, which only asks Comcash for days it
+                # doesn't have yet
+                customer_ids = [customer_id for customer_id, first_name, last_name in customer_rows.values()]
+                sales_by_customer, sales_failures = sales_store.get_sales_for_customers(api_client, customer_ids,
+                                                                                        time_from, time_to)
 
-                        # Check if sales data exists
-                        if not sales:
-                            product_string = "No sales found"  # Set a default message if no sales are found
-                        else:
-                            # Process sales data (if any)
-                            for sale in sales:
-                                for product in sale['products']:
-                                    product_title = product['title']
-                                    product_price = product['price']
-                                    # Add product details to the list
-                                    product_list.append(f"{product_title} - ${product_price:.2f}")
-
-                                # Directly access the payment dictionary
-                                payment = sale.get('payment')
-                                if isinstance(payment, dict) and 'totalPayedAmount' in payment:
-                                    total_payment += float(payment['totalPayedAmount'])
-                                else:
-                                    self.result_box.append(
-                                        f"Unexpected payment format or missing 'totalPayedAmount': {payment}")
-
-                            # Join the list into a formatted string
-                            product_string = '\n'.join(product_list)
-
-                        # Set the product details string in column D and total sales in column E
-                        ws[f'D{row_num}'] = product_string
-                        ws[f'E{row_num}'] = total_payment
+                # Any client without sales makes the run a failure, their rows are reported below
+                if sales_failures:
+                    self.result_box.error(f"Sales could not be retrieved for {len(sales_failures)} of "
+                                          f"{len(customer_ids)} customers.")
 
-                    # Set the formula for Final Balance in column H
-                    ws[f'H{row_num}'] = f"=C{row_num}-E{row_num}-F{row_num}+G{row_num}"
+                for sales_row, (customer_id, first_name, last_name) in customer_rows.items():
+                    # Report a failed request for this client and leave their sales for staff to fill in
+                    if customer_id in sales_failures:
+                        ws[f'D{sales_row}'] = "Sales not retrieved"
+                        self.result_box.append(f"Could not retrieve sales for {first_name} {last_name}: "
+                                               f"{sales_failures[customer_id]}")
+                        continue
 
-                    # Move to the next row
-                    row_num += 1
+                    sales = sales_by_customer.get(customer_id)
+
+                    # Initialize an empty list to store product details
+                    product_list = []
+
+                    # Initialize total payment
+                    total_payment = 0.00
+
+                    # Check if sales data exists
+                    if not sales:
+                        product_string = "No sales found"  # Set a default message if no sales are found
+                    else:
+                        # Process sales data (if any)
+                        for sale in sales:
+                            for product in sale['products']:
+                                product_title = product['title']
+                                product_price = product['price']
+                                # Add product details to the list
+                                product_list.append(f"{product_title} - ${product_price:.2f}")
+
+                            # Directly access the payment dictionary
+                            payment = sale.get('payment')
+                            if isinstance(payment, dict) and 'totalPayedAmount' in payment:
+                                total_payment += float(payment['totalPayedAmount'])
+                            else:
+                                self.result_box.append(
+                                    f"Unexpected payment format or missing 'totalPayedAmount': {payment}")
+
+                        # Join the list into a formatted string
+                        product_string = '\n'.join(product_list)
+
+                    # Set the product details string in column D and total sales in column E
+                    ws[f'D{sales_row}'] = product_string
+                    ws[f'E{sales_row}'] = total_payment
 
                 # Quarters sheet processing
                 if os.path.exists(quarters_file_path):
-                    quarters_wb = openpyxl.load_workbook(quarters_file_path)
-                    quarters_ws = quarters_wb.active
-
-                    # Iterate over the quarters sheet starting at row 2
-                    for quarter_row in quarters_ws.iter_rows(min_row=2, max_row=quarters_ws.max_row, min_col=1,
-                                                             max_col=3, values_only=True):
-                        q_last_name, q_first_name, q_amount = quarter_row
-
-                        # Track if the name was found in the store list
-                        found_in_store_list = False
-
-                        # Search for matching name in the store list (ws)
-                        for store_row in ws.iter_rows(min_row=4, max_row=ws.max_row, min_col=1, max_col=2,
-                                                      values_only=False):
-                            store_last_name_cell, store_first_name_cell = store_row
-                            store_last_name = store_last_name_cell.value
-                            store_first_name = store_first_name_cell.value
-
-                            # If a match is found
-                            if store_last_name == q_last_name and store_first_name == q_first_name:
-                                found_in_store_list = True  # Mark as found
-
-                                # Add the quarters amount (column C in quarters) to column F in store list
-                                ws[f'F{store_last_name_cell.row}'] = q_amount
-                                break
-
-                        # If the name wasn't found, append to result box
-                        if not found_in_store_list:
-                            message = (f"{q_first_name} {q_last_name} has a ${q_amount} transaction on quarters sheet, "
-                                       f"but the patient isn't on the store list")
+                    unmatched_quarters = []
+
+                    # Add each quarters amount (column C in quarters) to column F of the patient's store list row
+                    for (q_last_name, q_first_name), q_amount in load_quarters(quarters_file_path).items():
+                        store_row = store_rows.get((q_last_name, q_first_name))
+                        if store_row is None:
+                            unmatched_quarters.append(f"{q_first_name} {q_last_name}: ${q_amount}")
+                        else:
+                            ws[f'F{store_row}'] = q_amount
+
+                    # Report every quarters transaction that has no patient on the store list at once
+                    if unmatched_quarters:
+                        self.result_box.append(f"{len(unmatched_quarters)} quarters transactions are for patients "
+                                               f"who aren't on the store list:")
+                        for message in unmatched_quarters:
                             self.result_box.append(message)
 
                 # Determine the range of the table (from row 3 to the last row, columns A-H)
@@ -1394,20 +2733,23 @@ class MainWindow(QMainWindow):
                 ws.add_table(table)
 
                 # Save the new workbook
-                sl.save(store_file_path)
+                save_workbook(sl, store_file_path)
                 print(f"New Store List '{store_file_name}' created successfully.")
 
         except FileNotFoundError:
-            self.result_box.setText("Deposit file not found.")
-        except pyodbc.Error as e:
-            self.result_box.setText(f"Database error: {e}")
+            self.result_box.error("Deposit file not found.")
+        except database_errors() as e:
+            self.result_box.error(f"Database error: {e}")
         except Exception as e:
-            self.result_box.setText(f"Unexpected error: {e}")
+            self.result_box.error(f"Unexpected error: {e}")
+        finally:
+            if connection:
+                self.db.release(connection)
 
     def add_daily_deposits_to_store_list(self):
         try:
             # Read the Auto-Deposits Excel file using pandas
-            df_deposits = pd.read_excel(auto_deposits_path)
+            df_deposits = read_excel(auto_deposits_path)
 
             # Group deposits by 'FirstName' and 'LastName' and sum the 'Amount'
             df_grouped_deposits = df_deposits.groupby(['FirstName', 'LastName'], as_index=False)['Amount'].sum()
@@ -1416,11 +2758,6 @@ class MainWindow(QMainWindow):
             today = datetime.today().strftime('%m-%d-%y')
             store_list_file = os.path.join(new_store_folder_path, f'Store List_{today}.xlsx')
 
-            # Open the store list excel file using xlwings
-            app = xw.App(visible=False)  # Launch Excel in the background
-            wb = app.books.open(store_list_file)
-            sheet = wb.sheets[0]  # Assuming the relevant sheet is the first one
-
             # Function to calculate the previous Thursday
             def get_previous_thursday(start_date):
                 offset = (start_date.weekday() - 3) % 7
@@ -1435,81 +2772,40 @@ class MainWindow(QMainWindow):
 
             # Generate the dates from last Thursday up to yesterday
             date_list = [last_thursday + timedelta(days=i) for i in range((yesterday - last_thursday).days + 1)]
-            print(date_list)
-
-            # Starting from row 4, get first and last name columns
-            row = 4  # Starting row for names
-            while True:
-                store_last_name = sheet.range(f'A{row}').value
-                store_first_name = sheet.range(f'B{row}').value
-
-                # Stop if both first and last names are None
-                if store_last_name is None and store_first_name is None:
-                    break
-
-                # Iterate through the grouped deposits and compare with store list names
-                for index, deposit_row in df_grouped_deposits.iterrows():
-                    first_name_deposit = deposit_row['FirstName']
-                    last_name_deposit = deposit_row['LastName']
-                    total_amount = deposit_row['Amount']
-
-                    # Check if the name from the deposit file matches the store list names
-                    if store_last_name == last_name_deposit and store_first_name == first_name_deposit:
-                        # Calculate total_added_this_week by opening store lists for each day back to last Thursday
-                        total_added_this_week = 0
-
-                        # Loop through each date back to last Thursday, stopping at yesterday
-                        for date in date_list:
-                            date_str = date.strftime('%m-%d-%y')
-                            store_file_path = os.path.join(new_store_folder_path, f'Store List_{date_str}.xlsx')
-
-                            # Check if the file exists for this date
-                            if os.path.exists(store_file_path):
-                                try:
-                                    # Open the file and access the sheet
-                                    past_wb = app.books.open(store_file_path)
-                                    past_sheet = past_wb.sheets[0]
-
-                                    # Look for the person's 'Added' value in column G (assuming 'Added' is in column G)
-                                    for r in range(4, past_sheet.range('A' + str(past_sheet.cells.last_cell.row)).end(
-                                            'up').row + 1):
-                                        past_last_name = past_sheet.range(f'A{r}').value
-                                        past_first_name = past_sheet.range(f'B{r}').value
-
-                                        # If the names match, sum up the "Added" column values
-                                        if past_last_name == last_name_deposit and past_first_name == first_name_deposit:
-                                            added_value = past_sheet.range(f'G{r}').value
-                                            if added_value is not None:
-                                                total_added_this_week += added_value
-                                            break  # Exit the loop once a match is found
-
-                                    # Close the past workbook
-                                    past_wb.close()
-
-                                except Exception as e:
-                                    # Continue to the next file if there are issues opening this one
-                                    print(f"Error accessing file {store_file_path}: {e}")
-                                    continue
-
-                        # Print the total_added_this_week along with the person's total deposits
-                        print(
-                            f"{last_name_deposit} {first_name_deposit}: {total_amount}, Total Added This Week: {total_added_this_week}")
-                        break  # You can decide if you want to continue checking or break once matched
-
-                row += 1  # Move to the next row in the store list
-
-            # Clean up and close the Excel workbook
-            wb.close()
-            app.quit()
+
+            # Names on today's store list, read without opening Excel
+            store_names = read_store_list_names(store_list_file)
+
+            check_cancelled()
+
+            # Read each day's store list once for what was added to every patient this week
+            weekly_added = build_weekly_added_ledger(date_list)
+
+            # Join the store list against the deposits and the weekly ledger, keeping store list order
+            store_df = pd.DataFrame(store_names, columns=['LastName', 'FirstName'])
+            ledger_df = pd.DataFrame([(last, first, added) for (last, first), added in weekly_added.items()],
+                                     columns=['LastName', 'FirstName', 'AddedThisWeek'])
+            matched = store_df.merge(df_grouped_deposits, on=['LastName', 'FirstName'], how='inner')
+            matched = matched.merge(ledger_df, on=['LastName', 'FirstName'], how='left')
+            matched['AddedThisWeek'] = matched['AddedThisWeek'].fillna(0)
+
+            self.result_box.clear()
+
+            for row in matched.itertuples(index=False):
+                self.result_box.append(f"{row.LastName} {row.FirstName}: {row.Amount}, "
+                                       f"Total Added This Week: {row.AddedThisWeek}")
 
         except FileNotFoundError:
-            self.result_box.setText("Deposit file or store list file not found.")
-        except pyodbc.Error as e:
-            self.result_box.setText(f"Database error: {e}")
+            self.result_box.error("Deposit file or store list file not found.")
+        except database_errors() as e:
+            self.result_box.error(f"Database error: {e}")
         except Exception as e:
-            self.result_box.setText(f"Unexpected error: {e}")
+            self.result_box.error(f"Unexpected error: {e}")
 
     def replenish_new_store_balances(self):
+        # Default connection
+        connection = None
+
         try:
             # Get today's date in MM-DD-YY format
             today = datetime.today().strftime('%m-%d-%y')
@@ -1524,103 +2820,220 @@ class MainWindow(QMainWindow):
             self.result_box.clear()
 
             # Check if the file exists
-            if os.path.exists(store_file_path):
-                try:
-                    # Use xlwings to open the workbook
-                    app = xw.App(visible=False)  # Run Excel in the background
-                    workbook = xw.Book(store_file_path)
-                    worksheet = workbook.sheets[0]
-
-                    # Recalculate the workbook to ensure all formulas are updated
-                    workbook.api.RefreshAll()  # Refresh all data connections and formulas
-                    worksheet.api.Calculate()  # Recalculate worksheet formulas
-
-                    # Establish connection to the Access database
-                    connection = pyodbc.connect(connection_string)
-                    cursor = connection.cursor()
-
-                    # Start iterating from row 4 (assuming names always start at row 4)
-                    row = 4
-                    while True:
-                        # Read the first name (column B) and last name (column A)
-                        last_name = worksheet.range(f'A{row}').value
-                        first_name = worksheet.range(f'B{row}').value
-
-                        # Read add column and final balance column
-                        current_final_balance = worksheet.range(f'H{row}').value
-                        current_add_column = worksheet.range(f'G{row}').value
-                        # Default to 0 if the "Added" column is None
-                        if current_add_column is None:
-                            current_add_column = 0
-
-                        # If both first and last names are empty, stop the loop
-                        if not first_name and not last_name:
-                            break
-
-                        # Query the Access database for the matching LastName and FirstName
-                        query = """
-                                    SELECT [Sum of DepositAmount], [Sum of WithdrawalAmount]
-                                    FROM Balance
-                                    WHERE [LastName] = ? AND [FirstName] = ?
-                                    """
-                        cursor.execute(query, (last_name, first_name))
-                        result = cursor.fetchone()
-
-                        if result:
-                            sum_of_deposits, sum_of_withdrawals = result
-                            if sum_of_deposits is None:
-                                sum_of_deposits = 0  # Handle potential None values
-                            if sum_of_withdrawals is None:
-                                sum_of_withdrawals = 0  # Handle potential None values
-
-                            # Calculate the access balance
-                            access_balance = sum_of_deposits - sum_of_withdrawals
-                            access_balance = float(access_balance)
-
-                            amount_to_add = 0.00
-
-                            if access_balance > 0.00:
-                                if (current_add_column + current_final_balance + access_balance) <= 100:
-                                    amount_to_add = (current_add_column + access_balance)
-                                    worksheet.range(f'G{row}').value = amount_to_add
-                                    self.result_box.append(f"Added ${amount_to_add} to {first_name} {last_name}'s account.")
-                                else:
-                                    amount_to_add = current_add_column + (100 - current_final_balance)
-                                    if amount_to_add >= 0:
-                                        worksheet.range(f'G{row}').value = amount_to_add
-                                        self.result_box.append(f"Added ${amount_to_add} to {first_name} "
-                                                               f"{last_name}'s account.")
-                        else:
-                            print(f"No data found for {first_name} {last_name} in the database.")
+            if not os.path.exists(store_file_path):
+                self.result_box.error("You need to create today's store list before you can continue.")
+                return
 
-                        # Move to the next row
-                        row += 1
+            # Fetch every client's Access balance in one query
+            connection = self.db.acquire()
+            balances = load_balances(connection.cursor())
 
-                    # Close the workbook and app when done
-                    workbook.save()
-                    workbook.close()
-                    app.quit()
-                    connection.close()
+            check_cancelled()
 
-                except Exception as e:
-                    self.result_box.setText(f"Error loading Excel file: {e}")
-                    return
+            try:
+                # Edit the file directly or through Excel, as set by excel_backend
+                if excel_backend == 'openpyxl':
+                    messages = replenish_new_store_list_openpyxl(store_file_path, balances)
+                else:
+                    messages = replenish_new_store_list_xlwings(store_file_path, balances)
 
-            else:
-                self.result_box.setText("You need to create today's store list before you can continue.")
+            except Exception as e:
+                self.result_box.error(f"Error loading Excel file: {e}")
+                return
+
+            for message in messages:
+                self.result_box.append(message)
 
         except FileNotFoundError:
-            self.result_box.setText("Store file not found.")
-        except pyodbc.Error as e:
-            self.result_box.setText(f"Database error: {e}")
+            self.result_box.error("Store file not found.")
+        except database_errors() as e:
+            self.result_box.error(f"Database error: {e}")
         except Exception as e:
-            self.result_box.setText(f"Unexpected error: {e}")
+            self.result_box.error(f"Unexpected error: {e}")
+        finally:
+            if connection:
+                self.db.release(connection)
+
+    def sync_comcash_sales(self):
+        try:
+            # Create a connection to the Comcash API
+            api_client = APIClient()
+
+            # Get the customer list
+            customers = api_client.get_customer_snapshot(1, 4)
+            customer_ids = [customer.get('id') for customer in customers.customers]
+
+            # Bring the last week of every customer's sales into the sales store, only days it doesn't have are fetched
+            last_day = date.today()
+            first_day = last_day - timedelta(days=6)
+            failures = sales_store.sync(api_client, customer_ids, first_day, last_day)
+
+            # Report the customers whose sales couldn't be fetched as a failure, they are fetched again next time
+            if failures:
+                self.result_box.error(f"Sales could not be retrieved for {len(failures)} of "
+                                      f"{len(customer_ids)} customers.")
+
+            for customer_id, message in failures.items():
+                customer = customers.get(customer_id) or {}
+                self.result_box.append(f"Could not retrieve sales for {customer.get('firstName')} "
+                                       f"{customer.get('lastName')}: {message}")
+
+            # Weekly spend, read from the store
+            totals = sales_store.spend_totals(first_day, last_day)
+            self.result_box.append(f"Sales synced for {len(customer_ids) - len(failures)} of {len(customer_ids)} "
+                                   f"customers. ${sum(totals.values()):.2f} spent at the store from "
+                                   f"{first_day:%m/%d/%y} to {last_day:%m/%d/%y}.")
+
+        except Exception as e:
+            self.result_box.error(f"Unexpected error: {e}")
 
 # ----------------
 # API Client CLass
 # ----------------
+
+# A Comcash customer list indexed by (firstName, lastName) and by id
+class CustomerSnapshot:
+    def __init__(self, customers):
+        self.customers = customers
+        self.fetched_at = time.time()
+        self.by_name = {}
+        self.by_id = {}
+
+        for customer in customers:
+            name = (customer.get('firstName'), customer.get('lastName'))
+            self.by_name.setdefault(name, []).append(customer)
+            self.by_id[customer.get('id')] = customer
+
+    def find(self, first_name, last_name):
+        # First customer with this exact name, or None
+        matches = self.by_name.get((first_name, last_name))
+        return matches[0] if matches else None
+
+    def find_all(self, first_name, last_name):
+        # Every customer with this exact name
+        return self.by_name.get((first_name, last_name), [])
+
+    def get(self, customer_id):
+        return self.by_id.get(customer_id)
+
+    def is_expired(self, ttl):
+        return time.time() - self.fetched_at > ttl
+
+# The Comcash bearer token shared by every APIClient using the same token file. It is read from the file once,
+# kept with the absolute time it expires and renewed shortly before then, and only one thread signs in when
+# several requests need a new token at once
+class TokenManager:
+    refresh_margin = config.get('comcash_token_refresh_margin', 60)  # Seconds before expiry a token is renewed
+    default_lifetime = 300  # Seconds a token is trusted when Comcash doesn't say when it expires
+
+    def __init__(self, token_file):
+        self.token_file = token_file
+        self.token = None
+        self.expires_at = None
+        self.refresh_at = None
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def token_expiry(token):
+        # The exp claim (seconds since the epoch) of a JWT, or None when the token isn't one
+        try:
+            claims = token.split('.')[1]
+            claims += '=' * (-len(claims) % 4)
+            return float(json.loads(base64.urlsafe_b64decode(claims))['exp'])
+        except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+            return None
+
+    def load(self):
+        # Load token and expiration from a file if it exists
+        self.loaded = True
+        if not os.path.exists(self.token_file):
+            print("No token file found. Need to authenticate.")
+            return
+
+        with open(self.token_file, 'r') as file:
+            data = json.load(file)
+
+        # Files written before expiry times were absolute hold the token's lifetime, which is never a time
+        # since the epoch that hasn't passed, so the token is renewed
+        try:
+            expires_at = float(data.get("token_expiration"))
+        except (TypeError, ValueError):
+            expires_at = None
+        self.token = data.get("token")
+        self.expires_at = self.token_expiry(self.token) or expires_at
+        self.refresh_at = self.expires_at - self.refresh_margin if self.expires_at else None
+        print("Loaded token from file.")
+
+    def save(self):
+        # Save token and expiration (seconds since the epoch) to a file
+        data = {
+            "token": self.token,
+            "token_expiration": self.expires_at
+        }
+        with open(self.token_file, 'w') as file:
+            json.dump(data, file)
+        print("Token saved to file.")
+
+    def store(self, token, expires_in):
+        # Keep a new token with the absolute time it expires, from its exp claim when it has one
+        now = time.time()
+        try:
+            expires_in = float(expires_in)
+        except (TypeError, ValueError):
+            expires_in = self.default_lifetime
+        # An expiresIn bigger than any token lifetime is already a time since the epoch
+        expires_at = self.token_expiry(token) or (expires_in if expires_in > now / 2 else now + expires_in)
+
+        self.token = token
+        self.expires_at = expires_at
+        # Renew the margin before expiry, or halfway through a short-lived token
+        self.refresh_at = expires_at - min(self.refresh_margin, (expires_at - now) / 2)
+        self.save()
+
+    def is_valid(self):
+        # Check if token exists and isn't about to expire
+        return bool(self.token) and self.refresh_at is not None and time.time() < self.refresh_at
+
+    def ensure(self, sign_in):
+        # Sign in once, even when several threads find the token expired together
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            if not self.is_valid():
+                print("Token expired or invalid. Authenticating...")
+                sign_in()
+            return self.token
+
+    def invalidate(self, token):
+        # Forget a token Comcash rejected, unless another thread has already replaced it
+        with self.lock:
+            if self.token == token:
+                self.refresh_at = None
+
 class APIClient:
+    # Customer snapshots shared by every APIClient in this session, keyed by (status, customer_type)
+    customer_cache = {}
+    customer_cache_lock = threading.Lock()
+    customer_cache_ttl = config.get('comcash_cache_ttl', 300)  # Seconds before a snapshot is refetched
+
+    # Tokens shared by every APIClient in this session, keyed by token file
+    token_managers = {}
+    token_managers_lock = threading.Lock()
+
+    # One keep-alive connection pool shared by every APIClient in this session
+    session = None
+    session_lock = threading.Lock()
+    pool_size = config.get('comcash_pool_size', 10)  # Connections kept open to Comcash
+    request_timeout = config.get('comcash_timeout', 30)  # Seconds before a request is abandoned
+    request_retries = config.get('comcash_retries', 3)  # Retries after a 429, 5xx or dropped connection
+    retry_backoff = config.get('comcash_backoff', 0.5)  # Seconds before the first retry, doubled each time
+    retry_status_codes = (429, 500, 502, 503, 504)
+
     def __init__(self, token_file="token_data.json"):
+        # Comcash credentials are only read once something talks to Comcash
+        from API import API_KEY, API_PIN, API_PASSWORD, API_URL
+
         self.api_key = API_KEY
         self.pin = API_PIN
         self.password = API_PASSWORD
@@ -1631,31 +3044,78 @@ class APIClient:
         self.update_balance_url = f"{API_URL}/employee/customer/updatePoints"
         self.delete_customer_url = f"{API_URL}/employee/customer/delete"
         self.get_sales_url = f"{API_URL}/employee/customer/sales"
-        self.token_file = token_file
-        self.token = None
-        self.token_expiration = None
-        self.load_token_from_file()
-
-    def load_token_from_file(self):
-        # Load token and expiration from a file if it exists
-        if os.path.exists(self.token_file):
-            with open(self.token_file, 'r') as file:
-                data = json.load(file)
-                self.token = data.get("token")
-                self.token_expiration = data.get("token_expiration")
-                print("Loaded token from file.")
-        else:
-            print("No token file found. Need to authenticate.")
+        self.tokens = self.token_manager(token_file)
+
+    @classmethod
+    def token_manager(cls, token_file):
+        # One token per token file, so a new APIClient doesn't reread the file or sign in again
+        with cls.token_managers_lock:
+            if token_file not in cls.token_managers:
+                cls.token_managers[token_file] = TokenManager(token_file)
+            return cls.token_managers[token_file]
+
+    @property
+    def token(self):
+        return self.tokens.token
+
+    @classmethod
+    def get_session(cls):
+        # Create the pooled session the first time any request is made
+        with cls.session_lock:
+            if cls.session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=cls.pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers.update({'Content-Type': 'application/json'})
+                cls.session = session
+        return cls.session
+
+    def post(self, url, payload, timeout=None, authenticated=True, retry_server_errors=True):
+        # Send a request on the shared session, backing off and retrying when Comcash is busy or down
+        token = self.token
+        headers = {'Authorization': f'Bearer {token}'} if authenticated else {}
+        if timeout is None:
+            timeout = self.request_timeout
+        signed_in_again = False
+
+        for attempt in range(self.request_retries + 1):
+            retries_left = attempt < self.request_retries
+            delay = self.retry_backoff * (2 ** attempt)
 
-    def save_token_to_file(self):
-        # Save token and expiration to a file
-        data = {
-            "token": self.token,
-            "token_expiration": self.token_expiration
-        }
-        with open(self.token_file, 'w') as file:
-            json.dump(data, file)
-        print("Token saved to file.")
+            try:
+                with span('HTTP', 'call'):
+                    response = self.get_session().post(url, headers=headers, data=payload, timeout=timeout)
+            except requests.ConnectionError:
+                # Requests that create something are not resent, they may already have gone through
+                if not (retry_server_errors and retries_left):
+                    raise
+                print(f"Connection to Comcash failed. Retrying in {delay} seconds.")
+                time.sleep(delay)
+                continue
+
+            # A token Comcash rejected is renewed once and the request sent again, it wasn't carried out
+            if authenticated and response.status_code == 401 and not signed_in_again and retries_left:
+                signed_in_again = True
+                self.tokens.invalidate(token)
+                token = self.ensure_token()
+                headers = {'Authorization': f'Bearer {token}'}
+                print("Comcash rejected the token. Retrying with a new one.")
+                continue
+
+            # Only 429s are retried for requests that create something
+            retryable = response.status_code == 429 or (
+                    retry_server_errors and response.status_code in self.retry_status_codes)
+            if not (retryable and retries_left):
+                return response
+
+            # Honour Retry-After when Comcash sends it
+            retry_after = response.headers.get('Retry-After')
+            if retry_after and retry_after.isdigit():
+                delay = int(retry_after)
+
+            print(f"Comcash returned Status Code: {response.status_code}. Retrying in {delay} seconds.")
+            time.sleep(delay)
 
     def authenticate(self):
         # Request a new bearer token
@@ -1664,41 +3124,30 @@ class APIClient:
             "pin": self.pin,
             "password": self.password
         })
-        headers = {
-            "Content-Type": "application/json"
-        }
 
-        response = requests.post(self.signin_url, headers=headers, data=payload)
+        response = self.post(self.signin_url, payload, authenticated=False)
 
         if response.status_code == 200:
             data = response.json()
-            print(data)
-            self.token = data.get("accessToken")
             expires_in = data.get("expiresIn")
             print(f"Expires in: {expires_in}")
-            self.token_expiration = expires_in  # Track token expiration in seconds
-            self.save_token_to_file()  # Save token to file after successful authentication
+            self.tokens.store(data.get("accessToken"), expires_in)  # Saved to file with its absolute expiry
             print("Authenticated successfully. Token received.")
         else:
             print(f"Failed to authenticate. Status Code: {response.status_code}")
 
     def is_token_valid(self):
-        # Check if token exists and hasn't expired
-        if self.token and float(self.token_expiration) > time.time():
-            return True
-        return False
+        # Check if token exists and isn't about to expire
+        return self.tokens.is_valid()
+
+    def ensure_token(self):
+        # Sign in only when the shared token is missing or about to expire
+        return self.tokens.ensure(self.authenticate)
 
     def get_customer_list(self, status, customer_type):
-        if not self.is_token_valid():
-            print("Token expired or invalid. Authenticating...")
-            self.authenticate()
+        self.ensure_token()
 
         if self.token:
-            headers = {
-                'Content-Type': 'application/json',
-                'Authorization': f'Bearer {self.token}'
-            }
-
             payload = json.dumps({
                 "limit": 100000,
                 "order": "asc",
@@ -1706,7 +3155,7 @@ class APIClient:
                 "status": status
             })
 
-            response = requests.post(self.customer_list_url, headers=headers, data=payload)
+            response = self.post(self.customer_list_url, payload)
 
             if response.status_code == 200:
                 return response.json()
@@ -1714,17 +3163,34 @@ class APIClient:
                 print(f"Failed to fetch customer list. Status Code: {response.status_code}")
                 return None
 
+    def get_customer_snapshot(self, status, customer_type):
+        # Serve the customer list from the session cache until it expires
+        key = (status, customer_type)
+        with APIClient.customer_cache_lock:
+            snapshot = APIClient.customer_cache.get(key)
+            if snapshot is not None and not snapshot.is_expired(APIClient.customer_cache_ttl):
+                return snapshot
+
+        customers = self.get_customer_list(status, customer_type)
+        if customers is None:
+            # Never treat a failed fetch as an empty list, that would make everyone look new
+            raise RuntimeError("Failed to fetch the customer list from Comcash.")
+
+        snapshot = CustomerSnapshot(customers)
+        with APIClient.customer_cache_lock:
+            APIClient.customer_cache[key] = snapshot
+        return snapshot
+
+    @classmethod
+    def invalidate_customer_cache(cls):
+        # Drop every cached snapshot after customers are created, changed or deleted
+        with cls.customer_cache_lock:
+            cls.customer_cache.clear()
+
     def create_new_customer(self, first_name, last_name):
-        if not self.is_token_valid():
-            print("Token expired or invalid. Authenticating...")
-            self.authenticate()
+        self.ensure_token()
 
         if self.token:
-            headers = {
-                'Content-Type': 'application/json',
-                'Authorization': f'Bearer {self.token}'
-            }
-
             payload = json.dumps({
                 "countryPhoneCode": 1,
                 "phone": 0000000000,
@@ -1733,133 +3199,103 @@ class APIClient:
                 "locationId": 1
             })
 
-            response = requests.post(self.create_customer_url, headers=headers, data=payload)
+            response = self.post(self.create_customer_url, payload, retry_server_errors=False)
 
             if response.status_code == 200:
                 print("Customer created successfully.")
+                self.invalidate_customer_cache()
                 return response.json()
             else:
                 print(f"Failed to create customer. Status Code: {response.status_code}")
                 return None
 
     def update_customer_type(self, customer_id):
-        if not self.is_token_valid():
-            print("Token expired or invalid. Authenticating...")
-            self.authenticate()
+        self.ensure_token()
 
         if self.token:
-            headers = {
-                'Content-Type': 'application/json',
-                'Authorization': f'Bearer {self.token}'
-            }
-
             payload = json.dumps({
                 "id": customer_id,
                 "typeId": "4"
             })
 
-            response = requests.post(self.update_customer_url, headers=headers, data=payload)
+            response = self.post(self.update_customer_url, payload)
 
             if response.status_code == 200:
                 print("Customer type updated successfully.")
+                self.invalidate_customer_cache()
                 return response.json()
             else:
                 print(f"Failed to update customer type. Status Code: {response.status_code}")
                 return None
 
     def update_customer_balance(self, customer_id, balance):
-        if not self.is_token_valid():
-            print("Token expired or invalid. Authenticating...")
-            self.authenticate()
+        self.ensure_token()
 
         if self.token:
-            headers = {
-                'Content-Type': 'application/json',
-                'Authorization': f'Bearer {self.token}'
-            }
-
             payload = json.dumps({
                 "customerId": customer_id,
                 "storeCredit": float(balance)
             })
 
-            response = requests.post(self.update_balance_url, headers=headers, data=payload)
+            response = self.post(self.update_balance_url, payload)
 
             if response.status_code == 200:
                 print("Balance updated successfully.")
+                self.invalidate_customer_cache()
                 return response.json()
             else:
                 print(f"Failed to update balance. Status Code: {response.status_code}")
                 return None
 
     def delete_customer(self, customer_id):
-        if not self.is_token_valid():
-            print("Token expired or invalid. Authenticating...")
-            self.authenticate()
+        self.ensure_token()
 
         if self.token:
-            headers = {
-                'Content-Type': 'application/json',
-                'Authorization': f'Bearer {self.token}'
-            }
-
             payload = json.dumps({
                 "customerId": customer_id
             })
 
-            response = requests.post(self.delete_customer_url, headers=headers, data=payload)
+            response = self.post(self.delete_customer_url, payload)
 
             if response.status_code == 200:
                 print("Customer successfully deleted.")
+                self.invalidate_customer_cache()
                 return response.json()
             else:
                 print(f"Failed to delete customer. Status Code: {response.status_code}")
                 return None
 
     def update_customer_name(self, customer_id):
-        if not self.is_token_valid():
-            print("Token expired or invalid. Authenticating...")
-            self.authenticate()
+        self.ensure_token()
 
         if self.token:
-            headers = {
-                'Content-Type': 'application/json',
-                'Authorization': f'Bearer {self.token}'
-            }
-
             payload = json.dumps({
                 "id": customer_id,
                 "firstName": "Testing",
                 "lastName": "Again"
             })
 
-            response = requests.post(self.update_customer_url, headers=headers, data=payload)
+            response = self.post(self.update_customer_url, payload)
 
             if response.status_code == 200:
                 print("Name updated successfully.")
+                self.invalidate_customer_cache()
                 return response.json()
             else:
                 print(f"Failed to update customer name. Status Code: {response.status_code}")
                 return None
 
-    def get_customer_sales(self, customer_id, time_from, time_to):
-        if not self.is_token_valid():
-            print("Token expired or invalid. Authenticating...")
-            self.authenticate()
+    def get_customer_sales(self, customer_id, time_from, time_to, timeout=None):
+        self.ensure_token()
 
         if self.token:
-            headers = {
-                'Content-Type': 'application/json',
-                'Authorization': f'Bearer {self.token}'
-            }
-
             payload = json.dumps({
                 "customerId": customer_id,
                 "timeFrom": time_from,
                 "timeTo": time_to
             })
 
-            response = requests.post(self.get_sales_url, headers=headers, data=payload)
+            response = self.post(self.get_sales_url, payload, timeout=timeout)
 
             if response.status_code == 200:
                 print("Retrieved sales successfully.")
@@ -1868,12 +3304,338 @@ class APIClient:
                 print(f"Failed to retrieve sales. Status Code: {response.status_code}")
                 return None
 
+    def get_sales_for_customers(self, customer_ids, time_from, time_to, max_workers=None, timeout=None):
+        # Concurrency limit and per-request timeout come from the config unless given
+        if max_workers is None:
+            max_workers = config.get('comcash_max_workers', 8)
+        if timeout is None:
+            timeout = config.get('comcash_timeout', 30)
+
+        # Sign in before the requests start so the workers share one token
+        self.ensure_token()
+
+        sales_by_customer = {}
+        failures = {}
+
+        if not customer_ids:
+            return sales_by_customer, failures
+
+        # Fetch every customer's sales for the window in parallel, timed as part of the calling operation
+        spans = getattr(instrumentation, 'spans', None)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(call_in_spans, spans, self.get_customer_sales, customer_id, time_from, time_to,
+                                       timeout): customer_id
+                       for customer_id in customer_ids}
+
+            for future in as_completed(futures):
+                # Drop the requests that haven't started yet if the job is cancelled
+                try:
+                    check_cancelled()
+                except JobCancelled:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise
+
+                customer_id = futures[future]
+
+                # A failed request is reported for that customer instead of stopping the others
+                try:
+                    sales = future.result()
+                except Exception as e:
+                    failures[customer_id] = str(e)
+                    continue
+
+                if sales is None:
+                    failures[customer_id] = "Comcash did not return their sales."
+                else:
+                    sales_by_customer[customer_id] = sales
+
+        return sales_by_customer, failures
+
+# -------------------
+# Comcash Sales Store
+# -------------------
+
+# Comcash sales kept on disk so the store lists, weekly spend totals and audits read them locally instead of
+# asking Comcash for every customer on every run. Sales are fetched one calendar day at a time and filed under
+# that day, and each customer's watermark is the last whole day fetched for them. A sync carries on from the
+# day after the watermark, so only days that haven't been fetched yet are requested
+sales_store_path = config.get('sales_store_path', 'comcash_sales.sqlite3')
+sales_sync_max_days = config.get('sales_sync_max_days', 31)  # Most days caught up for a customer in one sync
+
+class SalesStore:
+    schema = '''
+        CREATE TABLE IF NOT EXISTS Sales (
+            CustomerID TEXT NOT NULL,
+            SaleID TEXT NOT NULL,
+            SaleDay TEXT NOT NULL,
+            TotalPaid REAL NOT NULL DEFAULT 0,
+            Sale TEXT NOT NULL,
+            PRIMARY KEY (CustomerID, SaleID)
+        );
+        CREATE INDEX IF NOT EXISTS SalesByDay ON Sales (SaleDay, CustomerID);
+        CREATE TABLE IF NOT EXISTS SyncedDays (
+            CustomerID TEXT NOT NULL,
+            SaleDay TEXT NOT NULL,
+            PRIMARY KEY (CustomerID, SaleDay)
+        );
+    '''
+
+    def __init__(self, database_path):
+        self.database_path = database_path
+        self.connection = None
+        self.lock = threading.Lock()  # One connection shared by the operations' worker threads
+
+    def connect(self):
+        # Open (and create) the store the first time it's used
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.database_path, check_same_thread=False)
+            self.connection.executescript(self.schema)
+        return self.connection
+
+    def query(self, sql, parameters=()):
+        with self.lock, span('sales store', 'query'):
+            return self.connect().execute(sql, parameters).fetchall()
+
+    def synced_days(self, customer_ids, first_day, last_day):
+        # Days between first_day and last_day that have been fetched, for each customer
+        rows = self.query("SELECT CustomerID, SaleDay FROM SyncedDays WHERE SaleDay BETWEEN ? AND ?",
+                          (first_day.isoformat(), last_day.isoformat()))
+        wanted = {str(customer_id) for customer_id in customer_ids}
+        synced = {}
+        for customer_id, sale_day in rows:
+            if customer_id in wanted:
+                synced.setdefault(customer_id, set()).add(date.fromisoformat(sale_day))
+        return synced
+
+    def watermarks(self):
+        # Last whole day fetched for every customer
+        rows = self.query("SELECT CustomerID, MAX(SaleDay) FROM SyncedDays GROUP BY CustomerID")
+        return {customer_id: date.fromisoformat(sale_day) for customer_id, sale_day in rows}
+
+    def store_day(self, sale_day, sales_by_customer, complete):
+        # Replace the customers' sales for the day in one transaction, so fetching a day again never
+        # duplicates a sale
+        rows = []
+        for customer_id, sales in sales_by_customer.items():
+            for index, sale in enumerate(sales):
+                payment = sale.get('payment')
+                total_paid = float(payment['totalPayedAmount']) \
+                    if isinstance(payment, dict) and 'totalPayedAmount' in payment else 0.0
+                # Sales without an id are keyed by their place in the day's list
+                sale_id = str(sale['id']) if sale.get('id') is not None else f"{sale_day.isoformat()}#{index}"
+                rows.append((str(customer_id), sale_id, sale_day.isoformat(), total_paid, json.dumps(sale)))
+        customer_days = [(str(customer_id), sale_day.isoformat()) for customer_id in sales_by_customer]
+
+        with self.lock, span('sales store', 'query'):
+            connection = self.connect()
+            with connection:
+                connection.executemany("DELETE FROM Sales WHERE CustomerID = ? AND SaleDay = ?", customer_days)
+                connection.executemany("INSERT OR REPLACE INTO Sales (CustomerID, SaleID, SaleDay, TotalPaid, Sale) "
+                                       "VALUES (?, ?, ?, ?, ?)", rows)
+                # Today is fetched again next time, its sales aren't all in yet
+                if complete:
+                    connection.executemany("INSERT OR IGNORE INTO SyncedDays (CustomerID, SaleDay) VALUES (?, ?)",
+                                           customer_days)
+
+    def sync(self, api_client, customer_ids, first_day, last_day):
+        # Fetch every day from first_day to last_day that a customer is missing, catching up from their
+        # watermark when it's earlier. Returns the customers whose sales couldn't be fetched
+        today = date.today()
+        last_day = min(last_day, today)
+        synced = self.synced_days(customer_ids, first_day, last_day)
+        watermarks = self.watermarks()
+
+        # Customers to fetch for each day
+        days_to_fetch = {}
+        for customer_id in customer_ids:
+            sale_day = first_day
+            watermark = watermarks.get(str(customer_id))
+            if watermark is not None and watermark < first_day:
+                # Catch up the days since the last sync, at most sales_sync_max_days of them
+                sale_day = min(first_day, max(watermark + timedelta(days=1),
+                                              last_day - timedelta(days=sales_sync_max_days - 1)))
+
+            while sale_day <= last_day:
+                if sale_day not in synced.get(str(customer_id), ()):
+                    days_to_fetch.setdefault(sale_day, []).append(customer_id)
+                sale_day += timedelta(days=1)
+
+        failures = {}
+        for sale_day in sorted(days_to_fetch):
+            check_cancelled()
+
+            # The whole day, from 00:00 to 23:59
+            time_from = int(time.mktime(datetime(sale_day.year, sale_day.month, sale_day.day, 0, 0, 0).timetuple()))
+            time_to = int(time.mktime(datetime(sale_day.year, sale_day.month, sale_day.day, 23, 59, 59).timetuple()))
+
+            sales_by_customer, day_failures = api_client.get_sales_for_customers(days_to_fetch[sale_day],
+                                                                                 time_from, time_to)
+            self.store_day(sale_day, sales_by_customer, sale_day < today)
+            for customer_id, message in day_failures.items():
+                failures.setdefault(customer_id, message)
+
+        return failures
+
+    def sales(self, customer_ids, first_day, last_day):
+        # Every stored sale of each customer between first_day and last_day, in the order they were fetched
+        rows = self.query("SELECT CustomerID, Sale FROM Sales WHERE SaleDay BETWEEN ? AND ? ORDER BY SaleDay, rowid",
+                          (first_day.isoformat(), last_day.isoformat()))
+        by_key = {str(customer_id): customer_id for customer_id in customer_ids}
+        sales_by_customer = {customer_id: [] for customer_id in customer_ids}
+        for customer_id, sale in rows:
+            if customer_id in by_key:
+                sales_by_customer[by_key[customer_id]].append(json.loads(sale))
+        return sales_by_customer
+
+    def spend_totals(self, first_day, last_day):
+        # Total paid by every customer between first_day and last_day, e.g. for the weekly spend
+        rows = self.query("SELECT CustomerID, SUM(TotalPaid) FROM Sales WHERE SaleDay BETWEEN ? AND ? "
+                          "GROUP BY CustomerID", (first_day.isoformat(), last_day.isoformat()))
+        return {customer_id: total for customer_id, total in rows}
+
+    def get_sales_for_customers(self, api_client, customer_ids, time_from, time_to):
+        # Same result as APIClient.get_sales_for_customers, but only days missing from the store go to Comcash
+        first_day = datetime.fromtimestamp(time_from).date()
+        last_day = datetime.fromtimestamp(time_to).date()
+        failures = self.sync(api_client, customer_ids, first_day, last_day)
+        sales_by_customer = self.sales([customer_id for customer_id in customer_ids if customer_id not in failures],
+                                       first_day, last_day)
+        return sales_by_customer, failures
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+sales_store = SalesStore(sales_store_path)
+
 # ------------------
 # Main Program Logic
 # ------------------
 
+# Command line names for the operations, each runs one or more ClientTrustOperations methods in order
+commands = {
+    'ingest-deposits': (['add_deposits'], "Add the Automated Deposits sheet to Access"),
+    'ingest-withdrawals': (['add_withdrawals'], "Add the Automated Withdrawals sheet to Access"),
+    'ins-outs': (['add_ins_outs'], "Add the Ins N Outs sheet to Access"),
+    'discharge': (['discharge_patients'], "Discharge phase 4 patients with a $0.00 balance"),
+    'verify-balances': (['verify_client_balances'], "Verify/rebuild the ClientBalances table"),
+    'deposits-sheet': (['generate_deposits_sheet'], "Generate a new deposits sheet"),
+    'withdrawals-sheet': (['generate_withdrawals_sheet'], "Generate a new withdrawals sheet"),
+    'store-list': (['generate_store_list'], "Generate today's Store List"),
+    'store-top-up': (['replenish_store_balances_thurs'], "Top up today's Store List balances to $100"),
+    'new-store-list': (['generate_new_store_list'], "Generate the New Store List"),
+    'new-store-deposits': (['add_daily_deposits_to_store_list'], "Add daily deposits to the New Store List"),
+    'new-store-top-up': (['replenish_new_store_balances'], "Top up the New Store List balances to $100"),
+    'comcash-add': (['new_patients_to_comcash'], "Add new/dephased patients to Comcash"),
+    'comcash-remove': (['delete_patients_from_comcash'], "Delete discharged/2nd phase patients from Comcash"),
+    'comcash-sync': (['new_patients_to_comcash', 'delete_patients_from_comcash'], "Run comcash-add then comcash-remove"),
+    'sales-sync': (['sync_comcash_sales'], "Bring the last week of Comcash sales into the local sales store"),
+}
+
+# Exit codes for the command line
+exit_ok = 0
+exit_failed = 1  # An operation reported an error
+exit_cancelled = 130  # Interrupted with Ctrl+C
+
+# Run the given commands without a window, returning the exit code
+def run_commands(command_names, json_output=False):
+    db = ConnectionManager(storage_backend)
+    exit_code = exit_ok
+
+    try:
+        for command in command_names:
+            reporter = CommandLineReporter(echo=not json_output)
+            operations = ClientTrustOperations(reporter, db)
+            spans = begin_spans(command)
+            status = 'ok'
+
+            try:
+                # Keep stdout to the JSON results, the operations' console prints go to stderr
+                with redirect_stdout(sys.stderr if json_output else sys.stdout):
+                    for method_name in commands[command][0]:
+                        getattr(operations, method_name)()
+                if reporter.failed:
+                    status = 'failed'
+            except KeyboardInterrupt:
+                status = 'cancelled'
+            except Exception as e:
+                reporter.error(f"Unexpected error: {e}")
+                status = 'failed'
+            finally:
+                end_spans(spans, status)
+
+            # One summary line, or one JSON object per command
+            if json_output:
+                result = spans.record(status)
+                result['messages'] = [message for message in reporter.messages if message]
+                print(json.dumps(result))
+            else:
+                print(spans.summary())
+
+            if status == 'cancelled':
+                return exit_cancelled
+            if status == 'failed':
+                exit_code = exit_failed
+    finally:
+        db.close_all()
+
+    return exit_code
+
+# Where startup time went: loading this module, showing the window and the modules imported on first use
+def startup_report(window_shown=None):
+    lines = [f"Startup: module loaded in {module_loaded - startup_started:.3f}s"]
+    if window_shown is not None:
+        lines.append(f"Startup: window shown after {window_shown - startup_started:.3f}s")
+    for name, seconds in deferred_import_times.items():
+        lines.append(f"Startup: {name} imported on first use in {seconds:.3f}s")
+    return lines
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Client Trust Management. Run without a command to open the window.",
+                                     formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog="commands:\n" + '\n'.join(f"  {name:20} {description}"
+                                                                       for name, (methods, description)
+                                                                       in commands.items()))
+    parser.add_argument('commands', nargs='*', metavar='command', help="Commands to run in order")
+    parser.add_argument('--json', action='store_true', help="Print one JSON result per command instead of text")
+    parser.add_argument('--open', action='store_true', help="Open generated workbooks when they are saved")
+    parser.add_argument('--profile-startup', action='store_true',
+                        help="Print how long startup took and which modules were imported later")
+    args = parser.parse_args(argv)
+
+    unknown = [command for command in args.commands if command not in commands]
+    if unknown:
+        parser.error(f"unknown command: {', '.join(unknown)}")
+
+    # Without a command, start the window
+    if not args.commands:
+        MainWindow = load_main_window()
+        from PyQt5.QtWidgets import QApplication
+        from PyQt5.QtCore import QTimer
+
+        app = QApplication(sys.argv[:1])
+        window = MainWindow()
+        window.show()
+
+        if args.profile_startup:
+            # Report once the event loop has painted the window, and again on exit for the later imports
+            QTimer.singleShot(0, lambda: print('\n'.join(startup_report(time.perf_counter()))))
+            app.aboutToQuit.connect(lambda: print('\n'.join(startup_report()[1:] or ["Startup: nothing imported later"])))
+        return app.exec()
+
+    # Scheduled runs don't open Excel unless asked to
+    global open_generated_files
+    open_generated_files = args.open
+
+    exit_code = run_commands(args.commands, json_output=args.json)
+    if args.profile_startup:
+        print('\n'.join(startup_report()), file=sys.stderr)
+    return exit_code
+
+# Everything above is defined, the rest of startup is the window or the commands
+module_loaded = time.perf_counter()
+
 if __name__ == "__main__":
-    app = QApplication(sys.argv)
-    window = MainWindow()
-    window.show()
-    sys.exit(app.exec())
\ No newline at end of file
+    sys.exit(main(sys.argv[1:]))
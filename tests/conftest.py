@@ -0,0 +1,30 @@
+import importlib.util
+import os
+
+import pytest
+
+# The application is a single script with a hyphenated name, loaded the same way benchmark.py loads it. It
+# reads config_work.json from the working directory when it is imported
+app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='session')
+def ctm():
+    working_dir = os.getcwd()
+    os.chdir(app_dir)
+    try:
+        spec = importlib.util.spec_from_file_location('client_trust_management',
+                                                      os.path.join(app_dir, 'client-trust-management.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        os.chdir(working_dir)
+    return module
+
+
+@pytest.fixture
+def cursor(ctm, tmp_path):
+    # A SQLite Client Trust database with the same tables the Access database has
+    connection = ctm.SQLiteBackend(str(tmp_path / 'client_trust.sqlite3')).connect()
+    yield connection.cursor()
+    connection.close()
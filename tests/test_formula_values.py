@@ -0,0 +1,102 @@
+import re
+import zipfile
+
+import openpyxl
+import pytest
+
+
+def store_list_workbook():
+    # Two clients with the Final Balance formula the New Store List writes, and a total under them
+    workbook = openpyxl.Workbook()
+    worksheet = workbook.active
+    worksheet.title = 'Store List'
+    worksheet.append(['Last Name', 'First Name', 'Starting Balance', 'Store Transactions', 'Total Spent at Store',
+                      'Quarter Transactions', 'Added to Store Balance', 'Final Balance'])
+    worksheet.append(['Lee', 'Ann', 40, None, 12.5, 2, 'n/a', '=C2-E2-F2+G2'])
+    worksheet.append(['Ray', 'Bob', 100, None, 0, 0, 25, '=C3-E3-F3+G3'])
+    worksheet['H4'] = '=SUM(H2:H3)'
+    return workbook
+
+
+def rewrite_sheet(file_path, rewrite):
+    # Rewrite the first sheet's XML, the way another writer could have saved the same cells
+    with zipfile.ZipFile(file_path) as source:
+        entries = {info.filename: source.read(info.filename) for info in source.infolist()}
+    entries['xl/worksheets/sheet1.xml'] = rewrite(entries['xl/worksheets/sheet1.xml'].decode('utf-8')).encode('utf-8')
+    with zipfile.ZipFile(file_path, 'w') as target:
+        for name, data in entries.items():
+            target.writestr(name, data)
+
+
+def cached_values(file_path):
+    return [row[0] for row in openpyxl.load_workbook(file_path, data_only=True).active.iter_rows(
+        min_row=2, min_col=8, max_col=8, values_only=True)]
+
+
+# ----------------
+# FormulaEvaluator
+# ----------------
+
+def test_cell_arithmetic_and_sums(ctm):
+    values = ctm.FormulaEvaluator(store_list_workbook().active).formula_values()
+
+    assert values == {'H2': 25.5, 'H3': 125.0, 'H4': 150.5}
+
+
+def test_numbers_and_absolute_references(ctm):
+    worksheet = openpyxl.Workbook().active
+    worksheet['A1'] = 10
+    worksheet['A2'] = '=$A$1 - 2.5 + SUM($A$1:A1)'
+
+    assert ctm.FormulaEvaluator(worksheet).formula_values() == {'A2': 17.5}
+
+
+def test_formulas_that_cannot_be_worked_out_are_left_out(ctm):
+    worksheet = openpyxl.Workbook().active
+    worksheet['A1'] = '=A2+1'
+    worksheet['A2'] = '=A1+1'
+    worksheet['A3'] = '=ROUND(B1, 2)'
+    worksheet['A4'] = '=B1*2'
+    worksheet['A5'] = '=B1+3'
+
+    assert ctm.FormulaEvaluator(worksheet).formula_values() == {'A5': 3.0}
+
+
+# --------------------
+# cache_formula_values
+# --------------------
+
+@pytest.mark.parametrize('empty_value', ['<v />', '<v/>', '<v></v>', ''])
+def test_values_are_cached_in_every_empty_value_form(ctm, tmp_path, empty_value):
+    file_path = str(tmp_path / 'Store List.xlsx')
+    workbook = store_list_workbook()
+    workbook.save(file_path)
+    rewrite_sheet(file_path, lambda xml: re.sub(r'</f>(<v\s*/>|<v>\s*</v>)?</c>', f'</f>{empty_value}</c>', xml))
+
+    ctm.cache_formula_values(file_path, workbook)
+
+    assert cached_values(file_path) == [25.5, 125.0, 150.5]
+
+
+def test_save_workbook_keeps_the_formulas(ctm, tmp_path):
+    file_path = str(tmp_path / 'Store List.xlsx')
+
+    ctm.save_workbook(store_list_workbook(), file_path)
+
+    assert cached_values(file_path) == [25.5, 125.0, 150.5]
+    worksheet = openpyxl.load_workbook(file_path).active
+    assert [worksheet[f'H{row}'].value for row in (2, 3, 4)] == ['=C2-E2-F2+G2', '=C3-E3-F3+G3', '=SUM(H2:H3)']
+    with zipfile.ZipFile(file_path) as saved:
+        assert 'fullCalcOnLoad="1"' in saved.read('xl/workbook.xml').decode('utf-8')
+
+
+def test_unrecognised_cells_are_reported(ctm, tmp_path, capsys):
+    file_path = str(tmp_path / 'Store List.xlsx')
+    workbook = store_list_workbook()
+    workbook.save(file_path)
+    rewrite_sheet(file_path, lambda xml: xml.replace('<f>C2-E2-F2+G2</f>', '<f t="normal">C2-E2-F2+G2</f>'))
+
+    ctm.cache_formula_values(file_path, workbook)
+
+    assert cached_values(file_path) == [None, 125.0, 150.5]
+    assert "1 formula values on 'Store List' could not be saved" in capsys.readouterr().out
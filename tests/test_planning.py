@@ -0,0 +1,128 @@
+import pandas as pd
+
+
+def add_clients(cursor, *clients):
+    cursor.executemany("INSERT INTO Clients (ClientID, FirstName, LastName, Phase) VALUES (?, ?, ?, ?)", clients)
+
+
+def ins_outs_sheet(*rows):
+    return pd.DataFrame.from_records(rows, columns=['FirstName', 'LastName', 'Type', 'Contract'])
+
+
+def transactions_sheet(*rows):
+    return pd.DataFrame.from_records(rows, columns=['FirstName', 'LastName', 'Type', 'Amount'])
+
+
+# -------------
+# plan_ins_outs
+# -------------
+
+def test_admissions_and_discharges_of_known_clients(ctm, cursor):
+    add_clients(cursor, (1, 'Ann', 'Lee', '1'), (2, 'Bob', 'Ray', '2'))
+    sheet = ins_outs_sheet(('Ann', 'Lee', 'A', 'C1'), ('bob', 'RAY', 'D', None), ('Cy', 'Moe', 'D', None),
+                           ('Dee', 'Fox', 'X', None))
+
+    plan = ctm.plan_ins_outs(sheet, ctm.load_clients_frame(cursor))
+
+    assert list(plan['status']) == ['already_in_access', 'discharge', 'not_found', 'invalid']
+    assert plan.loc[1, 'ClientID'] == 2
+
+
+def test_discharge_of_a_patient_admitted_earlier_in_the_file(ctm, cursor):
+    sheet = ins_outs_sheet(('Ann', 'Lee', 'A', 'C1'), ('Ann', 'Lee', 'D', None))
+
+    plan = ctm.plan_ins_outs(sheet, ctm.load_clients_frame(cursor))
+
+    assert list(plan['status']) == ['admit', 'discharge']
+    assert plan.loc[1, 'admission_row'] == 0
+
+
+def test_discharge_before_the_admission_in_the_file_is_not_found(ctm, cursor):
+    sheet = ins_outs_sheet(('Ann', 'Lee', 'D', None), ('Ann', 'Lee', 'A', 'C1'))
+
+    plan = ctm.plan_ins_outs(sheet, ctm.load_clients_frame(cursor))
+
+    assert list(plan['status']) == ['not_found', 'admit']
+
+
+def test_admission_repeated_in_the_file_is_added_once(ctm, cursor):
+    sheet = ins_outs_sheet(('Ann', 'Lee', 'A', 'C1'), ('ANN', 'lee', 'A', 'C1'))
+
+    plan = ctm.plan_ins_outs(sheet, ctm.load_clients_frame(cursor))
+
+    assert list(plan['status']) == ['admit', 'already_in_access']
+
+
+def test_repeated_discharges_only_discharge_once(ctm, cursor):
+    add_clients(cursor, (1, 'Ann', 'Lee', '2'), (2, 'Bob', 'Ray', '4'))
+    sheet = ins_outs_sheet(('Ann', 'Lee', 'D', None), ('Ann', 'Lee', 'D', None), ('Bob', 'Ray', 'D', None),
+                           ('Cy', 'Moe', 'A', 'C1'), ('Cy', 'Moe', 'D', None), ('Cy', 'Moe', 'D', None))
+
+    plan = ctm.plan_ins_outs(sheet, ctm.load_clients_frame(cursor))
+
+    assert list(plan['status']) == ['discharge', 'already_discharged', 'already_discharged',
+                                    'admit', 'discharge', 'already_discharged']
+
+
+# -----------------
+# plan_transactions
+# -----------------
+
+def test_transactions_are_matched_to_clients(ctm, cursor):
+    add_clients(cursor, (1, 'Ann', 'Lee', '1'), (2, 'Bob', 'Ray', '4'))
+    sheet = transactions_sheet(('ann', 'LEE', 'Paycheck', 25), ('Bob', 'Ray', 'Paycheck', 25),
+                               ('Cy', 'Moe', 'Paycheck', 25))
+
+    plan = ctm.plan_transactions(sheet, ctm.load_clients_frame(cursor),
+                                 ctm.load_existing_transactions(cursor, '01/02/2025'), 'deposit')
+
+    assert list(plan['status']) == ['insert', 'phase_4', 'not_found']
+    assert list(plan['ClientID']) == [1, 2, -1]
+
+
+def test_duplicates_of_access_ignore_case_and_rounding(ctm, cursor):
+    add_clients(cursor, (1, 'Ann', 'Lee', '1'))
+    cursor.execute("INSERT INTO Transactions (TransactionID, TransactionDate, TransactionDescription, "
+                   "DepositAmount, WithdrawalAmount, ClientID) VALUES (1, '01/02/2025', 'PAYCHECK', 10.1, 0, 1)")
+    sheet = transactions_sheet(('Ann', 'Lee', 'paycheck', 10.1000000001), ('Ann', 'Lee', 'Paycheck', 10.12))
+
+    plan = ctm.plan_transactions(sheet, ctm.load_clients_frame(cursor),
+                                 ctm.load_existing_transactions(cursor, '01/02/2025'), 'deposit')
+
+    assert list(plan['status']) == ['duplicate', 'insert']
+
+
+def test_duplicates_are_checked_in_either_direction(ctm, cursor):
+    add_clients(cursor, (1, 'Ann', 'Lee', '1'))
+    cursor.execute("INSERT INTO Transactions (TransactionID, TransactionDate, TransactionDescription, "
+                   "DepositAmount, WithdrawalAmount, ClientID) VALUES (1, '01/02/2025', 'Store', 0, 5, 1)")
+    existing = ctm.load_existing_transactions(cursor, '01/02/2025')
+    sheet = transactions_sheet(('Ann', 'Lee', 'Store', 5))
+
+    assert ctm.plan_transactions(sheet, ctm.load_clients_frame(cursor), existing, 'withdrawal')['status'][0] \
+        == 'duplicate'
+    assert ctm.plan_transactions(sheet, ctm.load_clients_frame(cursor), existing, 'deposit')['status'][0] \
+        == 'insert'
+
+
+def test_row_repeated_in_the_file_is_inserted_once(ctm, cursor):
+    add_clients(cursor, (1, 'Ann', 'Lee', '1'), (2, 'Bob', 'Ray', '1'))
+    sheet = transactions_sheet(('Ann', 'Lee', 'Paycheck', 25), ('ann', 'lee', 'PAYCHECK', '25.00'),
+                               ('Bob', 'Ray', 'Paycheck', 25))
+
+    plan = ctm.plan_transactions(sheet, ctm.load_clients_frame(cursor),
+                                 ctm.load_existing_transactions(cursor, '01/02/2025'), 'deposit')
+
+    assert list(plan['status']) == ['insert', 'duplicate', 'insert']
+
+
+def test_transactions_without_a_client_are_not_duplicate_keys(ctm, cursor):
+    add_clients(cursor, (1, 'Ann', 'Lee', '1'))
+    cursor.execute("INSERT INTO Transactions (TransactionID, TransactionDate, TransactionDescription, "
+                   "DepositAmount, WithdrawalAmount, ClientID) VALUES (1, '01/02/2025', 'Paycheck', 25, 0, NULL)")
+    sheet = transactions_sheet(('Ann', 'Lee', 'Paycheck', 25))
+
+    plan = ctm.plan_transactions(sheet, ctm.load_clients_frame(cursor),
+                                 ctm.load_existing_transactions(cursor, '01/02/2025'), 'deposit')
+
+    assert list(plan['status']) == ['insert']
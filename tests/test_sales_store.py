@@ -0,0 +1,122 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+
+
+class FakeComcash:
+    # Stands in for APIClient.get_sales_for_customers, recording the customers asked for on each day
+    def __init__(self, sales=None, failing=()):
+        self.sales = sales or {}
+        self.failing = set(failing)
+        self.requests = []
+
+    def get_sales_for_customers(self, customer_ids, time_from, time_to):
+        sale_day = datetime.fromtimestamp(time_from).date()
+        assert datetime.fromtimestamp(time_to).date() == sale_day
+        self.requests.append((sale_day, sorted(customer_ids)))
+        sales_by_customer = {customer_id: self.sales.get((customer_id, sale_day), [])
+                             for customer_id in customer_ids if customer_id not in self.failing}
+        failures = {customer_id: "HTTP 500" for customer_id in customer_ids if customer_id in self.failing}
+        return sales_by_customer, failures
+
+
+def sale(sale_id, amount):
+    return {'id': sale_id, 'payment': {'totalPayedAmount': amount}}
+
+
+@pytest.fixture
+def store(ctm, tmp_path):
+    sales_store = ctm.SalesStore(str(tmp_path / 'sales.sqlite3'))
+    yield sales_store
+    sales_store.close()
+
+
+def days(first_day, last_day):
+    return [first_day + timedelta(days=offset) for offset in range((last_day - first_day).days + 1)]
+
+
+def test_days_already_synced_are_not_fetched_again(store):
+    today = date.today()
+    first_day = today - timedelta(days=6)
+    comcash = FakeComcash()
+
+    assert store.sync(comcash, [1, 2], first_day, today) == {}
+    assert comcash.requests == [(day, [1, 2]) for day in days(first_day, today)]
+
+    # Today's sales aren't all in yet, so today is the only day fetched again
+    comcash.requests = []
+    store.sync(comcash, [1, 2], first_day, today)
+    assert comcash.requests == [(today, [1, 2])]
+
+
+def test_only_new_customers_are_fetched(store):
+    yesterday = date.today() - timedelta(days=1)
+    comcash = FakeComcash()
+    store.sync(comcash, [1], yesterday - timedelta(days=1), yesterday)
+
+    comcash.requests = []
+    store.sync(comcash, [1, 2], yesterday - timedelta(days=1), yesterday)
+
+    assert comcash.requests == [(yesterday - timedelta(days=1), [2]), (yesterday, [2])]
+
+
+def test_sync_catches_up_from_the_watermark(store):
+    today = date.today()
+    comcash = FakeComcash()
+    store.sync(comcash, [1], today - timedelta(days=12), today - timedelta(days=10))
+    assert store.watermarks() == {'1': today - timedelta(days=10)}
+
+    comcash.requests = []
+    store.sync(comcash, [1], today - timedelta(days=3), today - timedelta(days=1))
+
+    assert [day for day, customer_ids in comcash.requests] == days(today - timedelta(days=9), today - timedelta(days=1))
+    assert store.watermarks() == {'1': today - timedelta(days=1)}
+
+
+def test_catch_up_is_limited_to_the_most_recent_days(ctm, store, monkeypatch):
+    monkeypatch.setattr(ctm, 'sales_sync_max_days', 5)
+    today = date.today()
+    comcash = FakeComcash()
+    store.sync(comcash, [1], today - timedelta(days=30), today - timedelta(days=30))
+
+    comcash.requests = []
+    store.sync(comcash, [1], today - timedelta(days=2), today - timedelta(days=1))
+
+    assert [day for day, customer_ids in comcash.requests] == days(today - timedelta(days=5), today - timedelta(days=1))
+
+
+def test_failed_customers_are_fetched_again_next_time(store):
+    yesterday = date.today() - timedelta(days=1)
+    comcash = FakeComcash(failing=[2])
+
+    assert store.sync(comcash, [1, 2], yesterday, yesterday) == {2: "HTTP 500"}
+
+    comcash.failing = set()
+    comcash.requests = []
+    assert store.sync(comcash, [1, 2], yesterday, yesterday) == {}
+    assert comcash.requests == [(yesterday, [2])]
+
+
+def test_fetching_a_day_again_replaces_its_sales(store):
+    today = date.today()
+    comcash = FakeComcash({(1, today): [sale(10, '4.50')]})
+    store.sync(comcash, [1], today, today)
+
+    comcash.sales = {(1, today): [sale(10, '4.50'), sale(11, '2.00')]}
+    store.sync(comcash, [1], today, today)
+
+    assert store.sales([1], today, today) == {1: [sale(10, '4.50'), sale(11, '2.00')]}
+    assert store.spend_totals(today, today) == {'1': 6.5}
+
+
+def test_get_sales_for_customers_leaves_out_failures(store):
+    yesterday = date.today() - timedelta(days=1)
+    comcash = FakeComcash({(1, yesterday): [sale(10, '3.25'), {'total': 1}]}, failing=[2])
+    time_from = int(datetime(yesterday.year, yesterday.month, yesterday.day, 0, 0, 0).timestamp())
+    time_to = int(datetime(yesterday.year, yesterday.month, yesterday.day, 23, 59, 59).timestamp())
+
+    sales_by_customer, failures = store.get_sales_for_customers(comcash, [1, 2, 3], time_from, time_to)
+
+    assert sales_by_customer == {1: [sale(10, '3.25'), {'total': 1}], 3: []}
+    assert failures == {2: "HTTP 500"}
+    assert store.spend_totals(yesterday, yesterday) == {'1': 3.25}
@@ -0,0 +1,120 @@
+import base64
+import json
+import threading
+import time
+
+import pytest
+
+
+def jwt(claims):
+    # An unsigned JWT, only its claims are read
+    payload = base64.urlsafe_b64encode(json.dumps(claims).encode('utf-8')).decode('ascii').rstrip('=')
+    return f"header.{payload}.signature"
+
+
+@pytest.fixture
+def tokens(ctm, tmp_path):
+    return ctm.TokenManager(str(tmp_path / 'token_data.json'))
+
+
+def test_expires_in_is_a_lifetime(tokens):
+    before = time.time()
+    tokens.store('token', 3600)
+
+    assert before + 3600 <= tokens.expires_at <= time.time() + 3600
+    assert tokens.refresh_at == pytest.approx(tokens.expires_at - tokens.refresh_margin)
+    assert tokens.is_valid()
+
+
+def test_expires_in_is_already_an_epoch_time(tokens):
+    expires_at = time.time() + 3600
+    tokens.store('token', str(expires_at))
+
+    assert tokens.expires_at == pytest.approx(expires_at)
+
+
+def test_missing_expires_in_uses_the_default_lifetime(tokens):
+    tokens.store('token', None)
+
+    assert tokens.expires_at == pytest.approx(time.time() + tokens.default_lifetime, abs=5)
+
+
+def test_jwt_exp_claim_wins_over_expires_in(tokens):
+    expires_at = int(time.time()) + 7200
+    tokens.store(jwt({'exp': expires_at}), 60)
+
+    assert tokens.expires_at == expires_at
+
+
+def test_short_lived_token_is_renewed_halfway(tokens):
+    before = time.time()
+    tokens.store('token', 40)
+
+    assert before + 20 <= tokens.refresh_at <= time.time() + 20
+
+
+def test_expired_token_is_not_valid(tokens):
+    tokens.store(jwt({'exp': int(time.time()) - 10}), 3600)
+
+    assert not tokens.is_valid()
+
+
+def test_saved_token_is_loaded_with_its_expiry(ctm, tokens):
+    tokens.store('token', 3600)
+
+    loaded = ctm.TokenManager(tokens.token_file)
+    loaded.load()
+
+    assert loaded.token == 'token'
+    assert loaded.expires_at == pytest.approx(tokens.expires_at)
+    assert loaded.is_valid()
+
+
+def test_file_with_a_lifetime_instead_of_an_expiry_is_renewed(tokens):
+    # Files written before expiry times were absolute
+    with open(tokens.token_file, 'w') as file:
+        json.dump({'token': 'token', 'token_expiration': 3600}, file)
+
+    tokens.load()
+
+    assert tokens.token == 'token'
+    assert not tokens.is_valid()
+
+
+def test_threads_with_an_expired_token_sign_in_once(tokens):
+    sign_ins = []
+
+    def sign_in():
+        sign_ins.append(1)
+        time.sleep(0.05)
+        tokens.store(f"token {len(sign_ins)}", 3600)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(tokens.ensure(sign_in))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(sign_ins) == 1
+    assert results == ['token 1'] * 5
+
+
+def test_rejected_token_is_renewed_unless_already_replaced(tokens):
+    tokens.loaded = True
+    tokens.store('token 1', 3600)
+    tokens.store('token 2', 3600)
+
+    tokens.invalidate('token 1')
+    assert tokens.is_valid()
+
+    tokens.invalidate('token 2')
+    assert not tokens.is_valid()
+    assert tokens.ensure(lambda: tokens.store('token 3', 3600)) == 'token 3'
+
+
+def test_api_clients_share_one_token_per_file(ctm, tmp_path):
+    token_file = str(tmp_path / 'token_data.json')
+
+    assert ctm.APIClient.token_manager(token_file) is ctm.APIClient.token_manager(token_file)
+    assert ctm.APIClient.token_manager(token_file) is not ctm.APIClient.token_manager(str(tmp_path / 'other.json'))